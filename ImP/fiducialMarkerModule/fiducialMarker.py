@@ -2,10 +2,82 @@ import numpy as np
 from cv2 import aruco
 
 
+class MarkerDecodeIndex:
+    """
+    Lookup index identifying marker bits against an Aruco dictionary, with the same results as dictionary.identify.
+    Every rotation of every marker in the dictionary's bytesList is packed into one integer, so an exact match is a
+    single hash lookup, and other bits are matched by a vectorized popcount Hamming search within maxCorrectionBits.
+    """
+    # Number of set bits of each byte value
+    _POPCOUNT = np.array([bin(b).count('1') for b in range(256)], dtype=np.uint8)
+
+    def __init__(self, dictionary):
+        self.markerSize = dictionary.markerSize
+        self.maxCorrectionBits = dictionary.maxCorrectionBits
+        n_bits = self.markerSize * self.markerSize
+        n_bytes = (n_bits + 8 - 1) // 8
+        assert n_bytes <= np.dtype(np.uint64).itemsize
+        # Each bytesList row stores the bytes of the 4 rotations one after the other
+        bytes_list = np.ascontiguousarray(dictionary.bytesList, dtype=np.uint8)
+        rotation_bytes = bytes_list.reshape(len(bytes_list), 4, n_bytes).astype(np.uint64)
+        byte_shifts = np.array([8 * (n_bytes - 1 - j) for j in range(n_bytes)], dtype=np.uint64)
+        self._codes = np.bitwise_or.reduce(rotation_bytes << byte_shifts, axis=2)
+        # Weight of each bit (row-major) in a code, packed into bytes as Aruco does (last byte holds the remainder)
+        self._bit_weights = np.array([1 << (8 * (n_bytes - 1 - k // 8) + min(8, n_bits - 8 * (k // 8)) - 1 - k % 8)
+                                      for k in range(n_bits)], dtype=np.uint64)
+        # First (marker ID, rotation) of each code, in the order dictionary.identify checks them
+        self._exact_matches = dict()
+        for marker_id in range(len(self._codes)):
+            for rotation in range(4):
+                self._exact_matches.setdefault(int(self._codes[marker_id, rotation]), (marker_id, rotation))
+
+    def identify(self, onlyBits, maxCorrectionRate):
+        """
+        Identify the marker given its inner bits, as dictionary.identify does: the first marker (by ID) with
+        a rotation within the allowed number of erroneous bits is returned, with its closest rotation.
+        :param onlyBits: 2-dimensional array of the marker's inner bits (without border)
+        :param maxCorrectionRate: rate of the dictionary's maxCorrectionBits that may be erroneous
+        :return: (retval, id, rotation), where retval is False and id is -1 if the marker is not identified
+        """
+        code = np.bitwise_or.reduce(self._bit_weights[np.asarray(onlyBits).ravel() != 0])
+        max_correction = int(self.maxCorrectionBits * maxCorrectionRate)
+        exact_match = self._exact_matches.get(int(code))
+        if exact_match is not None:
+            # Only a lower ID within the allowed erroneous bits could take precedence over an exact match
+            if max_correction == 0 or exact_match[0] == 0:
+                return True, exact_match[0], exact_match[1]
+            codes = self._codes[:exact_match[0]]
+        elif max_correction == 0:
+            return False, -1, -1
+        else:
+            codes = self._codes
+        distances = self._hamming_distances(codes, code)
+        within_correction = np.flatnonzero(np.min(distances, axis=1) <= max_correction)
+        if len(within_correction) > 0:
+            marker_id = int(within_correction[0])
+            return True, marker_id, int(np.argmin(distances[marker_id]))
+        if exact_match is not None:
+            return True, exact_match[0], exact_match[1]
+        return False, -1, -1
+
+    @classmethod
+    def _hamming_distances(cls, codes, code):
+        """
+        Count the differing bits between each packed code and the given code.
+        :param codes: array of packed codes, of type np.uint64
+        :param code: packed code to compare against
+        :return: array of Hamming distances, with the shape of codes
+        """
+        differing = np.ascontiguousarray(np.bitwise_xor(codes, np.uint64(code)))
+        return np.sum(cls._POPCOUNT[differing.view(np.uint8)].reshape(codes.shape + (-1,)), axis=-1)
+
+
 class FiducialMarker:
     _dictionary = aruco.getPredefinedDictionary(aruco.DICT_4X4_50)
     _dictionary_size = 50
     _default_side_pixels = 6
+    _decode_index = MarkerDecodeIndex(_dictionary)
+    _decode_indices = dict()
 
     @staticmethod
     def get_dictionary():
@@ -23,6 +95,21 @@ class FiducialMarker:
     def get_max_correction_bits():
         return FiducialMarker.get_dictionary().maxCorrectionBits
 
+    @staticmethod
+    def get_decode_index(dictionary=None):
+        """
+        Get the MarkerDecodeIndex of a dictionary; the index of the default dictionary is built once at import,
+        and indices of other dictionaries are built once on first use.
+        :param dictionary: Aruco dictionary to get the index of; defaults to the dictionary set in FiducialMarker
+        :return: MarkerDecodeIndex of the dictionary
+        """
+        if dictionary is None or dictionary is FiducialMarker._dictionary:
+            return FiducialMarker._decode_index
+        key = (dictionary.markerSize, dictionary.maxCorrectionBits, dictionary.bytesList.tobytes())
+        if key not in FiducialMarker._decode_indices:
+            FiducialMarker._decode_indices[key] = MarkerDecodeIndex(dictionary)
+        return FiducialMarker._decode_indices[key]
+
     @staticmethod
     def dictionary_equal(dict1, dict2):
         return (
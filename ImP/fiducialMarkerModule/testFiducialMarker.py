@@ -63,6 +63,32 @@ class TestFiducialMarker(unittest.TestCase):
         self.assertFalse(numpy.array_equal(img_true, img_test),
                          "negative_generate_marker failed")
 
+    def test_get_decode_index(self):
+        self.assertIs(FiducialMarker.get_decode_index(),
+                      FiducialMarker.get_decode_index(FiducialMarker.get_dictionary()))
+        dictionary = aruco.getPredefinedDictionary(aruco.DICT_5X5_100)
+        self.assertIs(FiducialMarker.get_decode_index(dictionary),
+                      FiducialMarker.get_decode_index(aruco.getPredefinedDictionary(aruco.DICT_5X5_100)))
+        self.assertEqual(FiducialMarker.get_decode_index(dictionary).markerSize, 5)
+
+    def test_decode_index_identify_equals_dictionary_identify(self):
+        dictionary = FiducialMarker.get_dictionary()
+        decode_index = FiducialMarker.get_decode_index()
+        for ID in range(FiducialMarker.get_dictionary_size()):
+            # Inner bits of each marker, in each rotation, with and without an erroneous bit
+            bits = (FiducialMarker.draw_marker(ID)[1:-1, 1:-1] > 0).astype(numpy.uint8)
+            for rotation in range(4):
+                rotated_bits = numpy.rot90(bits, rotation).copy()
+                flipped_bits = rotated_bits.copy()
+                flipped_bits[ID % 4, rotation] ^= 1
+                for test_bits in (rotated_bits, flipped_bits):
+                    for rate in (0., 0.6, 1.):
+                        self.assertEqual(decode_index.identify(test_bits, rate)[:2],
+                                         dictionary.identify(test_bits, rate)[:2])
+                        if dictionary.identify(test_bits, rate)[0]:
+                            self.assertEqual(decode_index.identify(test_bits, rate),
+                                             dictionary.identify(test_bits, rate))
+
 
 if __name__ == '__main__':
     unittest.main()
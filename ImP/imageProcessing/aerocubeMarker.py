@@ -3,6 +3,7 @@ from enum import Enum
 import json
 import numpy as np
 from ImP.imageProcessing.settings import ImageProcessingSettings
+from ImP.imageProcessing.rotationConversion import multiply_quaternions, quaternions_to_rotation_matrices
 from ImP.fiducialMarkerModule.fiducialMarker import FiducialMarker, IDOutOfDictionaryBoundError
 
 
@@ -162,15 +163,28 @@ class AeroCube:
         _DUPLICATE_MARKERS:           "Duplicate AeroCube Marker used (Fiducial ID: {})"
     }
 
-    def __init__(self, markers):
+    # Pose of each face relative to the AeroCube, indexed by AeroCubeFace value
+    _FACE_QUATERNIONS = np.array([face.quaternion.elements for face in AeroCubeFace])
+    _FACE_TRANSLATIONS = np.array([face.translation for face in AeroCubeFace], dtype=np.float64)
+
+    def __init__(self, markers, quaternion=None, tvec=None):
+        """
+        :param markers: AeroCube Markers identified for this AeroCube, as a list or a MarkerTable
+        :param quaternion: pose of the AeroCube, if already reduced from its markers (see reduce_poses)
+        :param tvec: position of the AeroCube, if already reduced from its markers (see reduce_poses)
+        """
         # Check if arguments are valid
         self.raise_if_markers_invalid(markers)
         # Set instance variables
         print("making Aerocube")
         self._markers = markers
+        self._marker_table = MarkerTable.from_markers(markers)
         self._ID = markers[0].aerocube_ID
-        self._tvec = self.reduce_translation_vectors(markers)
-        self._quaternion = self.reduce_quaternions(markers)
+        if quaternion is None or tvec is None:
+            _, quaternions, tvecs = self.reduce_marker_table(self._marker_table)
+            quaternion, tvec = Quaternion(array=quaternions[0]), tvecs[0]
+        self._tvec = tvec
+        self._quaternion = quaternion
         self._distance= self.distance_from_tvec(self.tvec)
 
     def __eq__(self, other):
@@ -183,7 +197,7 @@ class AeroCube:
         :return: boolean indicating equivalence of self and other
         """
         return self.ID == other.ID and \
-            np.array_equal(self.markers, other.markers) and \
+            self.marker_table == other.marker_table and \
             np.array_equal(self.quaternion, other.quaternion) and \
             np.array_equal(self.tvec, other.tvec)
 
@@ -191,6 +205,10 @@ class AeroCube:
     def markers(self):
         return self._markers
 
+    @property
+    def marker_table(self):
+        return self._marker_table
+
     @property
     def ID(self):
         return self._ID
@@ -211,30 +229,69 @@ class AeroCube:
     def to_json(self):
         json_dict = {
             "CUBE_ID": int(self.ID),
-            "MARKERS": [m.to_jsonifiable_dict() for m in self.markers],
+            "MARKERS": self.marker_table.to_jsonifiable_dicts(),
             "QUATERNION": {k: v for k, v in zip(['w', 'x', 'y', 'z'], self.quaternion.elements)},
             "distance": self.distance
         }
         return json_dict
 
-    @staticmethod
-    def reduce_quaternions(markers):
-        print([m.to_jsonifiable_dict() for m in markers])
-        candidate_quats = [marker.quaternion * marker.aerocube_face.quaternion for marker in markers]
-        all_close = np.all([np.allclose(candidate_quats[0].elements, q.elements, atol=0.2) for q in candidate_quats])
-        if all_close or True:
-            return Quaternion(np.mean([q.elements for q in candidate_quats], axis=0)).normalised
-        else:
-            raise AttributeError("Quaternions are not close enough for AeroCube! candidate_quats: {}, original quats: {}".format(candidate_quats, [m.quaternion for m in markers]))
+    @classmethod
+    def reduce_poses(cls, cube_ids, faces, quaternions, tvecs):
+        """
+        Reduces the poses of stacked markers into one pose per AeroCube, for all AeroCubes at once.
+        Each marker gives a candidate AeroCube quaternion (marker quaternion times face quaternion), averaged as
+        the eigenvector of the largest eigenvalue of the sum of their outer products, which unlike the mean of
+        their components is insensitive to q and -q being the same rotation. Each marker also gives a candidate
+        AeroCube center (its tvec moved by the face translation, in the marker frame), which are averaged.
+        :param cube_ids: AeroCube ID of each marker, of shape (N,)
+        :param faces: AeroCubeFace value of each marker, of shape (N,)
+        :param quaternions: unit quaternion of each marker, of shape (N, 4)
+        :param tvecs: translation vector of each marker, of shape (N, 3)
+        :return: sorted unique AeroCube IDs (K,), AeroCube quaternions (K, 4) and AeroCube centers (K, 3)
+        """
+        quaternions = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4)
+        tvecs = np.asarray(tvecs, dtype=np.float64).reshape(-1, 3)
+        faces = np.asarray(faces, dtype=np.int64)
+        cube_ids, groups, counts = np.unique(cube_ids, return_inverse=True, return_counts=True)
+        groups = groups.ravel()
+        # Quaternions
+        candidate_quats = multiply_quaternions(quaternions, cls._FACE_QUATERNIONS[faces])
+        candidate_quats /= np.linalg.norm(candidate_quats, axis=1, keepdims=True)
+        outer_products = np.zeros((len(cube_ids), 4, 4))
+        np.add.at(outer_products, groups, candidate_quats[:, :, np.newaxis] * candidate_quats[:, np.newaxis, :])
+        # eigh sorts eigenvalues in ascending order
+        cube_quats = np.linalg.eigh(outer_products)[1][:, :, -1]
+        # Keep the sign of the component-wise mean, as AeroCube quaternions had before
+        quat_sums = np.zeros((len(cube_ids), 4))
+        np.add.at(quat_sums, groups, candidate_quats)
+        cube_quats *= np.where(np.sum(cube_quats * quat_sums, axis=1) < 0, -1., 1.)[:, np.newaxis]
+        # Translation vectors: the inverse rotation of (R t + d) is t + R^T d
+        rotations = quaternions_to_rotation_matrices(quaternions)
+        candidate_centers = tvecs + np.einsum('nji,nj->ni', rotations, cls._FACE_TRANSLATIONS[faces])
+        cube_centers = np.zeros((len(cube_ids), 3))
+        np.add.at(cube_centers, groups, candidate_centers)
+        cube_centers /= counts[:, np.newaxis]
+        return cube_ids, cube_quats, cube_centers
+
+    @classmethod
+    def reduce_marker_table(cls, marker_table):
+        """
+        Reduces the poses of the markers of a MarkerTable into one pose per AeroCube (see reduce_poses).
+        :param marker_table: MarkerTable, which may hold markers of different AeroCubes
+        :return: sorted unique AeroCube IDs (K,), AeroCube quaternions (K, 4) and AeroCube centers (K, 3)
+        """
+        return cls.reduce_poses(marker_table.aerocube_IDs, marker_table.faces,
+                                marker_table.quaternions, marker_table.tvecs)
 
-    @staticmethod
-    def reduce_translation_vectors(markers):
-        candidate_centers = [m.quaternion.inverse.rotate(np.add(m.quaternion.rotate(np.squeeze(m.tvec)), m.aerocube_face.translation)) for m in markers]
-        all_close = np.all([np.allclose(candidate_centers[0], c, atol=0.8) for c in candidate_centers])
-        if all_close or True:
-            return np.mean(candidate_centers, axis=0)
-        else:
-            raise AttributeError("Derived centers from marker tvecs are not close enough for AeroCube! candidate_centers: {}".format(candidate_centers))
+    @classmethod
+    def reduce_quaternions(cls, markers):
+        _, quaternions, _ = cls.reduce_marker_table(MarkerTable.from_markers(markers))
+        return Quaternion(array=quaternions[0])
+
+    @classmethod
+    def reduce_translation_vectors(cls, markers):
+        _, _, tvecs = cls.reduce_marker_table(MarkerTable.from_markers(markers))
+        return tvecs[0]
 
     @staticmethod
     def distance_from_tvec(tvec):
@@ -258,6 +315,207 @@ class AeroCube:
             raise AttributeError(AeroCube._ERR_MESSAGES[AeroCube._MARKERS_HAVE_MANY_AEROCUBES].format(aerocube_IDs))
 
 
+class MarkerView:
+    """
+    Read-only view of one row of a MarkerTable, with the attributes of an AeroCubeMarker.
+    Views hold no data of their own, so they are cheap to hand out to callers that want marker objects.
+    """
+    __slots__ = ('_array', '_index')
+
+    def __init__(self, array, index):
+        """
+        :param array: structured array of a MarkerTable
+        :param index: row of the marker in array
+        """
+        self._array = array
+        self._index = index
+
+    def __eq__(self, other):
+        if isinstance(other, (MarkerView, AeroCubeMarker)):
+            return (self.aerocube_ID == other.aerocube_ID and
+                    self.aerocube_face == other.aerocube_face and
+                    np.array_equal(self.corners, other.corners))
+        else:
+            return False
+
+    def __str__(self):
+        return "ID {} face {}".format(self.aerocube_ID, self.aerocube_face)
+
+    @property
+    def aerocube_ID(self):
+        return int(self._array['aerocube_ID'][self._index])
+
+    @property
+    def aerocube_face(self):
+        return AeroCubeFace(int(self._array['face'][self._index]))
+
+    @property
+    def corners(self):
+        return self._array['corners'][self._index]
+
+    @property
+    def quaternion(self):
+        return Quaternion(array=self._array['quaternion'][self._index])
+
+    @property
+    def tvec(self):
+        return self._array['tvec'][self._index]
+
+    @property
+    def distance(self):
+        return float(self._array['distance'][self._index])
+
+    def to_jsonifiable_dict(self):
+        return MarkerTable(self._array[self._index:self._index + 1]).to_jsonifiable_dicts()[0]
+
+
+class MarkerTable:
+    """
+    Columnar table of AeroCube Markers, stored as one structured array with a row per marker.
+    Columns are read as whole arrays (e.g., quaternions of shape (N, 4)), and rows as MarkerViews.
+    """
+    DTYPE = np.dtype([('aerocube_ID', np.int64),
+                      ('face', np.int8),
+                      ('corners', np.float64, (4, 2)),
+                      ('quaternion', np.float64, (4,)),
+                      ('tvec', np.float64, (3,)),
+                      ('distance', np.float64)])
+
+    def __init__(self, array=None):
+        """
+        :param array: structured array of dtype MarkerTable.DTYPE; an empty table if None
+        """
+        self._array = np.zeros(0, dtype=self.DTYPE) if array is None else array
+
+    @classmethod
+    def from_detections(cls, corners, ids, quaternions, tvecs):
+        """
+        Builds a table from the results of fiducial marker detection and pose estimation.
+        :param corners: corners of each marker, of shape (N, 4, 2) (or (N, 1, 4, 2), as returned by Aruco)
+        :param ids: fiducial marker ID of each marker, of shape (N,) (or (N, 1))
+        :param quaternions: quaternion of each marker, of shape (N, 4)
+        :param tvecs: translation vector of each marker, of shape (N, 3) (or (N, 1, 3), as returned by Aruco)
+        :return: MarkerTable of the markers
+        """
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if np.any(ids < 0) or np.any(ids >= AeroCubeMarker.get_dictionary_size()):
+            raise IDOutOfDictionaryBoundError('Invalid Marker ID')
+        if np.shape(corners) not in ((len(ids), 4, 2), (len(ids), 1, 4, 2)):
+            raise AeroCubeMarkerAttributeError("Invalid corner matrix shape")
+        array = np.zeros(len(ids), dtype=cls.DTYPE)
+        array['aerocube_ID'], array['face'] = np.divmod(ids, AeroCube.NUM_SIDES)
+        array['corners'] = np.reshape(corners, (-1, 4, 2))
+        array['quaternion'] = np.reshape(quaternions, (-1, 4))
+        array['tvec'] = np.reshape(tvecs, (-1, 3))
+        array['distance'] = np.linalg.norm(array['tvec'], axis=1)
+        return cls(array)
+
+    @classmethod
+    def from_markers(cls, markers):
+        """
+        Builds a table from AeroCubeMarkers (or MarkerViews); a MarkerTable is returned as is.
+        :param markers: array of AeroCubeMarkers
+        :return: MarkerTable of the markers
+        """
+        if isinstance(markers, MarkerTable):
+            return markers
+        array = np.zeros(len(markers), dtype=cls.DTYPE)
+        for row, marker in zip(array, markers):
+            row['aerocube_ID'] = marker.aerocube_ID
+            row['face'] = marker.aerocube_face.value
+            row['corners'] = marker.corners
+            row['quaternion'] = marker.quaternion.elements
+            row['tvec'] = np.reshape(marker.tvec, 3)
+            row['distance'] = marker.distance
+        return cls(array)
+
+    def __len__(self):
+        return len(self._array)
+
+    def __iter__(self):
+        return (MarkerView(self._array, i) for i in range(len(self._array)))
+
+    def __getitem__(self, key):
+        """
+        :param key: row index, for a MarkerView; or slice, mask or index array, for a MarkerTable of those rows
+        """
+        if isinstance(key, (int, np.integer)):
+            return MarkerView(self._array, range(len(self._array))[key])
+        return MarkerTable(self._array[key])
+
+    def __eq__(self, other):
+        if isinstance(other, MarkerTable):
+            return (np.array_equal(self.aerocube_IDs, other.aerocube_IDs) and
+                    np.array_equal(self.faces, other.faces) and
+                    np.array_equal(self.corners, other.corners))
+        else:
+            return False
+
+    @property
+    def array(self):
+        return self._array
+
+    @property
+    def aerocube_IDs(self):
+        return self._array['aerocube_ID']
+
+    @property
+    def faces(self):
+        return self._array['face']
+
+    @property
+    def corners(self):
+        return self._array['corners']
+
+    @property
+    def quaternions(self):
+        return self._array['quaternion']
+
+    @property
+    def tvecs(self):
+        return self._array['tvec']
+
+    @property
+    def distances(self):
+        return self._array['distance']
+
+    def group_by_aerocube(self):
+        """
+        Splits the table by AeroCube, keeping the order of markers within each AeroCube.
+        :return: list of (AeroCube ID, MarkerTable) tuples, sorted by AeroCube ID
+        """
+        order = np.argsort(self.aerocube_IDs, kind='stable')
+        cube_ids, counts = np.unique(self.aerocube_IDs, return_counts=True)
+        return [(int(cube_id), MarkerTable(self._array[indices]))
+                for cube_id, indices in zip(cube_ids, np.split(order, np.cumsum(counts)[:-1]))]
+
+    def to_markers(self):
+        """
+        :return: list of AeroCubeMarker objects, one per row
+        """
+        return [AeroCubeMarker(corners, aerocube_ID * AeroCube.NUM_SIDES + face, Quaternion(array=quaternion), tvec)
+                for aerocube_ID, face, corners, quaternion, tvec in zip(self.aerocube_IDs, self.faces, self.corners,
+                                                                        self.quaternions, self.tvecs)]
+
+    def to_jsonifiable_dicts(self):
+        """
+        Serializes every row as AeroCubeMarker.to_jsonifiable_dict does, converting each column only once.
+        :return: list of dictionaries, one per row
+        """
+        quaternion_keys = ['w', 'x', 'y', 'z']
+        return [{
+            "aerocubeID": aerocube_ID,
+            "aerocubeFace": face,
+            "corners": corners,
+            "quaternion": dict(zip(quaternion_keys, quaternion)),
+            "distance": distance
+        } for aerocube_ID, face, corners, quaternion, distance in zip(self.aerocube_IDs.tolist(),
+                                                                      self.faces.tolist(),
+                                                                      self.corners.tolist(),
+                                                                      self.quaternions.tolist(),
+                                                                      self.distances.tolist())]
+
+
 class AeroCubeMarkerAttributeError(Exception):
     """
     Raised when an attribute of AeroCubeMarker is incorrectly assigned
@@ -1,8 +1,10 @@
 import cv2
 from cv2 import aruco
+import hashlib
+import multiprocessing
 import numpy as np
 import os
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from ImP.imageProcessing.settings import ImageProcessingSettings
 from ImP.imageProcessing.aerocubeMarker import AeroCubeMarker
 
@@ -50,10 +52,165 @@ class CameraCalibration:
             IMG_RES=(2040, 2720)
         ) 
 
+    # Undistortion maps built by initUndistortRectifyMap, keyed by _undistort_maps_key; least recently used first
+    _undistort_maps = OrderedDict()
+    _undistort_maps_max_size = 4
+    # Directory in which undistortion maps are also stored as .npy files, if any
+    _undistort_maps_dir = None
+    # Calibrations derived by get_calibration_for_image, keyed by calibration, image resolution and crop
+    _derived_calibrations = dict()
+
     @staticmethod
     def get_default_calibration():
         return CameraCalibration.PredefinedCalibration.ANDREW_IPHONE
 
+    @classmethod
+    def get_calibration_for_image(cls, cal, img_res, crop=None):
+        """
+        Derive the calibration of images taken with the camera of cal, but (optionally) cropped and then
+        resized to img_res, e.g., images decoded at a reduced resolution. The camera matrix is scaled about
+        pixel centers, so that cx' = (cx - crop_x + 0.5) * img_res_x / crop_width - 0.5 (and likewise for y);
+        distortion coefficients apply to normalized coordinates, and are kept as is.
+        Derived calibrations are memoized, so picking one for every image costs a dictionary lookup.
+        :param cal: camera calibration, computed on images of resolution cal.IMG_RES
+        :param img_res: resolution of the target images as (y, x); further elements (e.g., channels of
+            an image shape) are ignored
+        :param crop: region (y, x, height, width) of the calibration resolution the target images were
+            cropped to before resizing; None for the full frame
+        :return: calibration for the target images; cal itself if they match its resolution and are not cropped
+        """
+        img_res = tuple(int(n) for n in img_res[:2])
+        crop = (0, 0) + tuple(cal.IMG_RES) if crop is None else tuple(int(n) for n in crop)
+        if img_res == tuple(cal.IMG_RES) and crop == (0, 0) + tuple(cal.IMG_RES):
+            return cal
+        key = (cls._undistort_maps_key(cal, cal.IMG_RES), cal.RET_VAL, cal.FOCAL_LENGTH, img_res, crop)
+        if key not in cls._derived_calibrations:
+            y, x, height, width = crop
+            if height <= 0 or width <= 0 or y < 0 or x < 0 or \
+                    y + height > cal.IMG_RES[0] or x + width > cal.IMG_RES[1]:
+                raise CameraCalibrationAttributeError("Crop {} is outside of calibration resolution {}"
+                                                      .format(crop, cal.IMG_RES))
+            scale_y, scale_x = img_res[0] / height, img_res[1] / width
+            camera_matrix = np.array(cal.CAMERA_MATRIX, dtype=np.float64)
+            camera_matrix[0] = [camera_matrix[0][0] * scale_x,
+                                camera_matrix[0][1] * scale_x,
+                                (camera_matrix[0][2] - x + 0.5) * scale_x - 0.5]
+            camera_matrix[1] = [0,
+                                camera_matrix[1][1] * scale_y,
+                                (camera_matrix[1][2] - y + 0.5) * scale_y - 0.5]
+            cls._derived_calibrations[key] = cal._replace(CAMERA_MATRIX=camera_matrix, IMG_RES=img_res)
+        return cls._derived_calibrations[key]
+
+    @classmethod
+    def set_undistort_maps_cache(cls, max_size=4, directory=None):
+        """
+        Configures the cache of undistortion maps, dropping any maps held in memory.
+        Maps of full resolution images take tens of megabytes each, hence the small default size.
+        :param max_size: number of (calibration, image size) pairs whose maps are kept in memory
+        :param directory: directory to also store maps in as .npy files, which are memory-mapped when
+            loaded, so processes sharing the directory build each map only once; None to not store maps
+        """
+        if max_size < 1:
+            raise CameraCalibrationAttributeError("Undistortion maps cache must hold at least one entry")
+        cls._undistort_maps.clear()
+        cls._undistort_maps_max_size = max_size
+        cls._undistort_maps_dir = directory
+
+    @staticmethod
+    def _undistort_maps_key(cal, img_size):
+        """
+        Calibrations hold arrays, so they are keyed by the bytes of the matrices used to build the maps.
+        :param cal: camera calibration
+        :param img_size: image size as (y, x); further elements (e.g., channels of an image shape) are ignored
+        :return: hashable key of the undistortion maps
+        """
+        return (np.asarray(cal.CAMERA_MATRIX, dtype=np.float64).tobytes(),
+                np.asarray(cal.DIST_COEFFS, dtype=np.float64).tobytes(),
+                tuple(int(n) for n in img_size[:2]))
+
+    @classmethod
+    def _get_undistort_maps_paths(cls, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return [os.path.join(cls._undistort_maps_dir, '{}_map{}.npy'.format(name, i)) for i in (1, 2)]
+
+    @classmethod
+    def _load_undistort_maps(cls, key):
+        """
+        :param key: key of the undistortion maps, from _undistort_maps_key
+        :return: memory-mapped (map1, map2), or None if they are not stored
+        """
+        paths = cls._get_undistort_maps_paths(key)
+        if not all(os.path.isfile(path) for path in paths):
+            return None
+        return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+    @classmethod
+    def _store_undistort_maps(cls, key, maps):
+        """
+        Stores undistortion maps as .npy files, each written to a temporary file first so that
+        other processes never load a partially written map.
+        :param key: key of the undistortion maps, from _undistort_maps_key
+        :param maps: (map1, map2)
+        """
+        os.makedirs(cls._undistort_maps_dir, exist_ok=True)
+        for path, undistort_map in zip(cls._get_undistort_maps_paths(key), maps):
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, undistort_map)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def get_undistort_maps(cls, cal, img_size):
+        """
+        Get the maps undistorting images of the given size taken with the given calibration, as used by cv2.remap.
+        Maps are built once per calibration and image size, and cached (see set_undistort_maps_cache).
+        Undistorted images keep the calibration's camera matrix, with no distortion.
+        :param cal: camera calibration
+        :param img_size: image size as (y, x), like IMG_RES and the first two elements of an image's shape
+        :return: (map1, map2), in the fixed-point representation of cv2.convertMaps (CV_16SC2)
+        """
+        key = cls._undistort_maps_key(cal, img_size)
+        if key in cls._undistort_maps:
+            cls._undistort_maps.move_to_end(key)
+            return cls._undistort_maps[key]
+        maps = None if cls._undistort_maps_dir is None else cls._load_undistort_maps(key)
+        if maps is None:
+            maps = cv2.initUndistortRectifyMap(cal.CAMERA_MATRIX, cal.DIST_COEFFS, None, cal.CAMERA_MATRIX,
+                                               (key[2][1], key[2][0]), cv2.CV_16SC2)
+            if cls._undistort_maps_dir is not None:
+                cls._store_undistort_maps(key, maps)
+        cls._undistort_maps[key] = maps
+        while len(cls._undistort_maps) > cls._undistort_maps_max_size:
+            cls._undistort_maps.popitem(last=False)
+        return maps
+
+    @classmethod
+    def undistort_image(cls, cal, img):
+        """
+        Corrects the lens distortion of an image, with cached undistortion maps (see get_undistort_maps).
+        :param cal: camera calibration of the image
+        :param img: image matrix
+        :return: undistorted image matrix
+        """
+        map1, map2 = cls.get_undistort_maps(cal, img.shape[:2])
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+    @staticmethod
+    def undistort_points(cal, points):
+        """
+        Corrects the lens distortion of points only (e.g., detected marker corners), without warping an image.
+        Undistorted points are in pixel coordinates of the calibration's camera matrix, as in undistort_image.
+        :param cal: camera calibration of the image the points are in
+        :param points: array of points of any shape (..., 2), such as corners of shape (N, 4, 2)
+        :return: array of undistorted points, of the same shape
+        """
+        points = np.asarray(points)
+        if points.size == 0:
+            return np.array(points, dtype=np.float64)
+        undistorted = cv2.undistortPoints(points.reshape(-1, 1, 2).astype(np.float64),
+                                          cal.CAMERA_MATRIX, cal.DIST_COEFFS, P=cal.CAMERA_MATRIX)
+        return undistorted.reshape(points.shape)
+
     @staticmethod
     def get_charucoboard():
         """
@@ -64,11 +221,28 @@ class CameraCalibration:
         SQUARES_Y = 5
         SQUARE_LENGTH = 10
         MARKER_LENGTH = 9
-        board = aruco.CharucoBoard_create(SQUARES_X, SQUARES_Y,
-                                          SQUARE_LENGTH,
-                                          MARKER_LENGTH,
-                                          AeroCubeMarker.get_dictionary())
-        return board
+        return CameraCalibration._create_charucoboard(SQUARES_X, SQUARES_Y, SQUARE_LENGTH, MARKER_LENGTH)
+
+    @staticmethod
+    def _create_charucoboard(squares_x, squares_y, square_length, marker_length):
+        """
+        Create a Charuco board of AeroCube markers; boards cannot be pickled, so worker processes
+        rebuild them from these params (see _get_charucoboard_params).
+        :return board: board object created by the aruco call
+        """
+        return aruco.CharucoBoard_create(squares_x, squares_y,
+                                         square_length,
+                                         marker_length,
+                                         AeroCubeMarker.get_dictionary())
+
+    @staticmethod
+    def _get_charucoboard_params(board):
+        """
+        :param board: Charucoboard object
+        :return: (squares_x, squares_y, square_length, marker_length) of the board
+        """
+        squares_x, squares_y = board.getChessboardSize()
+        return int(squares_x), int(squares_y), float(board.getSquareLength()), float(board.getMarkerLength())
 
     @staticmethod
     def draw_charucoboard(out_size, file_path):
@@ -83,31 +257,76 @@ class CameraCalibration:
         cv2.imwrite(file_path, aruco.drawPlanarBoard(board, out_size))
 
     @staticmethod
-    def get_calibration_matrices(board, img_arr):
+    def _get_charuco_cache_path(cache_dir, board_params, img):
+        """
+        Detections are cached by the content of the image (and the board looked for), so that renamed or
+        reloaded photos of a calibration set are still found in the cache.
+        :return: path of the .npz file caching the Charuco detection of img
+        """
+        content_hash = hashlib.sha1(repr((board_params, img.shape, img.dtype.str)).encode())
+        content_hash.update(np.ascontiguousarray(img).data)
+        return os.path.join(cache_dir, 'charuco_{}.npz'.format(content_hash.hexdigest()))
+
+    @staticmethod
+    def _load_charuco_detection(cache_path):
+        """
+        :return: (charuco_corners, charuco_IDs) cached at cache_path, or None if there are none
+        """
+        if not os.path.isfile(cache_path):
+            return None
+        with np.load(cache_path) as cached:
+            # Empty arrays stand for the None returned by Aruco when no corners are found
+            return tuple(cached[k] if cached[k].size > 0 else None for k in ('charuco_corners', 'charuco_IDs'))
+
+    @staticmethod
+    def _store_charuco_detection(cache_path, detection):
         """
+        Caches a Charuco detection, written to a temporary file first so that no partial file is ever loaded.
+        :param detection: (charuco_corners, charuco_IDs)
+        """
+        charuco_corners, charuco_IDs = (np.empty(0) if d is None else d for d in detection)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, charuco_corners=charuco_corners, charuco_IDs=charuco_IDs)
+        os.replace(tmp_path, cache_path)
+
+    @staticmethod
+    def get_calibration_matrices(board, img_arr, workers=None, cache_dir=None):
+        """
+        Charuco corners are detected in each image over a pool of worker processes, and (optionally) cached on
+        disk by image content, so that recalibrating after adding images to a set only processes the new ones.
+        Markers are looked for in the AeroCube dictionary, which the board is expected to be made of.
         :param board: Charucoboard object to calibrate against
         :param img_arr: array of images (from different viewpoints)
+        :param workers: number of worker processes; defaults to the number of CPUs, and 1 detects in this process
+        :param cache_dir: directory in which to cache detections; None to not cache them
         :return ret_val: unknown usage
         :return camera_matrix: 3X3 camera calibration matrix
         :return dist_coeffs: camera's distortion coefficients
         """
-        dictionary = AeroCubeMarker.get_dictionary()
-        all_charuco_corners = []
-        all_charuco_IDs = []
-        img_size = None
-        for img in img_arr:
-            # Convert to grayscale before performing operations
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            corners, IDs, _ = aruco.detectMarkers(gray, dictionary)
-            _, charuco_corners, charuco_IDs = aruco.interpolateCornersCharuco(
-                                                                corners,
-                                                                IDs,
-                                                                gray,
-                                                                board)
-            all_charuco_corners.append(charuco_corners)
-            all_charuco_IDs.append(charuco_IDs)
-            # Get matrix shape of grayscale image
-            img_size = gray.shape
+        board_params = CameraCalibration._get_charucoboard_params(board)
+        detections = [None] * len(img_arr)
+        cache_paths = [None] * len(img_arr)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            for i, img in enumerate(img_arr):
+                cache_paths[i] = CameraCalibration._get_charuco_cache_path(cache_dir, board_params, img)
+                detections[i] = CameraCalibration._load_charuco_detection(cache_paths[i])
+        pending = [i for i, detection in enumerate(detections) if detection is None]
+        jobs = [(board_params, img_arr[i]) for i in pending]
+        if workers == 1 or len(jobs) <= 1:
+            new_detections = [_detect_charuco_corners(job) for job in jobs]
+        else:
+            with multiprocessing.Pool(workers, initializer=_init_charuco_worker) as pool:
+                new_detections = pool.map(_detect_charuco_corners, jobs)
+        for i, detection in zip(pending, new_detections):
+            detections[i] = detection
+            if cache_dir is not None:
+                CameraCalibration._store_charuco_detection(cache_paths[i], detection)
+        all_charuco_corners = [charuco_corners for charuco_corners, _ in detections]
+        all_charuco_IDs = [charuco_IDs for _, charuco_IDs in detections]
+        # Get matrix shape of grayscale image
+        img_size = img_arr[-1].shape[:2] if len(img_arr) > 0 else None
         ret_val, camera_matrix, dist_coeffs, _, _ = aruco.calibrateCameraCharuco(all_charuco_corners,
                                                                                  all_charuco_IDs,
                                                                                  board,
@@ -116,6 +335,37 @@ class CameraCalibration:
                                                                                  None)
         return ret_val, camera_matrix, dist_coeffs
 
+class CameraCalibrationAttributeError(Exception):
+    """
+    Raised when an attribute of CameraCalibration is incorrectly assigned
+    """
+
+
+def _init_charuco_worker():
+    """
+    Initializes a worker process of CameraCalibration.get_calibration_matrices. OpenCV is limited to
+    one thread, since the pool already keeps every core busy.
+    """
+    cv2.setNumThreads(1)
+
+
+def _detect_charuco_corners(job):
+    """
+    Detects the Charuco corners of one image, in a worker process of CameraCalibration.get_calibration_matrices.
+    :param job: (board_params, img) tuple, with board params from CameraCalibration._get_charucoboard_params
+    :return: (charuco_corners, charuco_IDs), as returned by Aruco
+    """
+    board_params, img = job
+    board = CameraCalibration._create_charucoboard(*board_params)
+    # Convert to grayscale before performing operations
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    corners, IDs, _ = aruco.detectMarkers(gray, AeroCubeMarker.get_dictionary())
+    _, charuco_corners, charuco_IDs = aruco.interpolateCornersCharuco(corners,
+                                                                       IDs,
+                                                                       gray,
+                                                                       board)
+    return charuco_corners, charuco_IDs
+
 if __name__ == '__main__':
     # Get the calibration matrices for ANDREW_IPHONE calibration/configuration
     board = CameraCalibration.get_charucoboard()
@@ -1,14 +1,17 @@
-import itertools
+import functools
 import math
+import multiprocessing
+from collections import namedtuple
 import cv2
 from cv2 import aruco
 import numpy as np
 import pyquaternion
 from jobs.aeroCubeSignal import ImageEventSignal
 from .aerocubeMarker import AeroCubeMarker, AeroCube
-from .aerocubeMarker import AeroCubeMarker, AeroCubeFace, AeroCube
+from .aerocubeMarker import AeroCubeMarker, AeroCubeFace, AeroCube, MarkerTable
 from .parallel import markerDetectPar as MarkerDetectPar
 from .cameraCalibration import CameraCalibration
+from .rotationConversion import rodrigues_to_quaternions, quaternions_to_rodrigues
 from .settings import ImageProcessingSettings
 
 
@@ -18,32 +21,153 @@ class ImageProcessor:
     Instantiated with an image, provides the ability to process the image in various
     ways, most often by passing it AeroCubeSignal enum objects.
     :cvar _DICTIONARY: Aruco dictionary meant to be accessed only internally
-    :ivar _img_mat: holds the matrix representation of an image
+    :ivar _img_mat: holds the matrix representation of an image, decoded as set by the load policy
     :ivar _dispatcher: dictionary mapping AeroCubeSignals to functions
+    :ivar _tracker: optional MarkerTracker shared between ImageProcessors of sequential frames
+    :ivar _file_path: path (or matrix) the image was loaded from
+    :ivar _reduction: factor by which _img_mat is downscaled from the full resolution image
+    :ivar _color_img_mat: full resolution colour image, only loaded once something is drawn
+    :ivar _fiducial_cache: fiducial markers found in the image, keyed by _detection_key
+    :ivar _aerocube_marker_cache: MarkerTables of markers (with pose) found in the image, keyed by _detection_key
+    :ivar _aerocube_cache: AeroCubes identified in the image, keyed by _detection_key
     """
     _DICTIONARY = AeroCubeMarker.get_dictionary()
 
-    def __init__(self, file_path, cal=CameraCalibration.get_default_calibration()):
+    class LoadPolicy:
+        """
+        Inner class to hold the ways an image can be decoded, constructed with named tuples.
+        Policies should be instances of _Policy with constant-style names (e.g., all upper-case).
+        Decoding only the grayscale image, and letting the decoder downscale it, is much faster and lighter
+        than decoding the full colour image; detection only ever needs the grayscale image.
+        * GRAYSCALE - whether only the grayscale image is decoded
+        * REDUCTION - factor (1, 2, 4 or 8) by which the decoder downscales the image
+        """
+        _Policy = namedtuple('_Policy', 'GRAYSCALE \
+                                         REDUCTION')
+        COLOR = _Policy(GRAYSCALE=False, REDUCTION=1)
+        GRAYSCALE = _Policy(GRAYSCALE=True, REDUCTION=1)
+        GRAYSCALE_REDUCED_2 = _Policy(GRAYSCALE=True, REDUCTION=2)
+        GRAYSCALE_REDUCED_4 = _Policy(GRAYSCALE=True, REDUCTION=4)
+        GRAYSCALE_REDUCED_8 = _Policy(GRAYSCALE=True, REDUCTION=8)
+
+        _IMREAD_FLAGS = {
+            (False, 1): cv2.IMREAD_COLOR,
+            (False, 2): cv2.IMREAD_REDUCED_COLOR_2,
+            (False, 4): cv2.IMREAD_REDUCED_COLOR_4,
+            (False, 8): cv2.IMREAD_REDUCED_COLOR_8,
+            (True, 1): cv2.IMREAD_GRAYSCALE,
+            (True, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+            (True, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+            (True, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8
+        }
+
+        @classmethod
+        def get_imread_flags(cls, policy):
+            """
+            :param policy: load policy
+            :return: flags for cv2.imread decoding images as set by policy
+            """
+            if (policy.GRAYSCALE, policy.REDUCTION) not in cls._IMREAD_FLAGS:
+                raise ValueError("Invalid load policy {}".format(policy))
+            return cls._IMREAD_FLAGS[(policy.GRAYSCALE, policy.REDUCTION)]
+
+        @classmethod
+        def for_marker_pixel_size(cls, expected_marker_px, target_marker_px=60):
+            """
+            Picks the grayscale policy with the largest reduction that still leaves markers large enough to detect.
+            :param expected_marker_px: expected side length of the markers in the full resolution image, in pixels
+            :param target_marker_px: smallest side length markers should keep after downscaling, in pixels
+            :return: load policy
+            """
+            for reduction in (8, 4, 2):
+                if expected_marker_px / reduction >= target_marker_px:
+                    return cls._Policy(GRAYSCALE=True, REDUCTION=reduction)
+            return cls.GRAYSCALE
+
+    def __init__(self, file_path, cal=CameraCalibration.get_default_calibration(), tracker=None,
+                 load_policy=LoadPolicy.COLOR):
         """
         Upon instantiation, use file_path to load the image for this ImageProcessor
-        :param file_path: path to image to be processed
+        :param file_path: path to image to be processed; an already loaded image matrix is used as is,
+            regardless of load_policy
+        :param tracker: optional MarkerTracker; if given, fiducial markers are searched for around
+            those found by the tracker's previous scan, so ImageProcessors sharing it should share a load policy
+        :param load_policy: LoadPolicy setting how the image is decoded; fiducial markers are always
+            reported in full resolution image coordinates
         """
-        self._img_mat = self._load_image(file_path)
-        self._cal = cal
+        self._img_mat = self._load_image(file_path, load_policy)
+        self._fiducial_cache = dict()
+        self._aerocube_marker_cache = dict()
+        self._aerocube_cache = dict()
+        self.cal = cal
+        self._tracker = tracker
+        self._file_path = file_path
+        self._reduction = 1 if isinstance(file_path, np.ndarray) else load_policy.REDUCTION
+        self._color_img_mat = self._img_mat if load_policy == self.LoadPolicy.COLOR else None
 
     @staticmethod
-    def _load_image(file_path):
+    def _load_image(file_path, load_policy=LoadPolicy.COLOR):
         """
         Method used to load an image given the file path (static since it
             does not rely on state).
-        :param file_path: path used to find the image to be processed
+        :param file_path: path used to find the image to be processed; an already loaded image
+            matrix is returned as is
+        :param load_policy: LoadPolicy setting how the image is decoded
         :return: the image specified as a matrix
         """
-        image = cv2.imread(file_path)
+        if isinstance(file_path, np.ndarray):
+            return file_path
+        image = cv2.imread(file_path, ImageProcessor.LoadPolicy.get_imread_flags(load_policy))
         if image is None:
             raise OSError("cv2.imread returned None for path {}".format(file_path))
         return image
 
+    @property
+    def cal(self):
+        return self._cal
+
+    @cal.setter
+    def cal(self, cal):
+        """
+        Set the camera calibration, dropping any poses computed with the previous one.
+        :param cal: camera calibration
+        """
+        self._cal = cal
+        self._aerocube_marker_cache.clear()
+        self._aerocube_cache.clear()
+
+    def _get_image_calibration(self):
+        """
+        Get the calibration matching the resolution of the full resolution image, derived from cal
+        (see CameraCalibration.get_calibration_for_image). With a reduced load policy, the full resolution
+        is taken as that of the decoded image times the reduction.
+        :return: camera calibration for poses found in full resolution image coordinates
+        """
+        img_res = (self._img_mat.shape[0] * self._reduction, self._img_mat.shape[1] * self._reduction)
+        return CameraCalibration.get_calibration_for_image(self._cal, img_res)
+
+    @staticmethod
+    def _detection_key(gpu):
+        """
+        Key under which the results of a scan are memoized: the detection algorithm used, along with
+        its current parameters (the parallel algorithm's can be changed at runtime).
+        :param gpu: whether the parallelized algorithm is used
+        :return: hashable key
+        """
+        if gpu is True:
+            return gpu, tuple(sorted(MarkerDetectPar.params.items()))
+        return gpu, None
+
+    def _get_color_image(self):
+        """
+        Get the full resolution colour image, used to draw on. Decoded on first use, so that scans
+        loaded with a grayscale or reduced policy only pay for it if something is drawn.
+        :return: the colour image as a matrix
+        """
+        if self._color_img_mat is None:
+            self._color_img_mat = self._load_image(self._file_path)
+        return self._color_img_mat
+
     # Aruco entry points
 
     def _find_fiducial_markers(self, gpu=False):
@@ -52,6 +176,8 @@ class ImageProcessor:
         Serves as an abstraction of the aruco method calls
         Note that the default format of the arrays returned by Aruco are a bit cumbersome, and are being translated
         into friendlier formats before being returned.
+        If this ImageProcessor has a tracker, the search is restricted to regions around previously
+        found markers whenever the tracker allows it.
         :param gpu: optional param to attempt to use parallelized algorithm
         :return corners: an array of 3-D arrays
             each element is of the shape (N, 4, 2), where N is the number of detected markers
@@ -60,12 +186,35 @@ class ImageProcessor:
             Note that the Aruco method returns a 1D numpy array of the form [id1, id2, ...],
             and has the shape (N,)
             If no markers found, marker_IDs == None
+        Results are memoized per detection algorithm and parameters, and copies are returned.
+        """
+        key = self._detection_key(gpu)
+        if key not in self._fiducial_cache:
+            if self._tracker is None:
+                corners, marker_IDs = self._detect_fiducial_markers(self._img_mat, gpu=gpu)
+            else:
+                corners, marker_IDs = self._tracker.find_fiducial_markers(
+                    self._img_mat, functools.partial(self._detect_fiducial_markers, gpu=gpu))
+            # Map corners found on a reduced image back to the full resolution image, about pixel centers
+            if self._reduction != 1 and len(corners) > 0:
+                corners = (corners + 0.5) * self._reduction - 0.5
+            self._fiducial_cache[key] = (corners, marker_IDs)
+        corners, marker_IDs = self._fiducial_cache[key]
+        return np.copy(corners), np.copy(marker_IDs)
+
+    @classmethod
+    def _detect_fiducial_markers(cls, img, gpu=False):
+        """
+        Identify fiducial markers in the whole of img.
+        :param img: image (or region of an image) to be searched
+        :param gpu: optional param to attempt to use parallelized algorithm
+        :return: (corners, marker_IDs), formatted as returned by _find_fiducial_markers
         """
         if gpu is True:
-            corners, marker_IDs = MarkerDetectPar.detect_markers_parallel(self._img_mat, dictionary=self._DICTIONARY)
+            corners, marker_IDs = MarkerDetectPar.detect_markers_parallel(img, dictionary=cls._DICTIONARY)
         else:
-            corners, marker_IDs, _ = aruco.detectMarkers(self._img_mat, dictionary=self._DICTIONARY)
-            corners, marker_IDs = self._simplify_fiducial_arrays(corners, marker_IDs)
+            corners, marker_IDs, _ = aruco.detectMarkers(img, dictionary=cls._DICTIONARY)
+            corners, marker_IDs = cls._simplify_fiducial_arrays(corners, marker_IDs)
         return corners, marker_IDs
 
     @staticmethod
@@ -114,7 +263,7 @@ class ImageProcessor:
         :param img:
         :return: img with marker boundaries drawn and markers IDed
         """
-        img = np.copy(self._img_mat) if img is None else img
+        img = np.copy(self._get_color_image()) if img is None else img
         aruco_corners, aruco_ids = self._prepare_fiducial_arrays_for_aruco(corners, marker_IDs)
         return aruco.drawDetectedMarkers(img, aruco_corners, aruco_ids)
 
@@ -127,17 +276,18 @@ class ImageProcessor:
         :param img:
         :return: img held by this ImageProcessor with the drawn axis
         """
-        img = np.copy(self._img_mat) if img is None else img
+        img = np.copy(self._get_color_image()) if img is None else img
+        cal = CameraCalibration.get_calibration_for_image(self._cal, img.shape)
         return aruco.drawAxis(img,
-                              self._cal.CAMERA_MATRIX,
-                              self._cal.DIST_COEFFS,
+                              cal.CAMERA_MATRIX,
+                              cal.DIST_COEFFS,
                               self.quaternion_to_rodrigues(quaternion),
                               tvec,
                               ImageProcessingSettings.get_marker_length())
 
     def draw_aerocube_markers(self):
-        markers = self._find_aerocube_markers()
-        img_w_markers = self.draw_fiducial_markers([m.corners for m in markers], [m.aerocube_ID*AeroCube.NUM_SIDES+m.aerocube_face.value for m in markers])
+        markers = self._find_marker_table()
+        img_w_markers = self.draw_fiducial_markers(np.float32(markers.corners), markers.aerocube_IDs*AeroCube.NUM_SIDES+markers.faces)
         for m in markers:
             result = self.draw_axis(m.quaternion, m.tvec, img=img_w_markers)
             img_w_markers = np.copy(result)
@@ -162,9 +312,10 @@ class ImageProcessor:
         """
         # Get marker length
         marker_length = AeroCubeMarker.MARKER_LENGTH
-        # Get camera calibration
-        camera_matrix = self._cal.CAMERA_MATRIX
-        dist_coeffs = self._cal.DIST_COEFFS
+        # Get camera calibration, for the resolution of the image
+        cal = self._get_image_calibration()
+        camera_matrix = cal.CAMERA_MATRIX
+        dist_coeffs = cal.DIST_COEFFS
         # call aruco function
         rvecs, tvecs = aruco.estimatePoseSingleMarkers(corners,
                                                        marker_length,
@@ -172,35 +323,71 @@ class ImageProcessor:
                                                        dist_coeffs)
         return rvecs, tvecs
 
+    def undistort_image(self):
+        """
+        Corrects the lens distortion of the full resolution colour image. The undistortion maps of each
+        calibration and image size are only built once (see CameraCalibration.get_undistort_maps).
+        :return: undistorted image matrix
+        """
+        img = self._get_color_image()
+        cal = CameraCalibration.get_calibration_for_image(self._cal, img.shape)
+        return CameraCalibration.undistort_image(cal, img)
+
+    def undistort_fiducial_markers(self, corners):
+        """
+        Corrects the lens distortion of marker corners only, which is much cheaper than undistorting the image.
+        :param corners: corners formatted as (N, 4, 2), in full resolution image coordinates
+        :return: undistorted corners, formatted as (N, 4, 2)
+        """
+        return CameraCalibration.undistort_points(self._get_image_calibration(), corners)
+
     # AeroCube identification functions
 
+    def _find_marker_table(self, gpu=False):
+        """
+        Calls a private function to find all fiducial markers, then finds their poses,
+        storing both in a MarkerTable. If there are no markers found, return an empty table.
+        Results are memoized, like those of _find_fiducial_markers, until the calibration changes.
+        :return: MarkerTable of the markers found
+        """
+        key = self._detection_key(gpu)
+        if key not in self._aerocube_marker_cache:
+            corners, ids = self._find_fiducial_markers(gpu=gpu)
+            if len(ids) is 0:
+                markers = MarkerTable()
+            else:
+                rvecs, tvecs = self._find_pose(corners)
+                markers = MarkerTable.from_detections(corners, ids, rodrigues_to_quaternions(rvecs), tvecs)
+            self._aerocube_marker_cache[key] = markers
+        return MarkerTable(np.copy(self._aerocube_marker_cache[key].array))
+
     def _find_aerocube_markers(self, gpu=False):
         """
-        Calls a private function to find all fiducial markers, then constructs
-        AeroCubeMarker objects from those results. If there are no markers found,
-        return an empty array.
+        Constructs AeroCubeMarker objects from the markers found by _find_marker_table.
+        If there are no markers found, return an empty array.
         :return: array of AeroCubeMarker objects; empty if none found
         """
-        corners, ids = self._find_fiducial_markers(gpu=gpu)
-        if len(ids) is 0:
-            return []
-        else:
-            rvecs, tvecs = self._find_pose(corners)
-            quaternions = [self.rodrigues_to_quaternion(r) for r in rvecs]
-            return [AeroCubeMarker(corners, id, q, tvec) for corners, id, q, tvec in zip(corners, ids, quaternions, tvecs)]
+        return self._find_marker_table(gpu=gpu).to_markers()
 
-    def _identify_aerocubes(self):
+    def _identify_aerocubes(self, gpu=False):
         """
         Internal function called when ImP receives a ImageEventSignal.IDENTIFY_AEROCUBES signal.
+        Results are memoized, like those of _find_aerocube_markers.
         :return: array of AeroCube objects; [] if no AeroCubes found
         """
-        markers = self._find_aerocube_markers()
-        markers.sort(key=lambda marker:marker.aerocube_ID)
-        print("IMP: Markers sorted {}".format(markers))
-        aerocubes = list()
-        for aerocube, aerocube_markers in itertools.groupby(markers, lambda m: m.aerocube_ID):
-            aerocubes.append(AeroCube(list(aerocube_markers)))
-        return aerocubes
+        key = self._detection_key(gpu)
+        if key not in self._aerocube_cache:
+            markers = self._find_marker_table(gpu=gpu)
+            aerocubes = list()
+            if len(markers) > 0:
+                # Reduce the poses of all AeroCubes at once; IDs come back sorted, as groups are
+                _, quaternions, tvecs = AeroCube.reduce_marker_table(markers)
+                for (_, aerocube_markers), quaternion, tvec in zip(markers.group_by_aerocube(), quaternions, tvecs):
+                    aerocubes.append(AeroCube(aerocube_markers,
+                                              quaternion=pyquaternion.Quaternion(array=quaternion),
+                                              tvec=tvec))
+            self._aerocube_cache[key] = aerocubes
+        return list(self._aerocube_cache[key])
 
     def identify_markers_for_storage(self):
         # corners, ids = self._find_fiducial_markers()
@@ -244,8 +431,8 @@ class ImageProcessor:
             quaternions[ID] = {k: v for k, v in zip(['w', 'x', 'y', 'z'], cube.quaternion.elements)}
             tvecs[ID] = {k: v for k, v in zip(['x', 'y', 'z'], cube.tvec)}
             distances[ID] = cube.distance
-            num_markers[ID] = len(cube.markers)
-            markers += [m.to_jsonifiable_dict() for m in cube.markers]
+            num_markers[ID] = len(cube.marker_table)
+            markers += cube.marker_table.to_jsonifiable_dicts()
         cube_json_dict = {
             AeroCube.STR_KEY_CUBE_IDS: cube_ids,
             AeroCube.STR_KEY_QUATERNIONS: quaternions,
@@ -259,6 +446,29 @@ class ImageProcessor:
         #print ("IMFS: result{}".format(result))
         #return(result)
        
+    @classmethod
+    def scan_many(cls, images, cal=CameraCalibration.get_default_calibration(), workers=None, chunksize=1,
+                  ordered=True, load_policy=LoadPolicy.COLOR):
+        """
+        Scans many images with identify_markers_for_storage, spread over a pool of worker processes.
+        Each worker is warmed up once (see _init_scan_worker) and then scans the images it is handed.
+        :param images: iterable of image file paths and/or image matrices
+        :param cal: camera calibration used for every image
+        :param workers: number of worker processes; defaults to the number of CPUs
+        :param chunksize: number of images handed to a worker at a time; larger chunks cut inter-process
+            overhead on long batches
+        :param ordered: if True, yield results in the order of images; else, as soon as each is done
+        :param load_policy: LoadPolicy setting how images given as file paths are decoded
+        :return: generator of (index, result) tuples, where index is the position of the image in images
+            and result is what identify_markers_for_storage returns for it
+        """
+        with multiprocessing.Pool(processes=workers,
+                                  initializer=_init_scan_worker,
+                                  initargs=(cal._asdict(), tuple(load_policy))) as pool:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for result in imap(_scan_for_storage, enumerate(images), chunksize):
+                yield result
+
     # Pose and distance functions
 
     def _find_distance(self, corners):
@@ -271,11 +481,10 @@ class ImageProcessor:
         :param cal: calibration information of the camera used for the image
         :return: distance in meters
         """
-        cal = self._cal
+        # Calibration scaled for current resolution (if necessary)
+        cal = self._get_image_calibration()
         # Find m (pixels per unit of measurement)
-        m = (cal.CAMERA_MATRIX[0][0]/cal.FOCAL_LENGTH + cal.CAMERA_MATRIX[1][1]/cal.FOCAL_LENGTH)/2
-        # Scale m for current resolution (if necessary), taking y information from original image and current
-        m_for_res = self._img_mat.shape[0] * (m / cal.IMG_RES[0])
+        m_for_res = (cal.CAMERA_MATRIX[0][0]/cal.FOCAL_LENGTH + cal.CAMERA_MATRIX[1][1]/cal.FOCAL_LENGTH)/2
         # Initialize variables for loop
         dist_results = list()
         marker_size = ImageProcessingSettings.get_marker_length()
@@ -302,16 +511,48 @@ class ImageProcessor:
         """
         Converts an OpenCV rvec object (written in compact Rodrigues notation) into a quaternion.
         http://stackoverflow.com/questions/12933284/rodrigues-into-eulerangles-and-vice-versa
+        To convert many rvecs, use rotationConversion.rodrigues_to_quaternions on all of them at once.
         :param rodrigues: rotation in compact Rodrigues notation (returned by cv2.Rodrigues) as 1x3 array
         :return: rotation represented as quaternion
         """
-        return pyquaternion.Quaternion(matrix=cv2.Rodrigues(rodrigues)[0]).normalised
+        return pyquaternion.Quaternion(array=rodrigues_to_quaternions(rodrigues)[0])
 
     @staticmethod
     def quaternion_to_rodrigues(quaternion):
         """
         Converts quaternion to rvec object (written in compact Rodrigues notation)
         :param quaternion: rotation represented as quaternion
-        :return: rotation represented as rvec in compact Rodrigues notation
+        :return: rotation represented as rvec in compact Rodrigues notation, as a 3x1 array
         """
-        return cv2.Rodrigues(quaternion.rotation_matrix)[0]
+        return quaternions_to_rodrigues(quaternion.elements).reshape(3, 1)
+
+
+# State of each worker process started by ImageProcessor.scan_many
+_scan_worker_cal = None
+_scan_worker_load_policy = None
+
+
+def _init_scan_worker(cal_fields, load_policy_fields):
+    """
+    Initializes a worker process of ImageProcessor.scan_many. OpenCV is limited to one thread, since the
+    pool already keeps every core busy, and the calibration and dictionary decode index are built once.
+    :param cal_fields: fields of the camera calibration as an OrderedDict, since the nested
+        calibration namedtuple cannot be pickled itself
+    :param load_policy_fields: fields of the load policy as a tuple, for the same reason
+    """
+    global _scan_worker_cal, _scan_worker_load_policy
+    cv2.setNumThreads(1)
+    _scan_worker_cal = CameraCalibration.PredefinedCalibration._Calibration(**cal_fields)
+    _scan_worker_load_policy = ImageProcessor.LoadPolicy._Policy(*load_policy_fields)
+    AeroCubeMarker.get_decode_index(ImageProcessor._DICTIONARY)
+
+
+def _scan_for_storage(indexed_image):
+    """
+    Scans one image in a worker process of ImageProcessor.scan_many.
+    :param indexed_image: (index, image) tuple, with image as a file path or image matrix
+    :return: (index, result) tuple, with the result of identify_markers_for_storage
+    """
+    index, image = indexed_image
+    imp = ImageProcessor(image, cal=_scan_worker_cal, load_policy=_scan_worker_load_policy)
+    return index, imp.identify_markers_for_storage()
@@ -0,0 +1,149 @@
+import itertools
+import numpy as np
+from .aerocubeMarker import AeroCube
+
+
+class MarkerTracker:
+    """
+    Carries fiducial marker detections over from one scan to the next, so that repeated
+    scans of the same scene only search expanded regions of interest (ROIs) around the
+    previously found markers instead of the full frame.
+    A full-frame search is run when there is nothing to track, every full_scan_interval
+    scans, and whenever a tracked marker is lost.
+    :ivar _roi_expansion_rate: how far each ROI extends past its marker's bounding box,
+        as a fraction of the larger bounding box side
+    :ivar _full_scan_interval: maximum number of consecutive ROI-only scans
+    :ivar _corners: corners of the markers found by the last scan, shape (N, 4, 2), in the coordinates
+        of the image searched (reduced, for an ImageProcessor with a reduced LoadPolicy)
+    :ivar _ids: fiducial marker IDs of the markers found by the last scan, shape (N,)
+    :ivar _scans_since_full_scan: number of ROI-only scans since the last full-frame scan
+    """
+
+    def __init__(self, roi_expansion_rate=0.5, full_scan_interval=10):
+        """
+        :param roi_expansion_rate: fraction of a marker's size added on each side of its ROI
+        :param full_scan_interval: number of ROI-only scans allowed between two full-frame scans
+        """
+        if roi_expansion_rate < 0:
+            raise MarkerTrackerAttributeError("roi_expansion_rate must be non-negative")
+        if full_scan_interval < 1:
+            raise MarkerTrackerAttributeError("full_scan_interval must be at least 1")
+        self._roi_expansion_rate = roi_expansion_rate
+        self._full_scan_interval = full_scan_interval
+        self.reset()
+
+    @property
+    def corners(self):
+        return self._corners
+
+    @property
+    def ids(self):
+        return self._ids
+
+    def reset(self):
+        """
+        Forget all tracked markers, forcing the next scan to search the full frame.
+        """
+        self._corners = np.empty((0, 4, 2), dtype=np.float32)
+        self._ids = np.empty((0,), dtype=int)
+        self._scans_since_full_scan = 0
+
+    def seed(self, markers, reduction=1):
+        """
+        Track the markers found by a previous scan.
+        :param markers: array of AeroCubeMarker objects, whose corners are in full resolution coordinates
+        :param reduction: factor by which the images to be searched are downscaled from the full
+            resolution, i.e. the LoadPolicy.REDUCTION of the ImageProcessors using this tracker
+        """
+        corners = np.array([m.corners for m in markers], dtype=np.float32).reshape(-1, 4, 2)
+        # The inverse of ImageProcessor's mapping to the full resolution image, about pixel centers
+        if reduction != 1:
+            corners = (corners + 0.5) / reduction - 0.5
+        self._update(corners,
+                     np.array([m.aerocube_ID*AeroCube.NUM_SIDES + m.aerocube_face.value for m in markers],
+                              dtype=int))
+
+    def _update(self, corners, ids):
+        self._corners = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2)
+        self._ids = np.asarray(ids, dtype=int).reshape(-1)
+
+    def needs_full_scan(self):
+        """
+        :return: True if the next scan has to search the full frame
+        """
+        return len(self._ids) == 0 or self._scans_since_full_scan >= self._full_scan_interval
+
+    def get_regions_of_interest(self, img_shape):
+        """
+        Find the regions of the image to search for the tracked markers. Each marker's bounding box is
+        expanded by _roi_expansion_rate on every side and clamped to the image; overlapping regions are
+        merged so that no marker is searched for twice.
+        :param img_shape: shape of the image to be searched
+        :return: array of regions, each represented as [x_min, y_min, x_max, y_max) of shape (4,)
+        """
+        height, width = img_shape[:2]
+        mins = self._corners.min(axis=1)
+        maxs = self._corners.max(axis=1)
+        margins = self._roi_expansion_rate * (maxs - mins).max(axis=1, keepdims=True)
+        mins = np.floor(mins - margins)
+        maxs = np.ceil(maxs + margins) + 1
+        regions = np.hstack((mins, maxs)).astype(int)
+        regions = np.clip(regions, 0, [width, height, width, height])
+        return self._merge_regions(regions)
+
+    @staticmethod
+    def _merge_regions(regions):
+        """
+        Repeatedly merge overlapping regions into their common bounding box until no two regions overlap.
+        :param regions: regions represented as [x_min, y_min, x_max, y_max), shape (N, 4)
+        :return: non-overlapping regions, shape (M, 4) with M <= N
+        """
+        merged = list(regions)
+        merging = True
+        while merging:
+            merging = False
+            for i, j in itertools.combinations(range(len(merged)), 2):
+                if np.all(merged[i][:2] < merged[j][2:]) and np.all(merged[j][:2] < merged[i][2:]):
+                    merged[i] = np.hstack((np.minimum(merged[i][:2], merged[j][:2]),
+                                           np.maximum(merged[i][2:], merged[j][2:])))
+                    del merged[j]
+                    # the grown region may now overlap regions it was already compared with
+                    merging = True
+                    break
+        return np.array(merged, dtype=int).reshape(-1, 4)
+
+    def find_fiducial_markers(self, img, detect):
+        """
+        Find fiducial markers in img, only searching around tracked markers where possible.
+        :param img: image to be searched
+        :param detect: function taking an image and returning (corners, IDs) as
+            ImageProcessor._find_fiducial_markers does, i.e. shapes (N, 4, 2) and (N,)
+        :return corners: corners of the markers found, shape (N, 4, 2)
+        :return marker_IDs: fiducial marker IDs of the markers found, shape (N,)
+        """
+        if not self.needs_full_scan():
+            found_corners = list()
+            found_ids = list()
+            for x_min, y_min, x_max, y_max in self.get_regions_of_interest(img.shape):
+                corners, ids = detect(img[y_min:y_max, x_min:x_max])
+                if len(ids) > 0:
+                    found_corners.append(np.asarray(corners, dtype=np.float32) + np.float32([x_min, y_min]))
+                    found_ids.append(np.asarray(ids, dtype=int))
+            if len(found_ids) > 0:
+                corners = np.concatenate(found_corners)
+                ids = np.concatenate(found_ids)
+                # a scan only counts as tracked if no previously found marker was lost
+                if np.all(np.isin(self._ids, ids)):
+                    self._scans_since_full_scan += 1
+                    self._update(corners, ids)
+                    return corners, ids
+        corners, ids = detect(img)
+        self._scans_since_full_scan = 0
+        self._update(corners, ids)
+        return corners, ids
+
+
+class MarkerTrackerAttributeError(Exception):
+    """
+    Raised when MarkerTracker is given an invalid attribute.
+    """
@@ -1,5 +1,6 @@
 import os
 import math
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 from cv2 import aruco
 import numpy as np
@@ -36,6 +37,8 @@ class MarkerDetectPar:
     maxErroneousBitsInBorderRate = 'maxErroneousBitsInBorderRate'
     minOtsuStdDev = 'minOtsuStdDev'
     errorCorrectionRate = 'errorCorrectionRate'
+    pyramidLevels = 'pyramidLevels'
+    pyramidCornerTolerance = 'pyramidCornerTolerance'
 
     # Parameter dictionary/values
     params = {
@@ -58,9 +61,15 @@ class MarkerDetectPar:
         perspectiveRemoveIgnoredMarginPerCell:  0.13,
         maxErroneousBitsInBorderRate:           0.35,
         minOtsuStdDev:                          5.0,
-        errorCorrectionRate:                    0.6
+        errorCorrectionRate:                    0.6,
+        pyramidLevels:                          0,
+        pyramidCornerTolerance:                 0.5
     }
 
+    # Thread pool shared by all detections, used to threshold and find contours at several scales at once
+    _threshold_pool = None
+    _threshold_pool_workers = os.cpu_count()
+
     # HELPER FUNCTIONS/OBJECTS
 
     class MarkerDetectParException(Exception):
@@ -90,6 +99,73 @@ class MarkerDetectPar:
         return cv2.adaptiveThreshold(gray, maxValue, adaptiveMethod=cv2.ADAPTIVE_THRESH_MEAN_C,
                                      thresholdType=cv2.THRESH_BINARY_INV, blockSize=winSize, C=constant)
 
+    @staticmethod
+    def _integral_image(gray, maxWinSize):
+        """
+        Computes one integral image of a grayscale image that _threshold_integral can reuse for every window size up
+        to maxWinSize. The image is first padded by replicating its border, as OpenCV's box filter does.
+        Sums are kept modulo 2^32 (np.uint32), so that they never overflow: the sum of any window is still exact when
+        computed with the same modular arithmetic, since it is far below 2^32.
+        :param gray: grayscale image to be thresholded
+        :param maxWinSize: largest window size that will be used
+        :return: (integral, pad) tuple, with the integral image and the number of pixels padded on each side
+        """
+        pad = (maxWinSize + 1 - maxWinSize % 2) // 2
+        padded = cv2.copyMakeBorder(gray, pad, pad, pad, pad, cv2.BORDER_REPLICATE)
+        return cv2.integral(padded, sdepth=cv2.CV_64F).astype(np.int64).astype(np.uint32), pad
+
+    @classmethod
+    def _threshold_integral(cls, gray, integral, pad, winSize, constant=params[adaptiveThreshConstant]):
+        """
+        Equivalent of _threshold that derives the local means from a precomputed integral image, bit-exact with
+        cv2.adaptiveThreshold using ADAPTIVE_THRESH_MEAN_C and THRESH_BINARY_INV.
+        A pixel is set if src - round(sum / winSize^2) <= -floor(constant); as sum / winSize^2 is never halfway between
+        two integers, this is compared exactly in integers as 2 * sum >= (2 * (src + floor(constant)) - 1) * winSize^2.
+        :param gray: image to be thresholded; must be single-channel (i.e., grayscale) image
+        :param integral: integral image of gray, as returned by _integral_image
+        :param pad: padding of the integral image, as returned by _integral_image
+        :param winSize: size of pixel neighborhood about a pixel; even sizes are increased by one, as in _threshold
+        :param constant: used to weight the mean of the threshold calculations of a given pixel and its neighborhood
+        :return: thresholded image
+        """
+        assert winSize >= 3
+        if winSize % 2 == 0:
+            winSize += 1
+        radius = winSize // 2
+        assert radius <= pad
+        rows, cols = gray.shape
+        low, high = pad - radius, pad + radius + 1
+        # Sum of each pixel's window, with modular arithmetic (see _integral_image)
+        window_sum = np.subtract(integral[high:high + rows, high:high + cols], integral[low:low + rows, high:high + cols])
+        np.subtract(window_sum, integral[high:high + rows, low:low + cols], out=window_sum)
+        np.add(window_sum, integral[low:low + rows, low:low + cols], out=window_sum)
+        window_sum = window_sum.view(np.int32)
+        np.left_shift(window_sum, 1, out=window_sum)
+        bound = gray.astype(np.int32) * 2 + (2 * math.floor(constant) - 1)
+        np.multiply(bound, winSize * winSize, out=bound)
+        thresh = np.greater_equal(window_sum, bound).view(np.uint8)
+        maxValue = 255
+        return np.multiply(thresh, maxValue, out=thresh)
+
+    @classmethod
+    def _get_threshold_pool(cls):
+        """
+        Get the thread pool used to process the thresholding scales concurrently, creating it on first use.
+        OpenCV releases the GIL during thresholding and contour finding, so the scales run in parallel.
+        :return: ThreadPoolExecutor owned by the detector
+        """
+        if cls._threshold_pool is None:
+            cls._threshold_pool = ThreadPoolExecutor(max_workers=cls._threshold_pool_workers)
+        return cls._threshold_pool
+
+    @classmethod
+    def _reset_threshold_pool(cls):
+        """
+        Drops the thread pool without shutting it down, in a forked child: the pool's threads are not copied by
+        fork, so work submitted to it would never run, and its locks may be held. A new pool is created on first use.
+        """
+        cls._threshold_pool = None
+
     @staticmethod
     def _cuda_threshold(gray, winSize, constant=params[adaptiveThreshConstant]):
         """
@@ -111,7 +187,10 @@ class MarkerDetectPar:
     def detect_markers_parallel(cls, img, dictionary=FiducialMarker.get_dictionary()):
         """
         Public entry point to algorithm. Delegates the steps of the algorithms to several helper functions.
-        :param img: image that might contain markers; should not be a grayscale image
+        If params[pyramidLevels] is set, candidates are found on an image downscaled that many times by half and mapped
+        back up; their bits are still extracted from the full resolution image, and their corners are refined on it
+        whenever the error of the mapping can exceed params[pyramidCornerTolerance].
+        :param img: image that might contain markers; either a BGR or a grayscale image
         :param dictionary: Aruco dictionary to identify markers from; defaults to the dictionary set in FiducialMarker
         :return:
         """
@@ -119,10 +198,12 @@ class MarkerDetectPar:
         assert img is not None
 
         # Convert to grayscale (if necessary)
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray_img = img if len(img.shape) == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
-        # ~~STEP 1~~: Detect marker candidates
-        candidates, contours = cls._detect_candidates(gray_img)
+        # ~~STEP 1~~: Detect marker candidates, on a downscaled image if pyramid levels are set
+        levels = cls.params[cls.pyramidLevels]
+        candidates, contours = cls._detect_candidates(cls._pyramid_down(gray_img, levels))
+        candidates = cls._pyramid_up_candidates(candidates, levels)
 
         # ~~STEP 2~~: Identify marker candidates, filtering out candidates without properly set bits
         accepted, ids, rejected = cls._identify_candidates(gray_img, candidates, dictionary)
@@ -131,10 +212,60 @@ class MarkerDetectPar:
         filtered_candidates, ids = cls._filter_detected_markers(accepted, ids)
 
         # ~~STEP 4~~: Do corner refinement (if necessary)
-        # Params default to False, so this is going to stay un-implemented!
+        # Without pyramid levels, the corners carry no mapping error to refine away
+        if cls.params[cls.doCornerRefinement] or \
+                (levels > 0 and 2 ** levels / 2 > cls.params[cls.pyramidCornerTolerance]):
+            filtered_candidates = cls._refine_corners(gray_img, filtered_candidates, levels)
 
         return filtered_candidates, ids
 
+    @staticmethod
+    def _pyramid_down(gray, levels):
+        """
+        Downscales a grayscale image by half the given number of times, with Gaussian pyramid steps.
+        :param gray: grayscale image to be downscaled
+        :param levels: number of pyramid levels to go down; 0 returns gray itself
+        :return: downscaled grayscale image
+        """
+        assert levels >= 0
+        for _ in range(levels):
+            gray = cv2.pyrDown(gray)
+        return gray
+
+    @staticmethod
+    def _pyramid_up_candidates(candidates, levels):
+        """
+        Maps the corners of candidates found in an image downscaled by _pyramid_down back to the full resolution image.
+        Each pyramid step halves the image about pixel centers, so a point x maps back to (x + 0.5) * 2 - 0.5.
+        :param candidates: list of candidates, each of shape (4, 2) and type np.float32
+        :param levels: number of pyramid levels the candidates were found at
+        :return: list of candidates in full resolution image coordinates
+        """
+        if levels == 0:
+            return candidates
+        scale = 2 ** levels
+        return [((c + 0.5) * scale - 0.5).astype(np.float32) for c in candidates]
+
+    @classmethod
+    def _refine_corners(cls, gray, candidates, levels=0):
+        """
+        Refines the corners of all markers to sub-pixel accuracy with cv2.cornerSubPix.
+        The search window is widened for markers found on a downscaled image, so it covers the error of their corners.
+        :param gray: full resolution grayscale image
+        :param candidates: array of markers, each of shape (4, 2) and type np.float32
+        :param levels: number of pyramid levels the markers were found at
+        :return: list of refined markers, each of shape (4, 2), as returned without refinement
+        """
+        assert cls.params[cls.cornerRefinementWinSize] > 0
+        assert cls.params[cls.cornerRefinementMaxIterations] > 0 and cls.params[cls.cornerRefinementMinAccuracy] > 0
+        if len(candidates) == 0:
+            return candidates
+        corners = np.array(candidates, dtype=np.float32).reshape(-1, 1, 2)
+        winSize = max(cls.params[cls.cornerRefinementWinSize], 2 ** levels)
+        criteria = (cv2.TERM_CRITERIA_MAX_ITER | cv2.TERM_CRITERIA_EPS,
+                    cls.params[cls.cornerRefinementMaxIterations], cls.params[cls.cornerRefinementMinAccuracy])
+        corners = cv2.cornerSubPix(gray, corners, (winSize, winSize), (-1, -1), criteria)
+        return list(corners.reshape(-1, 4, 2))
 
     # ~~STEP 1 FUNCTIONS~~
 
@@ -176,10 +307,15 @@ class MarkerDetectPar:
         candidates = list()
         contours = list()
 
-        # Threshold at different scales
-        for i in range(int(nScales)):
-            scale = cls.params[cls.adaptiveThreshWinSizeMin] + i * cls.params[cls.adaptiveThreshWinSizeStep]
-            cand, cont = cls._find_marker_contours(cls._threshold(gray, scale, cls.params[cls.adaptiveThreshConstant]))
+        # Threshold at different scales concurrently, all deriving their local means from the same integral image;
+        # map returns the results in scale order
+        scales = [cls.params[cls.adaptiveThreshWinSizeMin] + i * cls.params[cls.adaptiveThreshWinSizeStep]
+                  for i in range(int(nScales))]
+        integral, pad = cls._integral_image(gray, max(scales))
+        n = len(scales)
+        results = cls._get_threshold_pool().map(cls._find_marker_contours_at_scale,
+                                                [gray] * n, scales, [integral] * n, [pad] * n)
+        for cand, cont in results:
             if len(cand) > 0:
                 for j in range(len(cand)):
                     candidates.append(cand[j])
@@ -187,6 +323,21 @@ class MarkerDetectPar:
 
         return np.squeeze(candidates), contours
 
+    @classmethod
+    def _find_marker_contours_at_scale(cls, gray, scale, integral=None, pad=0):
+        """
+        Thresholds the grayscale image with the given window size and finds the candidate marker contours in it.
+        :param gray: grayscale image to be analyzed
+        :param scale: window size used for thresholding
+        :param integral: integral image of gray, as returned by _integral_image; if None, _threshold is used
+        :param pad: padding of the integral image, as returned by _integral_image
+        :return: (candidates, contours)
+        """
+        constant = cls.params[cls.adaptiveThreshConstant]
+        if integral is None:
+            return cls._find_marker_contours(cls._threshold(gray, scale, constant))
+        return cls._find_marker_contours(cls._threshold_integral(gray, integral, pad, scale, constant))
+
     @classmethod
     def _find_marker_contours(cls, thresh):
         """
@@ -287,46 +438,83 @@ class MarkerDetectPar:
         """
         Modifies the given arrays of markers, filtering out candidate markers that are
         too close to each other. Does not modify the original params.
+        Only candidates whose centroids fall in neighbouring cells of a uniform grid are compared, since two candidates
+        can only be too close if their centroids are closer than the largest allowed marker distance.
         :param candidates: list of candidates, each represented by four Points, with values Point(x,y)
         :param contours: list of contours, with points stored as ints
         :return: candidates, contours filtered by conditions described in comments
         """
         minMarkerDistanceRate = cls.params[cls.minMarkerDistanceRate]
         assert minMarkerDistanceRate >= 0
-        # Initialize array to keep track of markers to remove
-        to_remove = [False]*len(candidates)
-        # Compare mean square distance between corner points for each candidate (squared to avoid negatives)
+        # With fewer than two candidates (or a zero distance rate), no pair can be too close
+        if len(candidates) < 2 or minMarkerDistanceRate == 0:
+            return list(candidates), list(contours)
+        corners = np.asarray(candidates).reshape(-1, 4, 2)
+        perimeters = np.array([len(c) for c in contours], dtype=np.float64)
+        # Mean square distance below minMarkerDistancePixels^2 implies the centroids are closer than
+        # minMarkerDistancePixels, so the grid cells only have to be as large as the largest such distance
+        centroids = np.mean(corners, axis=1, dtype=np.float64)
+        pairs_i, pairs_j = cls._find_neighbouring_pairs(centroids, perimeters.max() * minMarkerDistanceRate)
+        # Compare mean square distance between corner points for each candidate pair (squared to avoid negatives)
+        # Because the corners (guaranteed clockwise) of i can have 4 different combinations with the
+        # corners of j, we must repeat this process 4 times
+        minMarkerDistanceSq = np.square(np.minimum(perimeters[pairs_i], perimeters[pairs_j]) * minMarkerDistanceRate)
+        too_close = np.zeros(len(pairs_i), dtype=bool)
+        for fc in range(4):
+            diff = (np.roll(corners[pairs_i], -fc, axis=1) - corners[pairs_j]).astype(np.float64)
+            sq = np.square(diff[:, :, 0]) + np.square(diff[:, :, 1])
+            distSq = (((sq[:, 0] + sq[:, 1]) + sq[:, 2]) + sq[:, 3]) / 4.0  # Take the mean distance squared
+            too_close |= distSq < minMarkerDistanceSq
         # If a candidate's corner is too close (has a mean square distance too low) to the other candidate's corners,
-        # remove the smaller candidate of the pair
-        for i in range(len(candidates)):
-            for j in range(i+1, len(candidates)):
-                minimumPerimeter = float(min(len(contours[i]), len(contours[j])))
-                minMarkerDistancePixels = minimumPerimeter * minMarkerDistanceRate
-                # Because the corners (guaranteed clockwise) of i can have 4 different combinations with the
-                # corners of j, we must repeat this process 4 times
-                for fc in range(4):
-                    # For each corner in candidate i, compute mean square distance to candidate j
-                    distSq = 0
-                    for c in range(4):
-                        modC = (fc + c) % 4
-                        distSq += math.pow(candidates[i][modC][0] - candidates[j][c][0], 2) + \
-                                  math.pow(candidates[i][modC][1] - candidates[j][c][1], 2)
-                    distSq /= 4.0  # Take the mean distance squared
-                    # If mean square distance too low, mark for deletion
-                    if distSq < math.pow(minMarkerDistancePixels, 2):
-                        # If one marker already marked for deletion, do nothing
-                        if to_remove[i] or to_remove[j]:
-                            break
-                        # Else, mark one with smaller contour perimeter for deletion
-                        elif len(contours[i]) > len(contours[j]):
-                            to_remove[j] = True
-                        else:
-                            to_remove[i] = True
+        # remove the smaller candidate of the pair; pairs are visited in (i, j) order, as the removals depend on it
+        to_remove = [False]*len(candidates)
+        for i, j in zip(pairs_i[too_close].tolist(), pairs_j[too_close].tolist()):
+            # If one marker already marked for deletion, do nothing
+            if to_remove[i] or to_remove[j]:
+                continue
+            # Else, mark one with smaller contour perimeter for deletion
+            elif perimeters[i] > perimeters[j]:
+                to_remove[j] = True
+            else:
+                to_remove[i] = True
         # Add marker info to out arrays only if not marked for removal
         cand_out = [c for i, c in enumerate(candidates) if to_remove[i] is False]
         cont_out = [c for i, c in enumerate(contours) if to_remove[i] is False]
         return cand_out, cont_out
 
+    @staticmethod
+    def _find_neighbouring_pairs(points, radius):
+        """
+        Finds all index pairs (i, j), i < j, of points that are closer than radius to each other (and possibly a few
+        that are farther apart), by bucketing the points in a uniform grid with cells radius wide and only pairing
+        points in the same or adjacent cells.
+        :param points: array of 2-dimensional points, with shape (N, 2)
+        :param radius: distance below which two points must be paired
+        :return: (pairs_i, pairs_j) arrays of indices, sorted by i and then j
+        """
+        # Pad the cell size slightly, so rounding can never push a close pair two cells apart
+        cell_size = max(radius * (1. + 1e-6), 1e-6)
+        cells = np.floor(points / cell_size).astype(np.int64)
+        grid = dict()
+        for index, cell in enumerate(map(tuple, cells)):
+            grid.setdefault(cell, list()).append(index)
+        grid = {cell: np.array(members) for cell, members in grid.items()}
+        pairs_i, pairs_j = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        for (x, y), members in grid.items():
+            # Same cell, then the half of the adjacent cells "after" this one, so each cell pair is visited once
+            first, second = np.triu_indices(len(members), k=1)
+            pairs_i.append(members[first])
+            pairs_j.append(members[second])
+            for dx, dy in ((1, -1), (1, 0), (1, 1), (0, 1)):
+                neighbours = grid.get((x + dx, y + dy))
+                if neighbours is not None:
+                    pairs_i.append(np.repeat(members, len(neighbours)))
+                    pairs_j.append(np.tile(neighbours, len(members)))
+        pairs_i, pairs_j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+        pairs_i, pairs_j = np.minimum(pairs_i, pairs_j), np.maximum(pairs_i, pairs_j)
+        order = np.lexsort((pairs_j, pairs_i))
+        return pairs_i[order], pairs_j[order]
+
     # ~~STEP 2 FUNCTIONS~~
 
     @classmethod
@@ -352,9 +540,13 @@ class MarkerDetectPar:
         accepted = list()
         ids = list()
         rejected = list()
-        # Analyze each candidate
+        if len(candidates) == 0:
+            return accepted, ids, rejected
+        # Extract the bits of all candidates at once, then analyze each candidate
+        candidates_bits = cls._extract_bits_batch(gray, candidates)
+        decode_index = FiducialMarker.get_decode_index(dictionary)
         for i in range(len(candidates)):
-            valid, corners, cand_id = cls._identify_one_candidate(dictionary, gray, candidates[i])
+            valid, corners, cand_id = cls._identify_from_bits(decode_index, candidates_bits[i], candidates[i])
             if valid:
                 accepted.append(corners)
                 ids.append(cand_id)
@@ -381,13 +573,27 @@ class MarkerDetectPar:
                 else, if candidate identified invalid, original corners returned
             * id - id of the identified candidate; if invalid candidate, set to -1
         """
-        markerBorderBits = cls.params[cls.markerBorderBits]
         assert len(corners) is 4
         assert gray is not None
+        decode_index = FiducialMarker.get_decode_index(dictionary)
+        return cls._identify_from_bits(decode_index, cls._extract_bits(gray, corners), corners)
+
+    @classmethod
+    def _identify_from_bits(cls, dictionary, candidate_bits, corners):
+        """
+        Given the extracted bits of a candidate, use the dictionary to identify the candidate. If successful, reverse
+        any rotation applied to the ordering of the corner points and return with the ID.
+        Else, return False, and return original corners and invalid ID.
+        :param dictionary: dictionary, or its MarkerDecodeIndex (see FiducialMarker.get_decode_index), used to identify
+            the extracted bits
+        :param candidate_bits: bits (incl. border) extracted from the candidate, as returned by _extract_bits
+        :param corners: corner points of the candidate with shape (4,2)
+        :return: (valid_candidate, corners, id), as described in _identify_one_candidate
+        """
+        markerBorderBits = cls.params[cls.markerBorderBits]
         assert markerBorderBits > 0
 
-        # Get bits, and ensure there are not too many erroneous bits
-        candidate_bits = cls._extract_bits(gray, corners)
+        # Ensure there are not too many erroneous bits
         max_errors_in_border = int(dictionary.markerSize * dictionary.markerSize * markerBorderBits)
         border_errors = cls._get_border_errors(candidate_bits, dictionary.markerSize, markerBorderBits)
         if border_errors > max_errors_in_border:
@@ -473,6 +679,169 @@ class MarkerDetectPar:
                     bits[y][x] = 1
         return bits
 
+    @classmethod
+    def _extract_bits_batch(cls, gray, candidates):
+        """
+        Batched equivalent of _extract_bits, extracting the bits of all given candidates at once.
+        The perspective transformations of all candidates are computed together, every perspective-removed marker is
+        sampled from the grayscale image with one vectorized lookup (matching cv2.warpPerspective with INTER_NEAREST),
+        and the Otsu thresholding and per-cell pixel counts are done with array operations over the whole batch.
+        :param gray: grayscale image containing the candidates
+        :param candidates: list of candidates' corner points, each with shape (4, 2); must be in clockwise order
+        :return: 3-dimensional array of binary values, with shape (len(candidates), markerSizeWithBorders,
+            markerSizeWithBorders), holding the bits of each candidate as returned by _extract_bits
+        """
+        # Initialize variables
+        markerSize = FiducialMarker.get_marker_size()  # size of inner region of marker (area containing ID information)
+        markerBorderBits = cls.params[cls.markerBorderBits]  # size of marker border
+        cellSize = cls.params[cls.perspectiveRemovePixelPerCell]  # size of "cell", area consisting of one bit of info.
+        cellMarginRate = cls.params[cls.perspectiveRemoveIgnoredMarginPerCell]  # cell margin
+        minStdDevOtsu = cls.params[cls.minOtsuStdDev]  # min. std. dev. needed to run Otsu thresholding
+
+        # Run assertions
+        assert len(gray.shape) == 2
+        assert markerBorderBits > 0 and cellSize > 0 and cellMarginRate >= 0 and cellMarginRate <= 1
+        assert minStdDevOtsu >= 0
+        corners = np.asarray(candidates, dtype=np.float32).reshape(-1, 4, 2)
+        n_candidates = len(corners)
+
+        # Determine new dimensions of perspective-removed markers
+        markerSizeWithBorders = markerSize + 2*markerBorderBits
+        cellMarginPixels = int(cellMarginRate * cellSize)
+        resultImgSize = int(markerSizeWithBorders * cellSize)
+        resultImgCorners = np.array([[0                , 0                ],
+                                     [resultImgSize - 1, 0                ],
+                                     [resultImgSize - 1, resultImgSize - 1],
+                                     [0                , resultImgSize - 1]], dtype=np.float32)
+
+        # Get transformations and sample all perspective-removed markers from the original image
+        transformations = cls._get_perspective_transforms(corners, resultImgCorners).astype(np.float32)
+        result_imgs = cls._warp_perspective_nearest(gray, transformations, resultImgSize)
+
+        # Mean and standard deviation of the inner regions, computed as cv2.meanStdDev does
+        inner_regions = result_imgs[:, int(cellSize/2):int(-cellSize/2), int(cellSize/2):int(-cellSize/2)]
+        inner_regions = inner_regions.reshape(n_candidates, -1).astype(np.int64)
+        mean = np.sum(inner_regions, axis=1) / inner_regions.shape[1]
+        stddev = np.sqrt(np.maximum(np.sum(np.square(inner_regions), axis=1) / inner_regions.shape[1] - mean*mean, 0))
+
+        # Threshold using Otsu, then count the white pixels of each cell, excluding the margin pixels
+        thresholds = cls._otsu_thresholds(result_imgs)
+        result_imgs = (result_imgs > thresholds[:, np.newaxis, np.newaxis]).reshape(
+            n_candidates, markerSizeWithBorders, cellSize, markerSizeWithBorders, cellSize)
+        squares = result_imgs[:, :, cellMarginPixels:cellSize - cellMarginPixels,
+                              :, cellMarginPixels:cellSize - cellMarginPixels]
+        square_size = (cellSize - 2 * cellMarginPixels) ** 2
+        bits = (np.sum(squares, axis=(2, 4)) > (square_size / 2)).astype(np.int8)
+
+        # If standard deviation not enough for Otsu thresholding, all bits are probably the same color
+        low_stddev = stddev < minStdDevOtsu
+        bits[low_stddev] = (mean[low_stddev] > 127)[:, np.newaxis, np.newaxis]
+        return bits
+
+    @staticmethod
+    def _get_perspective_transforms(src, dst):
+        """
+        Batched equivalent of cv2.getPerspectiveTransform, computing the transformation matrix from each set of four
+        source points to the same four destination points by solving all the linear systems at once.
+        If the system of a set of source points is singular, its transformation is left as zero (except the last
+        entry), as cv2.getPerspectiveTransform does.
+        :param src: source points, with shape (N, 4, 2)
+        :param dst: destination points, with shape (4, 2)
+        :return: transformation matrices, with shape (N, 3, 3) and type np.float64
+        """
+        src = np.asarray(src, dtype=np.float64)
+        dst = np.asarray(dst, dtype=np.float64)
+        x, y = src[:, :, 0], src[:, :, 1]
+        u, v = dst[:, 0], dst[:, 1]
+        # Build the 8x8 systems solved by OpenCV, one per set of source points
+        a = np.zeros((len(src), 8, 8))
+        a[:, :4, 0], a[:, :4, 1], a[:, :4, 2] = x, y, 1
+        a[:, 4:, 3], a[:, 4:, 4], a[:, 4:, 5] = x, y, 1
+        a[:, :4, 6], a[:, :4, 7] = -x * u, -y * u
+        a[:, 4:, 6], a[:, 4:, 7] = -x * v, -y * v
+        b = np.tile(np.concatenate((u, v)), (len(src), 1))
+        solvable = np.linalg.det(a) != 0
+        solution = np.zeros((len(src), 8))
+        if np.any(solvable):
+            solution[solvable] = np.linalg.solve(a[solvable], b[solvable][:, :, np.newaxis])[:, :, 0]
+        return np.concatenate((solution, np.ones((len(src), 1))), axis=1).reshape(-1, 3, 3)
+
+    @staticmethod
+    def _warp_perspective_nearest(gray, transformations, size):
+        """
+        Batched equivalent of cv2.warpPerspective with INTER_NEAREST and a constant (black) border, sampling one
+        square image per transformation from gray through a single vectorized lookup.
+        Like OpenCV, the transformations are inverted in double precision, and the source coordinate of every
+        destination pixel is rounded to the nearest integer.
+        :param gray: grayscale image to sample from
+        :param transformations: perspective transformation matrices, with shape (N, 3, 3)
+        :param size: side length of each destination image, in pixels
+        :return: sampled images, with shape (N, size, size) and the type of gray
+        """
+        m = np.asarray(transformations, dtype=np.float64)
+        # Invert each matrix with the closed form used by OpenCV for 3x3 matrices (zero if singular)
+        inv = np.stack([m[:, 1, 1] * m[:, 2, 2] - m[:, 1, 2] * m[:, 2, 1],
+                        m[:, 0, 2] * m[:, 2, 1] - m[:, 0, 1] * m[:, 2, 2],
+                        m[:, 0, 1] * m[:, 1, 2] - m[:, 0, 2] * m[:, 1, 1],
+                        m[:, 1, 2] * m[:, 2, 0] - m[:, 1, 0] * m[:, 2, 2],
+                        m[:, 0, 0] * m[:, 2, 2] - m[:, 0, 2] * m[:, 2, 0],
+                        m[:, 0, 2] * m[:, 1, 0] - m[:, 0, 0] * m[:, 1, 2],
+                        m[:, 1, 0] * m[:, 2, 1] - m[:, 1, 1] * m[:, 2, 0],
+                        m[:, 0, 1] * m[:, 2, 0] - m[:, 0, 0] * m[:, 2, 1],
+                        m[:, 0, 0] * m[:, 1, 1] - m[:, 0, 1] * m[:, 1, 0]], axis=1)
+        det = m[:, 0, 0] * inv[:, 0] + m[:, 0, 1] * inv[:, 3] + m[:, 0, 2] * inv[:, 6]
+        inv *= np.where(det != 0, 1. / np.where(det != 0, det, 1.), 0.)[:, np.newaxis]
+        inv = inv[:, :, np.newaxis, np.newaxis]
+        # Map every destination pixel (x, y) to its source coordinates
+        xs = np.arange(size, dtype=np.float64)[np.newaxis, np.newaxis, :]
+        ys = np.arange(size, dtype=np.float64)[np.newaxis, :, np.newaxis]
+        w = (inv[:, 7] * ys + inv[:, 8]) + inv[:, 6] * xs
+        w = np.where(w != 0, 1. / np.where(w != 0, w, 1.), 0.)
+        int_min, int_max = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+        src_x = np.rint(np.clip(((inv[:, 1] * ys + inv[:, 2]) + inv[:, 0] * xs) * w, int_min, int_max))
+        src_y = np.rint(np.clip(((inv[:, 4] * ys + inv[:, 5]) + inv[:, 3] * xs) * w, int_min, int_max))
+        src_x, src_y = src_x.astype(np.int64), src_y.astype(np.int64)
+        # Pixels mapped from outside the image are black
+        inside = (src_x >= 0) & (src_x < gray.shape[1]) & (src_y >= 0) & (src_y < gray.shape[0])
+        sampled = gray[np.clip(src_y, 0, gray.shape[0] - 1), np.clip(src_x, 0, gray.shape[1] - 1)]
+        sampled[~inside] = 0
+        return sampled
+
+    @staticmethod
+    def _otsu_thresholds(imgs):
+        """
+        Computes the Otsu threshold of each 8-bit image in the batch, as cv2.threshold with THRESH_OTSU does.
+        :param imgs: 8-bit images, with shape (N, rows, cols)
+        :return: array of N thresholds
+        """
+        n_imgs = len(imgs)
+        n_levels = 256
+        # One histogram per image, through a single bincount with each image's levels offset
+        offsets = np.arange(n_imgs)[:, np.newaxis] * n_levels
+        hists = np.bincount((imgs.reshape(n_imgs, -1) + offsets).ravel(),
+                            minlength=n_imgs * n_levels).reshape(n_imgs, n_levels)
+        scale = 1. / (imgs.shape[1] * imgs.shape[2])
+        # Sums of integers, so exact regardless of summation order
+        mu = np.dot(hists.astype(np.float64), np.arange(n_levels, dtype=np.float64)) * scale
+        # Run OpenCV's recurrence over all images at once
+        mu1, q1 = np.zeros(n_imgs), np.zeros(n_imgs)
+        max_sigma, max_val = np.zeros(n_imgs), np.zeros(n_imgs)
+        eps = np.finfo(np.float32).eps
+        for i in range(n_levels):
+            p_i = hists[:, i] * scale
+            mu1 *= q1
+            q1 += p_i
+            q2 = 1. - q1
+            valid = ~((np.minimum(q1, q2) < eps) | (np.maximum(q1, q2) > 1. - eps))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mu1 = np.where(valid, (mu1 + i * p_i) / q1, mu1)
+                mu2 = (mu - q1 * mu1) / q2
+                sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+            better = valid & (sigma > max_sigma)
+            max_sigma[better] = sigma[better]
+            max_val[better] = i
+        return max_val
+
     @staticmethod
     def _get_border_errors(bits, marker_size, border_size):
         """
@@ -503,9 +872,10 @@ class MarkerDetectPar:
     @classmethod
     def _filter_detected_markers(cls, corners, ids):
         """
-        Filter markers that share the same ID by
-        :param corners:
-        :param ids:
+        Filter markers that share the same ID by removing any marker contained in another marker of that ID
+        (double border bug). Markers are grouped by ID first, so only pairs within each group are compared.
+        :param corners: array of markers, each of shape (4, 2)
+        :param ids: array of marker IDs, respective to corners
         :return: (corners, ids) tuple
         """
         # Check that corners size is equal to id size, not sure if assert is done correctly
@@ -515,41 +885,61 @@ class MarkerDetectPar:
         if len(corners) == 0:
             return corners, ids
 
-        # Mark markers that will be deleted, initializes array all set to false
-        to_remove = np.array([False] * len(corners))
-
-        # Remove repeated markers with same id, or if one contains the other (double border bug)
-        for i in range(len(corners) - 1):
-            for j in range(1, len(corners)):
-                if i == j or ids[i] != ids[j]:
-                    continue
-                else:
-                    # Remove one of two identical (same ID) markers
-                    # Check if first marker is inside second
-                    inside = True
-                    for p in range(4):
-                        point = tuple(corners[j][p])
-                        if cv2.pointPolygonTest(corners[i], point, measureDist=False) < 0:
-                            inside = False
-                            break
-                    if inside:
-                        to_remove[j] = True
-                        continue
-
-                    # check the second marker
-                    inside = True
-                    for p in range(4):
-                        point = tuple(corners[i][p])
-                        if cv2.pointPolygonTest(corners[j], point, measureDist=False) < 0:
-                            inside = False
-                            break
-                    if inside:
-                        to_remove[i] = True
-                        continue
-
         corners = np.array(corners)
         ids = np.array(ids)
-        filtered_corners = corners[to_remove != True]
-        filtered_ids = ids[to_remove != True]
+        pairs_i, pairs_j = cls._find_same_id_pairs(ids)
+        # If no ID is shared, there is nothing to filter
+        if len(pairs_i) == 0:
+            return corners, ids
+
+        # Remove one of two identical (same ID) markers: the second if it is inside the first,
+        # else the first if it is inside the second
+        j_inside_i = np.all(cls._quads_contain_points(corners[pairs_i], corners[pairs_j]), axis=1)
+        i_inside_j = np.all(cls._quads_contain_points(corners[pairs_j], corners[pairs_i]), axis=1)
+        # Mark markers that will be deleted
+        to_remove = np.zeros(len(corners), dtype=bool)
+        to_remove[pairs_j[j_inside_i]] = True
+        to_remove[pairs_i[~j_inside_i & i_inside_j]] = True
+
+        return corners[~to_remove], ids[~to_remove]
+
+    @staticmethod
+    def _find_same_id_pairs(ids):
+        """
+        Finds every pair of markers sharing an ID.
+        :param ids: array of marker IDs
+        :return: (pairs_i, pairs_j) tuple of index arrays, with pairs_i < pairs_j
+        """
+        # A stable sort keeps the indices of each group ascending, so that each pair comes out with i < j
+        order = np.argsort(ids, kind='stable')
+        _, starts, counts = np.unique(ids[order], return_index=True, return_counts=True)
+        pairs_i = list()
+        pairs_j = list()
+        for start, count in zip(starts[counts > 1], counts[counts > 1]):
+            a, b = np.triu_indices(count, 1)
+            pairs_i.append(order[start + a])
+            pairs_j.append(order[start + b])
+        if len(pairs_i) == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+    @staticmethod
+    def _quads_contain_points(quads, points):
+        """
+        Tests whether points lie inside (or on the edge of) convex quads, as cv2.pointPolygonTest(...) >= 0 would.
+        A point is inside a convex polygon if it lies on the same side of every edge, i.e. if the cross products of
+        the edges with the vectors to the point all share a sign.
+        :param quads: array of convex quads, of shape (N, 4, 2)
+        :param points: array of points to test against the respective quad, of shape (N, P, 2)
+        :return: boolean array of shape (N, P)
+        """
+        quads = np.asarray(quads, dtype=np.float64)
+        edges = np.roll(quads, -1, axis=1) - quads
+        to_points = np.asarray(points, dtype=np.float64)[:, :, np.newaxis, :] - quads[:, np.newaxis, :, :]
+        cross = edges[:, np.newaxis, :, 0] * to_points[..., 1] - edges[:, np.newaxis, :, 1] * to_points[..., 0]
+        return np.all(cross >= 0, axis=2) | np.all(cross <= 0, axis=2)
+
 
-        return filtered_corners, filtered_ids
+# Forked children (e.g., process pools scanning several images) start their own thread pool
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=MarkerDetectPar._reset_threshold_pool)
@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 import os
 import cv2
 from cv2 import aruco
@@ -53,6 +54,20 @@ class TestMarkerDetectPar(unittest.TestCase):
         np.testing.assert_equal(MarkerDetectPar._threshold(self.gray, 4),
                                 MarkerDetectPar._threshold(self.gray, 5))
 
+    def test_threshold_integral_equals_threshold(self):
+        integral, pad = MarkerDetectPar._integral_image(self.gray, 23)
+        for win_size in (3, 4, 13, 22, 23):
+            for constant in (7, 0, -3, 2.5):
+                np.testing.assert_array_equal(
+                    MarkerDetectPar._threshold_integral(self.gray, integral, pad, win_size, constant),
+                    MarkerDetectPar._threshold(self.gray, win_size, constant))
+
+    def test_threshold_integral_raise_on_too_large_window(self):
+        integral, pad = MarkerDetectPar._integral_image(self.gray, 13)
+        self.assertRaises(AssertionError,
+                          MarkerDetectPar._threshold_integral,
+                          self.gray, integral, pad, 23)
+
     def test_threshold_returns_valid_thresholded_img(self):
         thresh = MarkerDetectPar._threshold(self.gray, 3)
         self.assertIsNotNone(thresh)
@@ -105,6 +120,68 @@ class TestMarkerDetectPar(unittest.TestCase):
             np.testing.assert_array_equal(actual_ids, expected_ids)
             print("PASSED: {}".format(img_path))
 
+    def test_detect_markers_parallel_accepts_gray_image(self):
+        corners, ids = MarkerDetectPar.detect_markers_parallel(self.img_marker_0_trans)
+        gray_corners, gray_ids = MarkerDetectPar.detect_markers_parallel(self.gray_marker_0_trans)
+        np.testing.assert_array_equal(gray_corners, corners)
+        np.testing.assert_array_equal(gray_ids, ids)
+
+    def test_detect_markers_parallel_pyramid_equals_full_resolution(self):
+        params = dict(MarkerDetectPar.params)
+        gray = cv2.imread(os.path.join(ImageProcessingSettings.get_test_files_path(), '2_ZENITH_0_BACK.jpg'),
+                          cv2.IMREAD_GRAYSCALE)
+        try:
+            MarkerDetectPar.params[MarkerDetectPar.doCornerRefinement] = True
+            expected_corners, expected_ids = MarkerDetectPar.detect_markers_parallel(gray)
+            MarkerDetectPar.params[MarkerDetectPar.doCornerRefinement] = False
+            MarkerDetectPar.params[MarkerDetectPar.pyramidLevels] = 1
+            MarkerDetectPar.params[MarkerDetectPar.pyramidCornerTolerance] = 0.1
+            actual_corners, actual_ids = MarkerDetectPar.detect_markers_parallel(gray)
+        finally:
+            MarkerDetectPar.params.update(params)
+        expected_order = np.argsort(expected_ids)
+        actual_order = np.argsort(actual_ids)
+        np.testing.assert_array_equal(np.array(actual_ids)[actual_order], np.array(expected_ids)[expected_order])
+        np.testing.assert_allclose(np.array(actual_corners)[actual_order],
+                                   np.array(expected_corners)[expected_order], atol=0.1)
+
+    def test_corner_refinement_needs_pyramid_or_flag(self):
+        params = dict(MarkerDetectPar.params)
+        try:
+            MarkerDetectPar.params[MarkerDetectPar.doCornerRefinement] = False
+            MarkerDetectPar.params[MarkerDetectPar.pyramidLevels] = 0
+            MarkerDetectPar.params[MarkerDetectPar.pyramidCornerTolerance] = 0.1
+            with mock.patch.object(MarkerDetectPar, '_refine_corners') as refine_mock:
+                corners, _ = MarkerDetectPar.detect_markers_parallel(self.gray_marker_0_trans)
+            refine_mock.assert_not_called()
+            MarkerDetectPar.params[MarkerDetectPar.doCornerRefinement] = True
+            refined_corners, _ = MarkerDetectPar.detect_markers_parallel(self.gray_marker_0_trans)
+        finally:
+            MarkerDetectPar.params.update(params)
+        # Same type with or without refinement
+        self.assertIsInstance(corners, list)
+        self.assertIsInstance(refined_corners, list)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_threshold_pool_usable_after_fork(self):
+        self.assertEqual(MarkerDetectPar._get_threshold_pool().submit(sum, [1, 2]).result(), 3)
+        pid = os.fork()
+        if pid == 0:
+            # The parent's pool has no threads here, so using it would hang
+            ok = MarkerDetectPar._threshold_pool is None and \
+                MarkerDetectPar._get_threshold_pool().submit(sum, [1, 2]).result(timeout=30) == 3
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_pyramid_up_candidates(self):
+        candidates = [np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float32)]
+        np.testing.assert_array_equal(MarkerDetectPar._pyramid_up_candidates(candidates, 0), candidates)
+        np.testing.assert_array_equal(MarkerDetectPar._pyramid_up_candidates(candidates, 2),
+                                      [[[1.5, 1.5], [5.5, 1.5], [5.5, 5.5], [1.5, 5.5]]])
+        self.assertEqual(MarkerDetectPar._pyramid_down(self.gray, 2).shape,
+                         ((self.gray.shape[0] + 3) // 4, (self.gray.shape[1] + 3) // 4))
+
     # ~~STEP 1 FUNCTIONS~~
 
     def test_detect_candidates_equals_aruco_method(self):
@@ -133,6 +210,19 @@ class TestMarkerDetectPar(unittest.TestCase):
         np.testing.assert_allclose(test_vals[0], true_vals[0])
         np.testing.assert_equal(test_vals[1], true_vals[1])
 
+    def test_detect_initial_candidates_merges_scales_in_order(self):
+        test_cand, test_cont = MarkerDetectPar._detect_initial_candidates(self.gray)
+        true_cand, true_cont = list(), list()
+        for scale in range(MarkerDetectPar.params[MarkerDetectPar.adaptiveThreshWinSizeMin],
+                           MarkerDetectPar.params[MarkerDetectPar.adaptiveThreshWinSizeMax] + 1,
+                           MarkerDetectPar.params[MarkerDetectPar.adaptiveThreshWinSizeStep]):
+            cand, cont = MarkerDetectPar._find_marker_contours_at_scale(self.gray, scale)
+            true_cand.extend(cand)
+            true_cont.extend(cont)
+        np.testing.assert_array_equal(test_cand, np.squeeze(true_cand))
+        np.testing.assert_equal(test_cont, true_cont)
+        self.assertIs(MarkerDetectPar._get_threshold_pool(), MarkerDetectPar._get_threshold_pool())
+
     def test_find_marker_contours_equals_aruco_method(self):
         """
         Tests find_marker_contours with various thresholded images.
@@ -217,6 +307,31 @@ class TestMarkerDetectPar(unittest.TestCase):
         np.testing.assert_allclose(candidates, cand_copy)
         np.testing.assert_array_equal(contours, cont_copy)
 
+    def test_filter_too_close_candidates_equals_pairwise_comparison(self):
+        # Clusters of jittered quads, so that many (but not all) candidates are too close to one another
+        rng = np.random.RandomState(0)
+        centers = rng.uniform(0, 500, (10, 2))
+        candidates = [(centers[rng.randint(len(centers))] + rng.normal(0, 3, (4, 2))).astype(np.float32)
+                      for _ in range(200)]
+        contours = [np.zeros((rng.randint(20, 200), 2), dtype=np.int32) for _ in range(200)]
+        # Pairwise comparison of all candidates, as done by Aruco
+        rate = MarkerDetectPar.params[MarkerDetectPar.minMarkerDistanceRate]
+        to_remove = [False] * len(candidates)
+        for i in range(len(candidates)):
+            for j in range(i + 1, len(candidates)):
+                min_dist_sq = (min(len(contours[i]), len(contours[j])) * rate) ** 2
+                for fc in range(4):
+                    diff = (np.roll(candidates[i], -fc, axis=0) - candidates[j]).astype(np.float64)
+                    if np.sum(np.square(diff)) / 4.0 < min_dist_sq:
+                        if not (to_remove[i] or to_remove[j]):
+                            to_remove[j if len(contours[i]) > len(contours[j]) else i] = True
+                        break
+        true_cand = [c for c, r in zip(candidates, to_remove) if not r]
+        test_cand, test_cont = MarkerDetectPar._filter_too_close_candidates(candidates, contours)
+        self.assertEqual(len(test_cand), len(true_cand))
+        self.assertEqual(len(test_cont), len(true_cand))
+        np.testing.assert_array_equal(test_cand, true_cand)
+
 
     # ~~STEP 2 FUNCTIONS~~
 
@@ -332,6 +447,14 @@ class TestMarkerDetectPar(unittest.TestCase):
         bits = MarkerDetectPar._extract_bits(self.gray_marker_0, candidates[0])
         np.testing.assert_array_equal(bits, np.ones((6, 6), dtype=np.int8))
 
+    def test_extract_bits_batch_equals_extract_bits(self):
+        for gray in (self.gray_marker_0, self.gray_marker_0_trans, self.gray):
+            candidates, _ = aruco._detectCandidates(gray, aruco.DetectorParameters_create())
+            batch_bits = MarkerDetectPar._extract_bits_batch(gray, candidates)
+            self.assertEqual(batch_bits.shape, (len(candidates), 6, 6))
+            for bits, corners in zip(batch_bits, candidates):
+                np.testing.assert_array_equal(bits, MarkerDetectPar._extract_bits(gray, corners))
+
 
     def test_get_border_errors_equals_aruco_method(self):
         candidates, _ = aruco._detectCandidates(self.gray_marker_0, aruco.DetectorParameters_create())
@@ -369,6 +492,32 @@ class TestMarkerDetectPar(unittest.TestCase):
         np.testing.assert_allclose(test_corners, np.array([[[1., 1.], [1., 5.], [5., 5.], [5., 1.]]]))
         np.testing.assert_array_equal(test_ids, [1])
 
+    def test_filter_detected_markers_equals_pairwise_comparison(self):
+        # Marker 0 contains markers 2 and 4 (ID 1), marker 3 is inside marker 5 (ID 2), and marker 6 shares
+        # ID 2 without any containment; marker 1 is alone with ID 3
+        corners = np.array([[[1., 1.], [1., 9.], [9., 9.], [9., 1.]],
+                            [[2., 2.], [2., 4.], [4., 4.], [4., 2.]],
+                            [[2., 2.], [2., 4.], [4., 4.], [4., 2.]],
+                            [[21., 21.], [21., 24.], [24., 24.], [24., 21.]],
+                            [[1., 1.], [1., 9.], [9., 9.], [9., 1.]],
+                            [[20., 20.], [20., 25.], [25., 25.], [25., 20.]],
+                            [[40., 40.], [40., 45.], [45., 45.], [45., 40.]]], dtype=np.float32)
+        ids = np.array([1, 3, 1, 2, 1, 2, 2])
+        # Reference: Aruco's comparison of each pair (i, j), i < j, sharing an ID
+        to_remove = np.zeros(len(ids), dtype=bool)
+        for i in range(len(ids)):
+            for j in range(i + 1, len(ids)):
+                if ids[i] != ids[j]:
+                    continue
+                if all(cv2.pointPolygonTest(corners[i], tuple(map(float, p)), False) >= 0 for p in corners[j]):
+                    to_remove[j] = True
+                elif all(cv2.pointPolygonTest(corners[j], tuple(map(float, p)), False) >= 0 for p in corners[i]):
+                    to_remove[i] = True
+        test_corners, test_ids = MarkerDetectPar._filter_detected_markers(corners, ids)
+        np.testing.assert_allclose(test_corners, corners[~to_remove])
+        np.testing.assert_array_equal(test_ids, ids[~to_remove])
+        np.testing.assert_array_equal(test_ids, [1, 3, 2, 2])
+
     # ~~STEP 4 FUNCTIONS~~
 
     # Non-existent cause we don't have to implement -- yeah!
@@ -0,0 +1,78 @@
+import numpy as np
+
+
+def rodrigues_to_quaternions(rvecs):
+    """
+    Converts rotations in compact Rodrigues notation (as returned by OpenCV) into unit quaternions, in closed form.
+    The sign of each quaternion follows pyquaternion.Quaternion(matrix=...), which keeps positive the component it
+    derives from the largest diagonal term of the rotation matrix, so results are interchangeable with it.
+    :param rvecs: array of rotation vectors of shape (N, 3), or (N, 1, 3) as returned by Aruco
+    :return: array of quaternions of shape (N, 4), with components ordered (w, x, y, z)
+    """
+    rvecs = np.asarray(rvecs, dtype=np.float64).reshape(-1, 3)
+    angles = np.linalg.norm(rvecs, axis=1)
+    # sin(angle/2)/angle tends to 1/2 as the angle tends to 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scales = np.where(angles > 1e-12, np.sin(angles / 2) / angles, 0.5)
+    quaternions = np.empty((len(rvecs), 4))
+    quaternions[:, 0] = np.cos(angles / 2)
+    quaternions[:, 1:] = rvecs * scales[:, np.newaxis]
+    # Diagonal of the rotation matrix, deciding which component pyquaternion keeps positive
+    w, x, y, z = quaternions.T
+    r00 = 1 - 2 * (y * y + z * z)
+    r11 = 1 - 2 * (x * x + z * z)
+    r22 = 1 - 2 * (x * x + y * y)
+    positive_component = np.where(r22 < 0,
+                                  np.where(r00 > r11, 1, 2),
+                                  np.where(r00 < -r11, 3, 0))
+    signs = np.where(quaternions[np.arange(len(quaternions)), positive_component] < 0, -1., 1.)
+    return quaternions * signs[:, np.newaxis]
+
+
+def quaternions_to_rodrigues(quaternions):
+    """
+    Converts quaternions into rotations in compact Rodrigues notation, in closed form.
+    Quaternions are normalised first, and rotation angles are kept within [0, pi] as cv2.Rodrigues does.
+    :param quaternions: array of quaternions of shape (N, 4), with components ordered (w, x, y, z)
+    :return: array of rotation vectors of shape (N, 3)
+    """
+    quaternions = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4)
+    quaternions = quaternions / np.linalg.norm(quaternions, axis=1, keepdims=True)
+    # q and -q are the same rotation; the one with w >= 0 rotates by at most pi
+    quaternions = quaternions * np.where(quaternions[:, 0] < 0, -1., 1.)[:, np.newaxis]
+    sin_halves = np.linalg.norm(quaternions[:, 1:], axis=1)
+    angles = 2 * np.arctan2(sin_halves, quaternions[:, 0])
+    # angle/sin(angle/2) tends to 2 as the angle tends to 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scales = np.where(sin_halves > 1e-12, angles / sin_halves, 2.)
+    return quaternions[:, 1:] * scales[:, np.newaxis]
+
+
+def multiply_quaternions(p, q):
+    """
+    Hamilton product of each pair of quaternions, as pyquaternion's p * q.
+    :param p: array of quaternions of shape (N, 4), with components ordered (w, x, y, z)
+    :param q: array of quaternions of shape (N, 4), with components ordered (w, x, y, z)
+    :return: array of quaternion products of shape (N, 4)
+    """
+    p = np.asarray(p, dtype=np.float64).reshape(-1, 4)
+    q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+    pw, px, py, pz = p.T
+    qw, qx, qy, qz = q.T
+    return np.stack((pw * qw - px * qx - py * qy - pz * qz,
+                     pw * qx + px * qw + py * qz - pz * qy,
+                     pw * qy - px * qz + py * qw + pz * qx,
+                     pw * qz + px * qy - py * qx + pz * qw), axis=1)
+
+
+def quaternions_to_rotation_matrices(quaternions):
+    """
+    Converts unit quaternions into rotation matrices, as pyquaternion's rotation_matrix.
+    :param quaternions: array of unit quaternions of shape (N, 4), with components ordered (w, x, y, z)
+    :return: array of rotation matrices of shape (N, 3, 3)
+    """
+    w, x, y, z = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4).T
+    return np.stack((np.stack((1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)), axis=1),
+                     np.stack((2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)), axis=1),
+                     np.stack((2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)), axis=1)),
+                    axis=1)
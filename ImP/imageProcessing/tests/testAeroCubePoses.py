@@ -0,0 +1,66 @@
+import unittest
+import numpy as np
+from pyquaternion import Quaternion
+from ImP.imageProcessing.aerocubeMarker import AeroCubeMarker, AeroCubeFace, AeroCube, MarkerTable
+
+
+class TestAeroCubePoses(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        cls.MARKERS = list()
+        # two AeroCubes, each seen through all of its faces; markers of both are interleaved
+        for aerocube_ID, cube_quat, center in ((1, Quaternion(axis=[1, 2, 3], angle=0.4), np.array([1., -2., 30.])),
+                                               (0, Quaternion(axis=[0, 1, 0], angle=2.), np.array([-4., 0., 50.]))):
+            for face in AeroCubeFace:
+                # pose of each marker, up to a little noise, as seen from the pose of its AeroCube
+                noise = Quaternion(axis=rng.normal(size=3), angle=rng.uniform(0, 0.02))
+                face_quat = Quaternion(array=face.quaternion.elements).normalised
+                quat = (noise * cube_quat * face_quat.inverse).normalised
+                tvec = center - quat.inverse.rotate(face.translation) + rng.normal(scale=0.01, size=3)
+                corners = np.zeros((4, 2))
+                cls.MARKERS.append(AeroCubeMarker(corners, aerocube_ID * AeroCube.NUM_SIDES + face.value,
+                                                  quat, tvec.reshape(1, 3)))
+        cls.MARKERS = cls.MARKERS[::2] + cls.MARKERS[1::2]
+
+    @staticmethod
+    def _reduce_poses_per_marker(markers):
+        """
+        Previous per-marker reduction: component-wise mean of candidate quaternions and candidate centers
+        """
+        candidate_quats = [m.quaternion * m.aerocube_face.quaternion for m in markers]
+        candidate_centers = [m.quaternion.inverse.rotate(np.add(m.quaternion.rotate(np.squeeze(m.tvec)),
+                                                                m.aerocube_face.translation)) for m in markers]
+        return (Quaternion(np.mean([q.elements for q in candidate_quats], axis=0)).normalised.elements,
+                np.mean(candidate_centers, axis=0))
+
+    def test_reduce_poses_equals_per_marker_reduction(self):
+        cube_ids, quaternions, tvecs = AeroCube.reduce_marker_table(MarkerTable.from_markers(self.MARKERS))
+        np.testing.assert_array_equal(cube_ids, [0, 1])
+        for cube_id, quaternion, tvec in zip(cube_ids, quaternions, tvecs):
+            expected_quat, expected_tvec = self._reduce_poses_per_marker(
+                [m for m in self.MARKERS if m.aerocube_ID == cube_id])
+            np.testing.assert_allclose(quaternion, expected_quat, atol=1e-4)
+            np.testing.assert_allclose(tvec, expected_tvec, atol=1e-9)
+
+    def test_reduce_poses_ignores_quaternion_signs(self):
+        table = MarkerTable.from_markers(self.MARKERS)
+        cube_ids, faces, quaternions, tvecs = table.aerocube_IDs, table.faces, table.quaternions, table.tvecs
+        _, expected_quats, _ = AeroCube.reduce_poses(cube_ids, faces, quaternions, tvecs)
+        # q and -q are the same rotation, but cancel out in a component-wise mean
+        quaternions[1::2] *= -1
+        _, test_quats, _ = AeroCube.reduce_poses(cube_ids, faces, quaternions, tvecs)
+        np.testing.assert_allclose(np.abs(np.sum(test_quats * expected_quats, axis=1)), 1, atol=1e-12)
+
+    def test_init_reduces_markers(self):
+        markers = [m for m in self.MARKERS if m.aerocube_ID == 1]
+        _, quaternions, tvecs = AeroCube.reduce_marker_table(MarkerTable.from_markers(markers))
+        aerocube = AeroCube(markers)
+        np.testing.assert_allclose(aerocube.quaternion.elements, quaternions[0])
+        np.testing.assert_allclose(aerocube.tvec, tvecs[0])
+        self.assertEqual(aerocube.distance, np.linalg.norm(tvecs[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
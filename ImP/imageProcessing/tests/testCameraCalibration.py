@@ -3,8 +3,10 @@ import unittest
 import numpy as np
 import cv2
 import tempfile
+from unittest import mock
 from ImP.imageProcessing.aerocubeMarker import AeroCubeMarker
-from ImP.imageProcessing.cameraCalibration import CameraCalibration
+from ImP.imageProcessing import cameraCalibration
+from ImP.imageProcessing.cameraCalibration import CameraCalibration, CameraCalibrationAttributeError
 from ImP.imageProcessing.settings import ImageProcessingSettings
 
 
@@ -60,6 +62,91 @@ class TestCameraCalibration(unittest.TestCase):
         self.assertEqual(retval[1].shape, (3, 3))
         self.assertEqual(retval[2].shape, (1, 5))
 
+    def test_get_calibration_matrices_caches_detections(self):
+        board = CameraCalibration.get_charucoboard()
+        img_arr = [cv2.imread(os.path.join(self._test_files_path, "andrew_iphone_calibration_photo_{}.jpg".format(i)))
+                   for i in range(4)]
+        expected = CameraCalibration.get_calibration_matrices(board, img_arr, workers=1)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            CameraCalibration.get_calibration_matrices(board, img_arr[:3], workers=2, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            # only the image added to the set is processed
+            with mock.patch.object(cameraCalibration, '_detect_charuco_corners',
+                                   wraps=cameraCalibration._detect_charuco_corners) as detect:
+                retval = CameraCalibration.get_calibration_matrices(board, img_arr, workers=1, cache_dir=cache_dir)
+                self.assertEqual(detect.call_count, 1)
+        self.assertAlmostEqual(retval[0], expected[0])
+        np.testing.assert_allclose(retval[1], expected[1])
+        np.testing.assert_allclose(retval[2], expected[2])
+
+    def test_get_calibration_for_image(self):
+        cal = CameraCalibration.get_default_calibration()
+        self.assertIs(CameraCalibration.get_calibration_for_image(cal, cal.IMG_RES + (3,)), cal)
+        small_cal = CameraCalibration.get_calibration_for_image(cal, (756, 1008))
+        self.assertIs(CameraCalibration.get_calibration_for_image(cal, (756, 1008)), small_cal)
+        self.assertEqual(small_cal.IMG_RES, (756, 1008))
+        np.testing.assert_array_equal(small_cal.DIST_COEFFS, cal.DIST_COEFFS)
+        # points project onto the same pixel areas, at a quarter of the resolution
+        object_points = np.array([[0.1, -0.05, 1.], [-0.2, 0.3, 0.8]])
+        points, _ = cv2.projectPoints(object_points, np.zeros(3), np.zeros(3), cal.CAMERA_MATRIX, cal.DIST_COEFFS)
+        small_points, _ = cv2.projectPoints(object_points, np.zeros(3), np.zeros(3),
+                                            small_cal.CAMERA_MATRIX, small_cal.DIST_COEFFS)
+        np.testing.assert_allclose(small_points, (points + 0.5) / 4 - 0.5)
+        # a crop shifts the principal point
+        crop_cal = CameraCalibration.get_calibration_for_image(cal, (1000, 2000), crop=(12, 34, 1000, 2000))
+        np.testing.assert_allclose(crop_cal.CAMERA_MATRIX[:2, 2], cal.CAMERA_MATRIX[:2, 2] - [34, 12])
+        np.testing.assert_allclose(crop_cal.CAMERA_MATRIX[[0, 1], [0, 1]], cal.CAMERA_MATRIX[[0, 1], [0, 1]])
+        self.assertRaises(CameraCalibrationAttributeError, CameraCalibration.get_calibration_for_image,
+                          cal, (100, 100), crop=(3000, 0, 100, 100))
+
+    def test_get_undistort_maps_equals_cv2_undistort(self):
+        CameraCalibration.set_undistort_maps_cache()
+        cal = CameraCalibration.PredefinedCalibration.GUS_GOPRO
+        img = cv2.imread(os.path.join(self._test_files_path, 'jetson_test1.jpg'))
+        maps = CameraCalibration.get_undistort_maps(cal, img.shape[:2])
+        self.assertIs(CameraCalibration.get_undistort_maps(cal, img.shape), maps)
+        test_img = CameraCalibration.undistort_image(cal, img)
+        expected_img = cv2.undistort(img, cal.CAMERA_MATRIX, cal.DIST_COEFFS)
+        # maps are fixed-point, so interpolation may differ by a level or two
+        self.assertLessEqual(np.percentile(cv2.absdiff(test_img, expected_img), 99), 2)
+
+    def test_undistort_maps_cache_evicts_least_recently_used(self):
+        CameraCalibration.set_undistort_maps_cache(max_size=2)
+        cal = CameraCalibration.get_default_calibration()
+        maps = [CameraCalibration.get_undistort_maps(cal, (40, 60 + i)) for i in range(2)]
+        self.assertIs(CameraCalibration.get_undistort_maps(cal, (40, 60)), maps[0])
+        CameraCalibration.get_undistort_maps(cal, (40, 62))
+        self.assertIs(CameraCalibration.get_undistort_maps(cal, (40, 60)), maps[0])
+        self.assertIsNot(CameraCalibration.get_undistort_maps(cal, (40, 61)), maps[1])
+        self.assertRaises(CameraCalibrationAttributeError, CameraCalibration.set_undistort_maps_cache, max_size=0)
+        CameraCalibration.set_undistort_maps_cache()
+
+    def test_undistort_maps_directory(self):
+        cal = CameraCalibration.get_default_calibration()
+        with tempfile.TemporaryDirectory() as directory:
+            CameraCalibration.set_undistort_maps_cache(directory=directory)
+            maps = CameraCalibration.get_undistort_maps(cal, (40, 60))
+            self.assertEqual(len(os.listdir(directory)), 2)
+            # maps are loaded from the directory once dropped from memory
+            CameraCalibration.set_undistort_maps_cache(directory=directory)
+            stored_maps = CameraCalibration.get_undistort_maps(cal, (40, 60))
+            for stored_map, undistort_map in zip(stored_maps, maps):
+                self.assertIsInstance(stored_map, np.memmap)
+                np.testing.assert_array_equal(stored_map, undistort_map)
+            CameraCalibration.set_undistort_maps_cache()
+
+    def test_undistort_points(self):
+        cal = CameraCalibration.get_default_calibration()
+        points = np.array([[[1000., 800.], [3000., 800.], [3000., 2200.], [1000., 2200.]]])
+        # distort the points, as the camera would have seen them
+        normalized = cv2.undistortPoints(points.reshape(-1, 1, 2), cal.CAMERA_MATRIX, None)
+        normalized = np.concatenate((normalized.reshape(-1, 2), np.ones((4, 1))), axis=1)
+        distorted, _ = cv2.projectPoints(normalized, np.zeros(3), np.zeros(3), cal.CAMERA_MATRIX, cal.DIST_COEFFS)
+        test_points = CameraCalibration.undistort_points(cal, distorted.reshape(points.shape))
+        self.assertEqual(test_points.shape, points.shape)
+        np.testing.assert_allclose(test_points, points, atol=1e-2)
+        self.assertEqual(CameraCalibration.undistort_points(cal, np.zeros((0, 4, 2))).shape, (0, 4, 2))
+
 
 if __name__ == '__main__':
     unittest.main()
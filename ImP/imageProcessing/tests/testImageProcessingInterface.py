@@ -1,5 +1,6 @@
 import os
 import unittest
+from unittest import mock
 from collections import namedtuple
 import cv2
 from cv2 import aruco
@@ -8,7 +9,7 @@ import os
 import pyquaternion
 from collections import namedtuple
 from ImP.imageProcessing.aerocubeMarker import AeroCubeMarker, AeroCubeFace, AeroCube
-from ImP.imageProcessing.imageProcessingInterface import ImageProcessor
+from ImP.imageProcessing.imageProcessingInterface import ImageProcessor, MarkerDetectPar
 from ImP.imageProcessing.settings import ImageProcessingSettings
 from ImP.imageProcessing.cameraCalibration import CameraCalibration
 from jobs.aeroCubeSignal import ImageEventSignal
@@ -63,6 +64,36 @@ class TestImageProcessingInterfaceMethods(unittest.TestCase):
     def test_negative_load_image(self):
         self.assertRaises(OSError, ImageProcessor, self.TEST_SINGLE_MARKER.img_path + "NULL")
 
+    def test_load_image_with_load_policy(self):
+        color = ImageProcessor._load_image(self.AC_0_FACES_125_PATH)
+        gray = ImageProcessor._load_image(self.AC_0_FACES_125_PATH, ImageProcessor.LoadPolicy.GRAYSCALE)
+        reduced = ImageProcessor._load_image(self.AC_0_FACES_125_PATH, ImageProcessor.LoadPolicy.GRAYSCALE_REDUCED_4)
+        self.assertEqual(gray.shape, color.shape[:2])
+        self.assertEqual(reduced.shape, ((color.shape[0] + 3) // 4, (color.shape[1] + 3) // 4))
+        self.assertRaises(ValueError, ImageProcessor._load_image, self.AC_0_FACES_125_PATH,
+                          ImageProcessor.LoadPolicy._Policy(GRAYSCALE=True, REDUCTION=3))
+
+    def test_load_policy_for_marker_pixel_size(self):
+        self.assertEqual(ImageProcessor.LoadPolicy.for_marker_pixel_size(50),
+                         ImageProcessor.LoadPolicy.GRAYSCALE)
+        self.assertEqual(ImageProcessor.LoadPolicy.for_marker_pixel_size(200),
+                         ImageProcessor.LoadPolicy.GRAYSCALE_REDUCED_2)
+        self.assertEqual(ImageProcessor.LoadPolicy.for_marker_pixel_size(200, target_marker_px=25),
+                         ImageProcessor.LoadPolicy.GRAYSCALE_REDUCED_8)
+
+    def test_find_fiducial_marker_with_load_policy(self):
+        imp = ImageProcessor(self.TEST_SINGLE_MARKER.img_path)
+        corners, ids = imp._find_fiducial_markers()
+        for load_policy in (ImageProcessor.LoadPolicy.GRAYSCALE, ImageProcessor.LoadPolicy.GRAYSCALE_REDUCED_2):
+            test_imp = ImageProcessor(self.TEST_SINGLE_MARKER.img_path, load_policy=load_policy)
+            test_corners, test_ids = test_imp._find_fiducial_markers()
+            # corners are reported in full resolution coordinates, within half a reduced pixel
+            np.testing.assert_allclose(test_corners, corners, atol=load_policy.REDUCTION / 2)
+            np.testing.assert_array_equal(test_ids, ids)
+            # drawing decodes the full resolution colour image
+            self.assertIsNone(test_imp._color_img_mat)
+            self.assertEqual(test_imp.draw_fiducial_markers(test_corners, test_ids).shape, imp._img_mat.shape)
+
     def test_find_fiducial_marker(self):
         # hard code results of operation
         corners, ids = ImageProcessor._simplify_fiducial_arrays(self.TEST_SINGLE_MARKER.corners,
@@ -207,6 +238,19 @@ class TestImageProcessingInterfaceMethods(unittest.TestCase):
         self.assertGreater(dist[0], 0.8)
         self.assertLess(dist[0], 1.0)
 
+    def test_find_pose_follows_image_resolution(self):
+        imp = ImageProcessor(self.TEST_JETSON_SINGLE_MARKER.img_path)
+        _, tvecs = imp._find_pose(imp._find_fiducial_markers()[0])
+        # a downscaled copy of the image, unlike the calibration's resolution
+        img = cv2.imread(self.TEST_JETSON_SINGLE_MARKER.img_path)
+        small_img = cv2.resize(img, (img.shape[1] // 4, img.shape[0] // 4), interpolation=cv2.INTER_AREA)
+        small_imp = ImageProcessor(small_img)
+        small_corners, _ = small_imp._find_fiducial_markers()
+        _, small_tvecs = small_imp._find_pose(small_corners)
+        np.testing.assert_allclose(small_tvecs, tvecs, rtol=0.1)
+        np.testing.assert_allclose(small_imp._find_distance(small_corners),
+                                   imp._find_distance(imp._find_fiducial_markers()[0]), rtol=0.1)
+
     def test_identify_markers_for_storage(self):
         # TODO: needs to be rewritten for new method
         self.fail()
@@ -220,6 +264,45 @@ class TestImageProcessingInterfaceMethods(unittest.TestCase):
         # assert equality
         np.testing.assert_array_equal(aerocube_list, scan_results)
 
+    def test_scan_results_are_memoized(self):
+        imp = ImageProcessor(self.TEST_MULT_AEROCUBES.img_path)
+        with mock.patch.object(ImageProcessor, '_detect_fiducial_markers',
+                               wraps=imp._detect_fiducial_markers) as detect, \
+                mock.patch.object(imp, '_find_pose', wraps=imp._find_pose) as find_pose:
+            scan_results = imp.identify_markers_for_storage()
+            imp.draw_aerocubes()
+            self.assertEqual(imp.identify_markers_for_storage(), scan_results)
+            self.assertEqual(detect.call_count, 1)
+            self.assertEqual(find_pose.call_count, 1)
+            # returned arrays are copies, so callers cannot alter the memoized results
+            corners, _ = imp._find_fiducial_markers()
+            corners += 1
+            np.testing.assert_array_equal(imp._find_fiducial_markers()[0], corners - 1)
+            # a new calibration only invalidates the poses
+            imp.cal = CameraCalibration.PredefinedCalibration.GUS_GOPRO
+            imp.identify_markers_for_storage()
+            self.assertEqual(detect.call_count, 1)
+            self.assertEqual(find_pose.call_count, 2)
+
+    def test_detection_key_follows_parallel_params(self):
+        self.assertEqual(ImageProcessor._detection_key(False), ImageProcessor._detection_key(False))
+        key = ImageProcessor._detection_key(True)
+        self.assertNotEqual(key, ImageProcessor._detection_key(False))
+        with mock.patch.dict(MarkerDetectPar.params, {MarkerDetectPar.pyramidLevels: 1}):
+            self.assertNotEqual(ImageProcessor._detection_key(True), key)
+        self.assertEqual(ImageProcessor._detection_key(True), key)
+
+    def test_scan_many_equals_identify_markers_for_storage(self):
+        images = [self.TEST_MULT_AEROCUBES.img_path,
+                  self.TEST_NO_MARKER.img_path,
+                  cv2.imread(self.TEST_SINGLE_MARKER.img_path)]
+        expected = [ImageProcessor(image).identify_markers_for_storage() for image in images]
+        ordered_results = list(ImageProcessor.scan_many(images, workers=2))
+        self.assertEqual([index for index, _ in ordered_results], [0, 1, 2])
+        self.assertEqual([result for _, result in ordered_results], expected)
+        unordered_results = ImageProcessor.scan_many(images, workers=2, chunksize=2, ordered=False)
+        self.assertEqual(sorted(unordered_results, key=lambda indexed_result: indexed_result[0]), ordered_results)
+
     # drawing functions
 
     def test_draw_fiducial_markers(self):
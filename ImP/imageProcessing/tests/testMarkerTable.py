@@ -0,0 +1,75 @@
+import unittest
+import numpy as np
+from pyquaternion import Quaternion
+from ImP.imageProcessing.aerocubeMarker import AeroCubeMarker, AeroCubeFace, AeroCube, MarkerTable, MarkerView, \
+    AeroCubeMarkerAttributeError
+from ImP.fiducialMarkerModule.fiducialMarker import IDOutOfDictionaryBoundError
+
+
+class TestMarkerTable(unittest.TestCase):
+    CORNERS = np.array([[[[884., 659.], [812., 657.], [811., 585.], [885., 586.]]],
+                        [[[504., 653.], [433., 653.], [433., 581.], [505., 582.]]],
+                        [[[104., 253.], [33., 253.], [33., 181.], [105., 182.]]]], dtype=np.float32)
+    IDS = np.array([[8], [0], [2]])
+    QUATERNIONS = np.array([Quaternion(axis=[1, 0, 0], angle=0.5).elements,
+                            Quaternion(axis=[0, 1, 0], angle=1.).elements,
+                            Quaternion(axis=[0, 0, 1], angle=1.5).elements])
+    TVECS = np.array([[[0.1, 0.2, 1.]], [[-0.3, 0., 2.]], [[0., 0.4, 0.5]]])
+
+    def _get_markers(self):
+        return [AeroCubeMarker(c[0], i[0], Quaternion(array=q), t)
+                for c, i, q, t in zip(self.CORNERS, self.IDS, self.QUATERNIONS, self.TVECS)]
+
+    def test_from_detections_equals_markers(self):
+        table = MarkerTable.from_detections(self.CORNERS, self.IDS, self.QUATERNIONS, self.TVECS)
+        self.assertEqual(len(table), 3)
+        np.testing.assert_array_equal(table.aerocube_IDs, [1, 0, 0])
+        np.testing.assert_array_equal(table.faces, [AeroCubeFace.FRONT.value, AeroCubeFace.ZENITH.value,
+                                                    AeroCubeFace.FRONT.value])
+        for view, marker in zip(table, self._get_markers()):
+            self.assertIsInstance(view, MarkerView)
+            self.assertEqual(view, marker)
+            self.assertEqual(view.quaternion, marker.quaternion)
+            np.testing.assert_array_equal(view.tvec, np.squeeze(marker.tvec))
+            self.assertAlmostEqual(view.distance, marker.distance)
+        self.assertEqual(MarkerTable.from_markers(self._get_markers()), table)
+        self.assertEqual(MarkerTable.from_markers(table.to_markers()), table)
+
+    def test_views_have_no_instance_dict(self):
+        view = MarkerTable.from_markers(self._get_markers())[0]
+        self.assertFalse(hasattr(view, '__dict__'))
+
+    def test_from_detections_raises_properly(self):
+        self.assertRaises(IDOutOfDictionaryBoundError, MarkerTable.from_detections,
+                          self.CORNERS, [[8], [0], [-1]], self.QUATERNIONS, self.TVECS)
+        self.assertRaises(AeroCubeMarkerAttributeError, MarkerTable.from_detections,
+                          self.CORNERS[:, :, :3], self.IDS, self.QUATERNIONS, self.TVECS)
+
+    def test_group_by_aerocube(self):
+        table = MarkerTable.from_detections(self.CORNERS, self.IDS, self.QUATERNIONS, self.TVECS)
+        groups = table.group_by_aerocube()
+        self.assertEqual([cube_id for cube_id, _ in groups], [0, 1])
+        self.assertEqual(groups[0][1], table[[1, 2]])
+        self.assertEqual(groups[1][1], table[:1])
+
+    def test_to_jsonifiable_dicts_equals_markers(self):
+        table = MarkerTable.from_detections(self.CORNERS, self.IDS, self.QUATERNIONS, self.TVECS)
+        expected = [m.to_jsonifiable_dict() for m in self._get_markers()]
+        for test_dict, expected_dict in zip(table.to_jsonifiable_dicts(), expected):
+            self.assertEqual(test_dict.keys(), expected_dict.keys())
+            self.assertEqual(test_dict['corners'], expected_dict['corners'])
+            self.assertAlmostEqual(test_dict['distance'], expected_dict['distance'])
+            self.assertEqual([test_dict[k] for k in ('aerocubeID', 'aerocubeFace', 'quaternion')],
+                             [expected_dict[k] for k in ('aerocubeID', 'aerocubeFace', 'quaternion')])
+        self.assertEqual(table[1].to_jsonifiable_dict(), table.to_jsonifiable_dicts()[1])
+
+    def test_aerocube_from_marker_table(self):
+        table = MarkerTable.from_detections(self.CORNERS, self.IDS, self.QUATERNIONS, self.TVECS)[1:]
+        aerocube = AeroCube(table)
+        self.assertEqual(aerocube.ID, 0)
+        self.assertEqual(aerocube, AeroCube(self._get_markers()[1:]))
+        self.assertRaises(AttributeError, AeroCube, MarkerTable())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import unittest
+import numpy as np
+from pyquaternion import Quaternion
+from ImP.imageProcessing.aerocubeMarker import AeroCubeMarker
+from ImP.imageProcessing.imageProcessingInterface import ImageProcessor
+from ImP.imageProcessing.markerTracker import MarkerTracker, MarkerTrackerAttributeError
+from ImP.imageProcessing.settings import ImageProcessingSettings
+
+
+class TestMarkerTracker(unittest.TestCase):
+    test_files_path = ImageProcessingSettings.get_test_files_path()
+    MULT_AEROCUBES_PATH = os.path.join(test_files_path, '2_ZENITH_0_BACK.jpg')
+    CORNERS = np.array([[[100., 100.], [140., 100.], [140., 140.], [100., 140.]],
+                        [[400., 300.], [440., 300.], [440., 340.], [400., 340.]]], dtype=np.float32)
+    IDS = np.array([3, 7])
+    IMG_SHAPE = (480, 640, 3)
+
+    class CountingDetector:
+        """
+        Stand-in for ImageProcessor._detect_fiducial_markers that reports fixed markers
+        (given in full-frame coordinates) found inside whatever region it is called on.
+        """
+        def __init__(self, img, corners, ids):
+            self.img = img
+            self.corners = corners
+            self.ids = ids
+            self.searched_shapes = list()
+
+        def __call__(self, region):
+            self.searched_shapes.append(region.shape)
+            # regions are views into img, so their offset follows from their data pointers
+            y, x = divmod(region.ctypes.data - self.img.ctypes.data, self.img.strides[0])
+            offset = np.float32([x // self.img.strides[1], y])
+            inside = [i for i, c in enumerate(self.corners - offset)
+                      if np.all(c >= 0) and np.all(c < region.shape[1::-1])]
+            return self.corners[inside] - offset, self.ids[inside]
+
+    def test_invalid_init_parameters(self):
+        self.assertRaises(MarkerTrackerAttributeError, MarkerTracker, roi_expansion_rate=-1)
+        self.assertRaises(MarkerTrackerAttributeError, MarkerTracker, full_scan_interval=0)
+
+    def test_seed(self):
+        tracker = MarkerTracker()
+        self.assertTrue(tracker.needs_full_scan())
+        tracker.seed([AeroCubeMarker(c, i, Quaternion(), np.zeros(3)) for c, i in zip(self.CORNERS, self.IDS)])
+        self.assertFalse(tracker.needs_full_scan())
+        np.testing.assert_array_equal(tracker.corners, self.CORNERS)
+        np.testing.assert_array_equal(tracker.ids, self.IDS)
+        # Corners of the full resolution image, tracked in a reduced one
+        tracker.seed([AeroCubeMarker(c, i, Quaternion(), np.zeros(3)) for c, i in zip(self.CORNERS, self.IDS)],
+                     reduction=2)
+        np.testing.assert_allclose(tracker.corners, (self.CORNERS + 0.5) / 2 - 0.5)
+
+    def test_get_regions_of_interest(self):
+        tracker = MarkerTracker(roi_expansion_rate=0.5)
+        tracker._update(self.CORNERS, self.IDS)
+        np.testing.assert_array_equal(tracker.get_regions_of_interest(self.IMG_SHAPE),
+                                      [[80, 80, 161, 161], [380, 280, 461, 361]])
+        # regions are clamped to the image and merged when they overlap
+        tracker = MarkerTracker(roi_expansion_rate=4)
+        tracker._update(self.CORNERS, self.IDS)
+        np.testing.assert_array_equal(tracker.get_regions_of_interest(self.IMG_SHAPE),
+                                      [[0, 0, 601, 480]])
+
+    def test_merge_regions(self):
+        regions = np.array([[0, 0, 10, 10], [20, 0, 30, 10], [5, 5, 25, 8], [40, 40, 50, 50]])
+        np.testing.assert_array_equal(MarkerTracker._merge_regions(regions),
+                                      [[0, 0, 30, 10], [40, 40, 50, 50]])
+        np.testing.assert_array_equal(MarkerTracker._merge_regions(regions[:2]), regions[:2])
+
+    def test_find_fiducial_markers_searches_regions_of_interest(self):
+        img = np.zeros(self.IMG_SHAPE, dtype=np.uint8)
+        tracker = MarkerTracker(full_scan_interval=2)
+        detect = self.CountingDetector(img, self.CORNERS, self.IDS)
+        for expected_shapes in ([self.IMG_SHAPE],
+                                [(81, 81, 3), (81, 81, 3)],
+                                [(81, 81, 3), (81, 81, 3)],
+                                [self.IMG_SHAPE]):
+            detect.searched_shapes = list()
+            corners, ids = tracker.find_fiducial_markers(img, detect)
+            self.assertEqual(detect.searched_shapes, expected_shapes)
+            np.testing.assert_allclose(corners, self.CORNERS)
+            np.testing.assert_array_equal(ids, self.IDS)
+
+    def test_find_fiducial_markers_falls_back_on_lost_marker(self):
+        img = np.zeros(self.IMG_SHAPE, dtype=np.uint8)
+        tracker = MarkerTracker()
+        tracker.find_fiducial_markers(img, self.CountingDetector(img, self.CORNERS, self.IDS))
+        # the second marker moved too far to be found inside its region of interest
+        moved_corners = self.CORNERS + np.float32([[[0, 0]], [[100, 100]]])
+        detect = self.CountingDetector(img, moved_corners, self.IDS)
+        corners, ids = tracker.find_fiducial_markers(img, detect)
+        self.assertEqual(detect.searched_shapes[-1], self.IMG_SHAPE)
+        np.testing.assert_allclose(corners, moved_corners)
+        np.testing.assert_array_equal(ids, self.IDS)
+
+    def test_image_processor_with_tracker_equals_full_search(self):
+        corners, ids = ImageProcessor(self.MULT_AEROCUBES_PATH)._find_fiducial_markers()
+        tracker = MarkerTracker()
+        for _ in range(3):
+            test_corners, test_ids = ImageProcessor(self.MULT_AEROCUBES_PATH,
+                                                    tracker=tracker)._find_fiducial_markers()
+            np.testing.assert_allclose(test_corners, corners)
+            np.testing.assert_array_equal(test_ids, ids)
+        self.assertFalse(tracker.needs_full_scan())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+import cv2
+import numpy as np
+import pyquaternion
+from ImP.imageProcessing.rotationConversion import rodrigues_to_quaternions, quaternions_to_rodrigues
+
+
+class TestRotationConversion(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        axes = rng.normal(size=(500, 3))
+        axes /= np.linalg.norm(axes, axis=1, keepdims=True)
+        rvecs = axes * rng.uniform(0, np.pi, size=(500, 1))
+        # include identity and half-turn rotations, where the closed forms have their edge cases
+        cls.RVECS = np.vstack((rvecs, [[0., 0., 0.], [np.pi, 0., 0.], [0., np.pi, 0.], [0., 0., np.pi]]))
+
+    def test_rodrigues_to_quaternions_equals_pyquaternion(self):
+        expected = np.array([pyquaternion.Quaternion(matrix=cv2.Rodrigues(r)[0]).normalised.elements
+                             for r in self.RVECS])
+        # includes the sign pyquaternion picks for each quaternion
+        np.testing.assert_allclose(rodrigues_to_quaternions(self.RVECS), expected, atol=1e-12)
+        np.testing.assert_allclose(rodrigues_to_quaternions(self.RVECS.reshape(-1, 1, 3)), expected, atol=1e-12)
+
+    def test_quaternions_to_rodrigues_equals_cv2_rodrigues(self):
+        quaternions = rodrigues_to_quaternions(self.RVECS)
+        expected = np.array([cv2.Rodrigues(pyquaternion.Quaternion(q).rotation_matrix)[0].ravel()
+                             for q in quaternions])
+        np.testing.assert_allclose(quaternions_to_rodrigues(quaternions), expected, atol=1e-8)
+        # q and -q are the same rotation
+        np.testing.assert_allclose(quaternions_to_rodrigues(-quaternions), expected, atol=1e-8)
+
+    def test_round_trip(self):
+        rvecs = self.RVECS[:-3]
+        np.testing.assert_allclose(quaternions_to_rodrigues(rodrigues_to_quaternions(rvecs)), rvecs, atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,7 @@ from controller.settings import ControllerSettings
 from jobs.aeroCubeEvent import ResultEvent, AeroCubeEvent
 from jobs.aeroCubeJob import AeroCubeJob
 from jobs.jobHandler import JobHandler
+from jobs.jobJournal import JobJournal
 from jobs.settings import job_id_bundle_key
 from logger import Logger
 from tcpService.settings import TcpSettings
@@ -37,6 +38,8 @@ def initialize_endpoint():
     job_handler.set_job_dequeue_observer(on_dequeue_job)
     # Instantiate TcpClient
     client = get_tcp_client()
+    # Resume the jobs journaled before the last shutdown, now that events can be sent
+    job_handler.restore_jobs()
     # Instantiate Flask app
     app, api = create_flask_app()
     return job_handler, client, app, api
@@ -70,7 +73,7 @@ def get_job_handler():
     # Get _handler from outside function scope
     global _handler
     if _handler is None:
-        _handler = JobHandler()
+        _handler = JobHandler(journal=JobJournal(FlaskServerSettings.get_job_journal_path()))
     return _handler
 
 
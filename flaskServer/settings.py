@@ -4,6 +4,7 @@ import os
 class FlaskServerSettings():
     _static_img_rel_path = 'static/img/'
     _test_files_rel_path = 'test_files'
+    _job_journal_rel_path = 'journal/jobs.journal'
     _ip_addr = '127.0.0.1'
     _port = 3000
 
@@ -21,6 +22,11 @@ class FlaskServerSettings():
         return os.path.join(FlaskServerSettings.get_flask_server_dir(),
                             FlaskServerSettings._test_files_rel_path)
 
+    @staticmethod
+    def get_job_journal_path():
+        return os.path.join(FlaskServerSettings.get_flask_server_dir(),
+                            FlaskServerSettings._job_journal_rel_path)
+
     @staticmethod
     def IP_ADDR():
         return FlaskServerSettings._ip_addr
@@ -3,9 +3,11 @@ import time
 import uuid
 from abc import ABCMeta, abstractmethod
 
+import jobs.settings
 from jobs.settings import job_id_bundle_key
 from logger import Logger
 from .aeroCubeSignal import *
+from .binaryCodec import BinaryCodecError, encode_string, decode_string, encode_value, decode_value
 from .bundle import Bundle
 
 logger = Logger('aeroCubeEvent.py', active=True, external=True)
@@ -21,10 +23,20 @@ class AeroCubeEvent(metaclass=ABCMeta):
 
     _INVALID_SIGNAL_FOR_EVENT = 'Invalid signal for event'
     _INVALID_PAYLOAD_NOT_BUNDLE = 'Invalid payload, must be instance of Bundle'
+    _INVALID_CODEC = 'Invalid codec {}, must be one of {}'
+
+    # Codecs for encode; JSON is kept for compatibility, binary (see to_binary) is more compact and faster
+    CODEC_JSON = 'json'
+    CODEC_BINARY = 'binary'
+    _CODECS = (CODEC_JSON, CODEC_BINARY)
+
+    # Leading bytes of the binary form of an event (see to_binary); the last one is the format version
+    BINARY_MAGIC = b'ACE\x01'
 
     _ERROR_MESSAGES = (
         _INVALID_SIGNAL_FOR_EVENT,
-        _INVALID_PAYLOAD_NOT_BUNDLE
+        _INVALID_PAYLOAD_NOT_BUNDLE,
+        _INVALID_CODEC
     )
 
     def __init__(self, bundle, signal, created_at=None, id=None):
@@ -66,13 +78,83 @@ class AeroCubeEvent(metaclass=ABCMeta):
         }
         return json.dumps(json_dict)
 
+    def to_binary(self):
+        """
+        Compact binary representation of this event: its class name, signal, creation time and uuid, followed
+        by the payload's typed sections (see Bundle.write_binary), rather than the payload's JSON nested as a
+        string in another JSON document.
+        :return: bytes starting with BINARY_MAGIC
+        """
+        parts = [self.BINARY_MAGIC]
+        encode_string(self.__class__.__name__, parts)
+        encode_value(self._signal.value, parts)
+        encode_value(float(self._created_at), parts)
+        encode_string(self._uuid, parts)
+        self._payload.write_binary(parts)
+        return b''.join(parts)
+
+    def encode(self, codec=None):
+        """
+        Encodes this event with the given codec; decode (or the matching construct_from_*) reverses it
+        :raises AttributeError: if the codec is not one of _CODECS
+        :param codec: CODEC_JSON or CODEC_BINARY; defaults to jobs.settings.event_codec
+        :return: JSON string or bytes
+        """
+        codec = jobs.settings.event_codec if codec is None else codec
+        if codec == AeroCubeEvent.CODEC_JSON:
+            return self.to_json()
+        elif codec == AeroCubeEvent.CODEC_BINARY:
+            return self.to_binary()
+        else:
+            raise AttributeError(self._INVALID_CODEC.format(codec, AeroCubeEvent._CODECS))
+
+    @staticmethod
+    def decode(encoded_event):
+        """
+        Constructs an event encoded with either codec, told apart by the leading bytes of the binary form
+        :param encoded_event: JSON string, or bytes-like binary or UTF-8 JSON representation
+        :return: instance of the AeroCubeEvent subclass that was encoded
+        """
+        if isinstance(encoded_event, str):
+            return AeroCubeEvent.construct_from_json(encoded_event)
+        if bytes(encoded_event[:len(AeroCubeEvent.BINARY_MAGIC)]) == AeroCubeEvent.BINARY_MAGIC:
+            return AeroCubeEvent.construct_from_binary(encoded_event)
+        return AeroCubeEvent.construct_from_json(bytes(encoded_event).decode())
+
+    @staticmethod
+    def construct_from_binary(event_bytes):
+        """
+        Take the binary representation of an AeroCubeEvent (see to_binary) and construct a new event
+        :raises BinaryCodecError: if event_bytes is not the binary representation of an event
+        :param event_bytes: bytes-like binary representation
+        :return: instance of the AeroCubeEvent subclass that was encoded
+        """
+        view = memoryview(event_bytes)
+        offset = len(AeroCubeEvent.BINARY_MAGIC)
+        if bytes(view[:offset]) != AeroCubeEvent.BINARY_MAGIC:
+            raise BinaryCodecError('Not a binary AeroCubeEvent')
+        class_name, offset = decode_string(view, offset)
+        signal_int, offset = decode_value(view, offset)
+        created_at, offset = decode_value(view, offset)
+        uuid, offset = decode_string(view, offset)
+        bundle, _ = Bundle.read_binary(view, offset)
+        return AeroCubeEvent._construct(class_name, signal_int, created_at, uuid, bundle)
+
     @staticmethod
     def construct_from_json(event_json_str):
-        logger.debug(
-            AeroCubeEvent.__name__,
-            'construct_from_json',
-            msg='Constructing from json: \r\n{}\r\n'.format(event_json_str),
-            id=None)
+        """
+        Take a string JSON representation of an AeroCubeEvent and construct a new event. Only the envelope (class,
+        signal, creation time and uuid) is decoded here; the payload is decoded as its sections are first accessed
+        (see Bundle.construct_from_json).
+        :param event_json_str: string JSON representation
+        :return: instance of the AeroCubeEvent subclass that was encoded
+        """
+        if logger.is_enabled:
+            logger.debug(
+                AeroCubeEvent.__name__,
+                'construct_from_json',
+                msg='Constructing from json: \r\n{}\r\n'.format(event_json_str),
+                id=None)
         loaded = json.loads(event_json_str)
         signal_int = int(loaded['signal'])
         created_at = float(loaded['created_at'])
@@ -80,11 +162,19 @@ class AeroCubeEvent(metaclass=ABCMeta):
         bundle = Bundle.construct_from_json(payload)
         class_name = loaded['class']
         uuid = loaded['uuid']
-        logger.debug(
-            class_name=AeroCubeEvent.__name__,
-            func_name='construct_from_json',
-            msg='Constructing from json: \r\n{}\r\n'.format(event_json_str),
-            id=bundle.strings(job_id_bundle_key))
+        if logger.is_enabled:
+            logger.debug(
+                class_name=AeroCubeEvent.__name__,
+                func_name='construct_from_json',
+                msg='Constructing from json: \r\n{}\r\n'.format(event_json_str),
+                id=bundle.strings(job_id_bundle_key))
+        return AeroCubeEvent._construct(class_name, signal_int, created_at, uuid, bundle)
+
+    @staticmethod
+    def _construct(class_name, signal_int, created_at, uuid, bundle):
+        """
+        Constructs the AeroCubeEvent subclass named class_name from decoded fields, for either codec
+        """
         event = None
         if class_name == ImageEvent.__name__:
             signal = ImageEventSignal(signal_int)
@@ -1,10 +1,14 @@
 from .aeroCubeEvent import *
 from .aeroCubeSignal import ResultEventSignal
+from .binaryCodec import decode_value, encode_value
 from ImP.imageProcessing.aerocubeMarker import AeroCube
+from .jobQueue import JobPriority
 from .settings import job_id_bundle_key
 
 class AeroCubeJobEventNode:
     """
+    The next node for a result signal may also be a list of nodes, to fan out: the events of all of them are then
+    current at the same time, each starting a branch of the job (see AeroCubeJobJoinNode).
     :ivar _event
     :ivar _event_signal_map
     """
@@ -45,7 +49,7 @@ class AeroCubeJobEventNode:
         """
         next_event_node attempts to use a result_event to determine the next event_node
         :param result_event:
-        :return None
+        :return the next node, a list of nodes to fan out to, or None
         :raises LookupError if init is not updated to match potential result event signals
         """
         if not isinstance(result_event, ResultEvent):
@@ -57,20 +61,57 @@ class AeroCubeJobEventNode:
                               .format(result_event.signal, self._event.signal))
 
 
+class AeroCubeJobJoinNode(AeroCubeJobEventNode):
+    """
+    Barrier joining the branches of a fan-out: its event becomes current once every branch has either reached it
+    or ended (e.g., on an error with no error node). The payloads of the results that led to it are then merged
+    into its event (if the job is updated with merge_payload) in the order of the branches, not the order they
+    finished, so that later branches win on duplicate keys whatever the timing.
+    """
+
+
+class _Barrier(object):
+    """
+    A fan-out whose branches have not all reached its join node or ended
+    :ivar parent: _Barrier of the branch that fanned out, or None
+    :ivar index: index of the branch that fanned out within parent
+    :ivar pending: number of branches still running
+    :ivar join_node: the AeroCubeJobJoinNode reached by the branches, or None until one does
+    :ivar payloads: index of each branch that reached join_node -> payload to merge, or None
+    """
+    __slots__ = ('parent', 'index', 'pending', 'join_node', 'payloads')
+
+    def __init__(self, parent, index, pending):
+        self.parent = parent
+        self.index = index
+        self.pending = pending
+        self.join_node = None
+        self.payloads = {}
+
+
 class AeroCubeJob:
     """
     :ivar _root_event_node:
-    :ivar _current_node:
+    :ivar _branches: (node, _Barrier or None, index in the barrier) of each node whose event is current
+    :ivar _current_node: node of the first branch, or None once the job is finished
     :ivar _created_at:
     :ivar _uuid:
+    :ivar _priority: JobPriority, used by JobHandler to schedule the job
+    :ivar _deadline: time (in seconds since the Epoch) the job should be started by, or None
     """
 
-    def __init__(self, root_event_node, created_at=time.time(), id=None):
+    def __init__(self, root_event_node, created_at=None, id=None, priority=JobPriority.INTERACTIVE, deadline=None):
         if not isinstance(root_event_node, AeroCubeJobEventNode):
             raise AttributeError('Invalid event node parameter, must be instance of AeroCubeJobEventNode')
+        if not isinstance(priority, JobPriority):
+            raise AttributeError('Invalid priority parameter, must be instance of JobPriority')
         self._root_event_node = root_event_node
+        self._branches = [(root_event_node, None, 0)]
         self._current_node = root_event_node
-        self._created_at = created_at
+        # Defaults to the time of each call, rather than the time the module was loaded
+        self._created_at = created_at if created_at is not None else time.time()
+        self._priority = priority
+        self._deadline = deadline
         self._uuid = id if id is not None else \
             uuid.uuid5(uuid.NAMESPACE_OID, "{}-{}".format(self.__class__.__name__, self._created_at)).hex
 
@@ -94,6 +135,14 @@ class AeroCubeJob:
     def current_event(self):
         return self._current_node.event
 
+    @property
+    def current_events(self):
+        """
+        Get the events of every branch of the job, which may all be started at the same time
+        :return: list of events
+        """
+        return [node.event for node, _, _ in self._branches]
+
     @property
     def created_at(self):
         return self._created_at
@@ -102,44 +151,170 @@ class AeroCubeJob:
     def uuid(self):
         return self._uuid
 
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def deadline(self):
+        return self._deadline
+
     @property
     def is_finished(self):
         return self._current_node is None
 
     def update_current_node(self, result_event, merge_payload=False):
         """
-        Updates the current node property and returns the updated node's event.
-        If the current node is a leaf node, returns None
-        :param result_event: the result_event corresponding to the current node
+        Updates the branch whose current event the result_event answers, following its node to the next node, to
+        the nodes it fans out to, or to the join node of its fan-out. The job is finished once no branch is left.
+        :param result_event: the result_event corresponding to a current event
         :param merge_payload: if set to True, merges the bundle of the current bundle with the
             next node's event's bundle
+        :raises AttributeError: if result_event is not a ResultEvent for a current event, or merge_payload is set and
+            its payload is invalid; the job is then unchanged
         """
         # Check if event is a proper event (ResultEvent)
         if not isinstance(result_event, ResultEvent):
             raise AttributeError('AeroCubeJob.update_and_retrieve_next_event: ERROR: resolve_event requires a ResultEvent')
-        # Check if ResultEvent is for the current calling event
-        if self.current_event.uuid != result_event.payload.strings(ResultEvent.CALLING_EVENT_UUID):
-            raise AttributeError('AeroCubeJob.update_and_retrieve_next_event: ERROR: result event with CALLING_EVENT_UUID:{} received not for current calling event:{}'.format(result_event.payload.strings(ResultEvent.CALLING_EVENT_UUID), self.current_event.uuid))
+        # Check if ResultEvent is for a current calling event
+        calling_event_uuid = result_event.payload.strings(ResultEvent.CALLING_EVENT_UUID)
+        position = next((i for i, branch in enumerate(self._branches) if branch[0].event_uuid == calling_event_uuid),
+                        None)
+        if position is None:
+            raise AttributeError('AeroCubeJob.update_and_retrieve_next_event: ERROR: result event with CALLING_EVENT_UUID:{} received not for current calling event:{}'.format(calling_event_uuid, [e.uuid for e in self.current_events]))
+        node, barrier, index = self._branches[position]
+        next_node = node.next_event_node(result_event)
+        if merge_payload is True:
+            # Raises on invalid entries before the branch is moved, rather than while merging
+            result_event.payload.validate()
+        del self._branches[position]
         # Merge bundle if param is set to True before moving to next node
-        self._current_node = self._current_node.next_event_node(result_event)
-        if merge_payload is True and not self.is_finished:
-            self._current_node.event.merge_payload(result_event.payload)
+        payload = result_event.payload if merge_payload is True else None
+        self._follow(next_node, barrier, index, payload, position)
+        self._current_node = self._branches[0][0] if self._branches else None
+
+    def _follow(self, next_node, barrier, index, payload, position):
+        """
+        Moves a branch to next_node, inserting the resulting branches at position
+        """
+        if next_node is None or (isinstance(next_node, (list, tuple)) and len(next_node) == 0):
+            self._end_branch(barrier, position)
+        elif isinstance(next_node, (list, tuple)):
+            fan_out = _Barrier(barrier, index, len(next_node))
+            for i, child_node in enumerate(next_node):
+                if payload is not None:
+                    child_node.event.merge_payload(payload)
+                self._branches.insert(position + i, (child_node, fan_out, i))
+        elif isinstance(next_node, AeroCubeJobJoinNode) and barrier is not None:
+            if barrier.join_node is None:
+                barrier.join_node = next_node
+            elif barrier.join_node is not next_node:
+                raise AttributeError('AeroCubeJob: ERROR: branches of a fan-out must join at the same node')
+            barrier.payloads[index] = payload
+            self._end_branch(barrier, position)
+        else:
+            if payload is not None:
+                next_node.event.merge_payload(payload)
+            self._branches.insert(position, (next_node, barrier, index))
+
+    def _end_branch(self, barrier, position):
+        """
+        Counts a branch of barrier as done, continuing after the fan-out once all of its branches are
+        """
+        if barrier is None:
+            return
+        barrier.pending -= 1
+        if barrier.pending > 0:
+            return
+        if barrier.join_node is None:
+            # No branch reached a join node, so the branch that fanned out ends here
+            self._end_branch(barrier.parent, position)
+        else:
+            for i in sorted(barrier.payloads):
+                if barrier.payloads[i] is not None:
+                    barrier.join_node.event.merge_payload(barrier.payloads[i])
+            self._branches.insert(position, (barrier.join_node, barrier.parent, barrier.index))
+
+    def to_binary(self):
+        """
+        Binary representation of the job's graph of events as it stands (see AeroCubeEvent.to_binary), with nodes
+        reached from several branches (e.g., join nodes) written once. Progress through the graph is not encoded:
+        a decoded job starts at its root event, and is brought up to date by updating it with the same results
+        (see JobJournal).
+        :return: bytes
+        """
+        nodes = [self._root_event_node]
+        indices = {id(self._root_event_node): 0}
+        fields = []
+        # Nodes are numbered in the order first reached, so the root is always 0
+        for node in nodes:
+            next_indices = {}
+            for signal, next_node in node.event_signal_map.items():
+                next_nodes = next_node if isinstance(next_node, (list, tuple)) else [next_node]
+                for n in next_nodes:
+                    if n is not None and id(n) not in indices:
+                        indices[id(n)] = len(nodes)
+                        nodes.append(n)
+                if isinstance(next_node, (list, tuple)):
+                    next_indices[signal.name] = [indices[id(n)] for n in next_node]
+                else:
+                    next_indices[signal.name] = indices[id(next_node)] if next_node is not None else None
+            fields.append({
+                'event': node.event.to_binary(),
+                'join': isinstance(node, AeroCubeJobJoinNode),
+                'next': next_indices
+            })
+        parts = []
+        encode_value({
+            'uuid': self._uuid,
+            'created_at': self._created_at,
+            'priority': self._priority.value,
+            'deadline': self._deadline,
+            'nodes': fields
+        }, parts)
+        return b''.join(parts)
+
+    @staticmethod
+    def construct_from_binary(job_bytes):
+        """
+        Take the binary representation of an AeroCubeJob (see to_binary) and construct a new job, at its root event
+        :raises BinaryCodecError: if job_bytes is not the binary representation of a job
+        :param job_bytes: bytes-like binary representation
+        :return: instance of AeroCubeJob
+        """
+        fields, _ = decode_value(memoryview(job_bytes), 0)
+        nodes = [(AeroCubeJobJoinNode if node_fields['join'] else AeroCubeJobEventNode)(
+                 AeroCubeEvent.construct_from_binary(node_fields['event'])) for node_fields in fields['nodes']]
+        for node, node_fields in zip(nodes, fields['nodes']):
+            for signal_name, next_index in node_fields['next'].items():
+                if isinstance(next_index, list):
+                    next_node = [nodes[i] for i in next_index]
+                else:
+                    next_node = nodes[next_index] if next_index is not None else None
+                node.event_signal_map[ResultEventSignal[signal_name]] = next_node
+        return AeroCubeJob(nodes[0],
+                           created_at=fields['created_at'],
+                           id=fields['uuid'],
+                           priority=JobPriority(fields['priority']),
+                           deadline=fields['deadline'])
 
     # Constructors -- use to construct specific type of AeroCubeJobs
 
     @staticmethod
-    def create_image_upload_job(img_path, int_storage=False, ext_store_target=None):
+    def create_image_upload_job(img_path, int_storage=False, ext_store_target=None, priority=JobPriority.INTERACTIVE,
+                                deadline=None):
         # TODO: there has to be a more graceful way to do this
         # TODO: add error event nodes
         # TODO: add error handling for improper args?
         """
         Sequence of events
         1. ImageEvent - identify AeroCubes
-        2. StorageEvent - store internally
-        3. StorageEvent - store externally
+        2. StorageEvent - store internally and StorageEvent - store externally, in parallel if both are requested
         :param img_path:
         :param int_storage:
         :param ext_store_target:
+        :param priority: JobPriority of the job; uploads are interactive unless e.g. reprocessing archived images
+        :param deadline: time (in seconds since the Epoch) the job should be started by, or None
         :return:
         """
         # Create bundles and events in reverse order to build node tree
@@ -165,19 +340,19 @@ class AeroCubeJob:
                                                                                    'raws:' + AeroCube.STR_KEY_TVECS,
                                                                                    'raws:' + AeroCube.STR_KEY_DISTANCES,
                                                                                    'raws:' + AeroCube.STR_KEY_MARKERS_DETECTED])
-            int_store_event = StorageEvent(StorageEventSignal.STORE_INTERNALLY, int_store_bundle)
-            if ext_store_target is not None:
-                int_store_node = AeroCubeJobEventNode(int_store_event, ok_event_node=ext_store_node)
-            else:
-                int_store_node = AeroCubeJobEventNode(int_store_event)
+            int_store_node = AeroCubeJobEventNode(StorageEvent(StorageEventSignal.STORE_INTERNALLY, int_store_bundle))
         img_bundle = Bundle()
         img_bundle.insert_string(ImageEvent.FILE_PATH, img_path)
         img_event = ImageEvent(ImageEventSignal.IDENTIFY_AEROCUBES, img_bundle)
-        if int_storage is True:
-            img_node = AeroCubeJobEventNode(img_event, ok_event_node=int_store_node)
+        # The stores do not depend on each other, so fan out to both
+        store_nodes = [node for node in (int_store_node, ext_store_node) if node is not None]
+        if len(store_nodes) > 1:
+            img_node = AeroCubeJobEventNode(img_event, ok_event_node=store_nodes)
+        elif len(store_nodes) == 1:
+            img_node = AeroCubeJobEventNode(img_event, ok_event_node=store_nodes[0])
         else:
             img_node = AeroCubeJobEventNode(img_event)
-        job = AeroCubeJob(img_node)
+        job = AeroCubeJob(img_node, priority=priority, deadline=deadline)
         if ext_store_target is not None:
             ext_store_bundle.insert_string(job_id_bundle_key, job.uuid)
         if int_storage is not None:
@@ -0,0 +1,225 @@
+"""
+Compact binary encoding of the values held by Bundles and AeroCubeEvents.
+Each value is written as a one-byte type tag followed by its payload (little-endian):
+* N: None
+* T, F: True, False
+* i: 64-bit signed integer; I: integer too large for 64 bits, as a decimal string
+* d: 64-bit float
+* s: UTF-8 string; b: bytes (both prefixed by their length)
+* a: NumPy array, as its dtype string, shape and buffer, so that no conversion to nested lists is needed
+* h: jobs.sharedRaw.SharedRaw, as its segment name, dtype string and shape; decoding maps the segment
+* j: list, tuple or dict holding no arrays or bytes, as compact JSON text (the C JSON encoder and decoder are
+  much faster than walking plain data in Python), so tuples come back as lists and dict keys as strings
+* l: list; u: tuple (both prefixed by their length, then each element)
+* m: dict (prefixed by its length, then each key followed by its value)
+Other iterables (e.g., sets) are written as lists, as they would be in JSON.
+"""
+
+import json
+import struct
+from numbers import Integral, Real
+
+import numpy as np
+
+from .sharedRaw import SharedRaw
+
+_UINT8 = struct.Struct('<B')
+_UINT32 = struct.Struct('<I')
+_UINT64 = struct.Struct('<Q')
+_INT64 = struct.Struct('<q')
+_FLOAT64 = struct.Struct('<d')
+
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+# Raises TypeError on arrays, bytes and other values JSON cannot hold
+_json_encoder = json.JSONEncoder(check_circular=False, separators=(',', ':'))
+
+
+class BinaryCodecError(Exception):
+    def __init__(self, message):
+        super(BinaryCodecError, self).__init__(message)
+
+
+def encode_length(length, parts):
+    """
+    Appends a length (e.g., of a container, without type tag) to parts
+    :param length: a non-negative integer below 2 ** 32
+    :param parts: list of bytes-like objects, joined once the whole message is encoded
+    """
+    parts.append(_UINT32.pack(length))
+
+
+def decode_length(view, offset):
+    """
+    :param view: memoryview of the message
+    :param offset: position of the length in view
+    :return: (length, offset past the length)
+    """
+    return _UINT32.unpack_from(view, offset)[0], offset + _UINT32.size
+
+
+def encode_string(string, parts):
+    """
+    Appends a length-prefixed UTF-8 string (without type tag) to parts
+    :param string: a string
+    :param parts: list of bytes-like objects, joined once the whole message is encoded
+    """
+    data = string.encode()
+    parts.append(_UINT32.pack(len(data)))
+    parts.append(data)
+
+
+def decode_string(view, offset):
+    """
+    :param view: memoryview of the message
+    :param offset: position of the string in view
+    :return: (string, offset past the string)
+    """
+    length, = _UINT32.unpack_from(view, offset)
+    offset += _UINT32.size
+    return str(view[offset:offset + length], 'utf-8'), offset + length
+
+
+def encode_value(value, parts):
+    """
+    Appends a tagged value to parts
+    :raises BinaryCodecError: if the value (or an element of it) cannot be encoded
+    :param value: None, bool, number, string, bytes, NumPy array, SharedRaw, or list, tuple, dict or iterable of those
+    :param parts: list of bytes-like objects, joined once the whole message is encoded
+    """
+    if value is None:
+        parts.append(b'N')
+    elif isinstance(value, (bool, np.bool_)):
+        parts.append(b'T' if value else b'F')
+    elif isinstance(value, Integral):
+        value = int(value)
+        if _INT64_MIN <= value <= _INT64_MAX:
+            parts.append(b'i')
+            parts.append(_INT64.pack(value))
+        else:
+            parts.append(b'I')
+            encode_string(str(value), parts)
+    elif isinstance(value, Real):
+        parts.append(b'd')
+        parts.append(_FLOAT64.pack(value))
+    elif isinstance(value, str):
+        parts.append(b's')
+        encode_string(value, parts)
+    elif isinstance(value, (bytes, bytearray)):
+        parts.append(b'b')
+        parts.append(_UINT64.pack(len(value)))
+        parts.append(value)
+    elif isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        array = np.ascontiguousarray(value)
+        parts.append(b'a')
+        encode_string(array.dtype.str, parts)
+        parts.append(_UINT8.pack(array.ndim))
+        parts.append(struct.pack('<{}Q'.format(array.ndim), *array.shape))
+        parts.append(_UINT64.pack(array.nbytes))
+        # The array's own buffer is joined into the message, without an intermediate copy
+        parts.append(memoryview(array).cast('B') if array.nbytes > 0 else b'')
+    elif isinstance(value, SharedRaw):
+        parts.append(b'h')
+        encode_string(value.name, parts)
+        encode_string(value.dtype.str, parts)
+        parts.append(_UINT8.pack(len(value.shape)))
+        parts.append(struct.pack('<{}Q'.format(len(value.shape)), *value.shape))
+    elif isinstance(value, (dict, list, tuple)) and _encode_json(value, parts):
+        pass
+    elif isinstance(value, dict):
+        parts.append(b'm')
+        parts.append(_UINT32.pack(len(value)))
+        for k, v in value.items():
+            encode_value(k, parts)
+            encode_value(v, parts)
+    elif isinstance(value, (list, tuple, np.ndarray)) or hasattr(value, '__iter__'):
+        items = value.tolist() if isinstance(value, np.ndarray) else value
+        items = items if isinstance(items, (list, tuple)) else list(items)
+        parts.append(b'u' if isinstance(items, tuple) else b'l')
+        parts.append(_UINT32.pack(len(items)))
+        for item in items:
+            encode_value(item, parts)
+    else:
+        raise BinaryCodecError('Cannot encode value of type {}'.format(type(value).__name__))
+
+
+def _encode_json(value, parts):
+    """
+    Appends a container as tagged JSON text to parts, if JSON can hold all of it
+    :return: True if appended, False if the container must be walked instead (e.g., it holds arrays)
+    """
+    try:
+        text = _json_encoder.encode(value)
+    except (TypeError, ValueError):
+        return False
+    parts.append(b'j')
+    encode_string(text, parts)
+    return True
+
+
+def decode_value(view, offset):
+    """
+    :raises BinaryCodecError: if the type tag is unknown
+    :param view: memoryview of the message
+    :param offset: position of the tagged value in view
+    :return: (value, offset past the value)
+    """
+    tag = view[offset]
+    offset += 1
+    if tag == 0x4E:  # N
+        return None, offset
+    elif tag == 0x54:  # T
+        return True, offset
+    elif tag == 0x46:  # F
+        return False, offset
+    elif tag == 0x69:  # i
+        return _INT64.unpack_from(view, offset)[0], offset + _INT64.size
+    elif tag == 0x49:  # I
+        string, offset = decode_string(view, offset)
+        return int(string), offset
+    elif tag == 0x64:  # d
+        return _FLOAT64.unpack_from(view, offset)[0], offset + _FLOAT64.size
+    elif tag == 0x73:  # s
+        return decode_string(view, offset)
+    elif tag == 0x62:  # b
+        length, = _UINT64.unpack_from(view, offset)
+        offset += _UINT64.size
+        return bytes(view[offset:offset + length]), offset + length
+    elif tag == 0x6A:  # j
+        text, offset = decode_string(view, offset)
+        return json.loads(text), offset
+    elif tag == 0x61:  # a
+        dtype, offset = decode_string(view, offset)
+        ndim, = _UINT8.unpack_from(view, offset)
+        offset += _UINT8.size
+        shape = struct.unpack_from('<{}Q'.format(ndim), view, offset)
+        offset += ndim * _UINT64.size
+        nbytes, = _UINT64.unpack_from(view, offset)
+        offset += _UINT64.size
+        # Copied out of the message, so that decoded arrays are writeable and do not keep the message alive
+        array = np.frombuffer(view[offset:offset + nbytes], dtype=np.dtype(dtype)).reshape(shape).copy()
+        return array, offset + nbytes
+    elif tag == 0x68:  # h
+        name, offset = decode_string(view, offset)
+        dtype, offset = decode_string(view, offset)
+        ndim, = _UINT8.unpack_from(view, offset)
+        offset += _UINT8.size
+        shape = struct.unpack_from('<{}Q'.format(ndim), view, offset)
+        return SharedRaw(name, dtype, shape), offset + ndim * _UINT64.size
+    elif tag == 0x6D:  # m
+        length, = _UINT32.unpack_from(view, offset)
+        offset += _UINT32.size
+        result = dict()
+        for _ in range(length):
+            k, offset = decode_value(view, offset)
+            result[k], offset = decode_value(view, offset)
+        return result, offset
+    elif tag == 0x6C or tag == 0x75:  # l, u
+        length, = _UINT32.unpack_from(view, offset)
+        offset += _UINT32.size
+        items = [None] * length
+        for i in range(length):
+            items[i], offset = decode_value(view, offset)
+        return (tuple(items) if tag == 0x75 else items), offset
+    else:
+        raise BinaryCodecError('Unknown type tag {!r} at offset {}'.format(chr(tag), offset - 1))
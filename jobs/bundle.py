@@ -1,8 +1,13 @@
-import collections
+import collections.abc
+import functools
 import json
+import re
 from numbers import Number
 
 from logger import Logger
+from .binaryCodec import BinaryCodecError, encode_length, decode_length, encode_string, decode_string, \
+    encode_value, decode_value
+from .sharedRaw import SharedRaw
 
 logger = Logger('bundle.py', active=True, external=False)
 
@@ -13,10 +18,15 @@ class BundleKeyError(Exception):
 
 class Bundle(object):
     """
+    A Bundle from construct_from_json starts with only its JSON, and materializes each section (parsing the JSON
+    up to that section, then validating its keys) when it is first accessed.
     :ivar _strings:
     :ivar _numbers:
     :ivar _raws:
     :ivar _iterables:
+    :ivar _pending_json: JSON string the sections not materialized yet come from, or None
+    :ivar _pending_offset: position in _pending_json past the sections parsed so far
+    :ivar _pending_sections: sections parsed but not materialized yet
     """
 
     _IMPROPER_KEY_FORMAT_STRING = "{} is not properly formatted"
@@ -26,6 +36,16 @@ class Bundle(object):
     _INCORRECT_TYPE_RAW_IS_STRING = 'Not raw data, found string'
     _INCORRECT_TYPE_RAW_IS_NUMBER = 'Not raw data, found number'
 
+    # Leading bytes of the binary form of a Bundle (see to_binary); the last one is the format version
+    BINARY_MAGIC = b'ACB\x01'
+
+    # Attribute and JSON names of the sections, in the order they are serialized
+    _SECTIONS = (('_strings', 'strings'), ('_numbers', 'numbers'), ('_raws', 'raws'), ('_iterables', 'iterables'))
+    _SECTION_ATTRIBUTES = dict((json_name, attr) for attr, json_name in _SECTIONS)
+    # Opening of the object or separator, then the name of the next section in a JSON Bundle
+    _JSON_SECTION_NAME = re.compile(r'\s*[{,]\s*"(\w+)"\s*:\s*')
+    _json_decoder = json.JSONDecoder()
+
     _ERROR_MESSAGES = (
         _IMPROPER_KEY_FORMAT_STRING,
         _INCORRECT_TYPE_STRING,
@@ -40,6 +60,78 @@ class Bundle(object):
         self._numbers = {}
         self._raws = {}
         self._iterables = {}
+        self._pending_json = None
+        self._pending_offset = 0
+        self._pending_sections = {}
+
+    def __getattr__(self, name):
+        """
+        Only called for attributes that are not set, i.e., sections of a Bundle from construct_from_json that have
+        not been accessed yet
+        :raises AttributeError: if name is not a section, or the section has invalid keys or values
+        """
+        if name not in Bundle._SECTION_ATTRIBUTES.values() or '_pending_sections' not in self.__dict__:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, name))
+        return self._materialize_section(name)
+
+    def _parse_sections_until(self, name):
+        """
+        Parses the sections of _pending_json in order until the given one, so that e.g. the strings, which come
+        first, are read without parsing the raws. Parses the whole JSON if it is laid out otherwise.
+        :raises KeyError: if the JSON has no such section
+        :param name: attribute name of the section, e.g., '_raws'
+        """
+        bundle_json = self._pending_json
+        while name not in self._pending_sections:
+            match = Bundle._JSON_SECTION_NAME.match(bundle_json, self._pending_offset)
+            if match is None or match.group(1) not in Bundle._SECTION_ATTRIBUTES:
+                loaded = json.loads(bundle_json)
+                for attr, json_name in Bundle._SECTIONS:
+                    if attr not in self.__dict__ and attr not in self._pending_sections:
+                        self._pending_sections[attr] = loaded[json_name]
+                break
+            value, self._pending_offset = Bundle._json_decoder.raw_decode(bundle_json, match.end())
+            self._pending_sections[Bundle._SECTION_ATTRIBUTES[match.group(1)]] = value
+
+    def _materialize_section(self, name):
+        """
+        Validates the entries of one pending section and sets it as an attribute. If an entry is invalid, the
+        section stays pending, so that every access raises.
+        :raises AttributeError: if the section has invalid keys or values
+        :param name: attribute name of the section, e.g., '_raws'
+        :return: the section's dict
+        """
+        self._parse_sections_until(name)
+        entries = self._pending_sections[name]
+        # Validated into a scratch Bundle, leaving this one unchanged on failure
+        scratch = Bundle()
+        insert = {
+            '_strings': scratch.insert_string,
+            '_numbers': scratch.insert_number,
+            '_raws': scratch._insert_raw_from_json,
+            '_iterables': scratch.insert_iterable
+        }[name]
+        for key in entries.keys():
+            insert(key, entries[key])
+        section = getattr(scratch, name)
+        del self._pending_sections[name]
+        setattr(self, name, section)
+        if all(attr in self.__dict__ for attr, _ in Bundle._SECTIONS):
+            # Every section is materialized, so the JSON is no longer needed
+            self._pending_json = None
+        return section
+
+    def validate(self):
+        """
+        Materializes every section not accessed yet (see construct_from_json), so that invalid entries are
+        reported before the Bundle is used, e.g., merged into another one
+        :raises AttributeError: if a section has invalid keys or values
+        """
+        for attr, _ in Bundle._SECTIONS:
+            getattr(self, attr)
+
+    def _insert_raw_from_json(self, key, value):
+        self.insert_raw(key, SharedRaw.from_handle(value) if SharedRaw.is_handle(value) else value)
 
     def __eq__(self, other):
         """
@@ -68,66 +160,131 @@ class Bundle(object):
             'raws': self._raws,
             'iterables': self._iterables
         }
-        strings = json.dumps(self._strings)
-        numbers = json.dumps(self._numbers)
-        raws = json.dumps(self._raws)
-        iterables = json.dumps(self._iterables)
         return str(structure)
 
     def to_json(self):
+        # Untouched Bundles from construct_from_json (e.g., forwarded payloads) are already serialized
+        if self._pending_json is not None and not any(attr in self.__dict__ for attr, _ in Bundle._SECTIONS):
+            return self._pending_json
         json_dict = {
             'strings': self._strings,
             'numbers': self._numbers,
             'raws': self._raws,
             'iterables': self._iterables
         }
-        strings = json.dumps(self._strings)
-        numbers = json.dumps(self._numbers)
-        raws = json.dumps(self._raws)
-        iterables = json.dumps(self._iterables)
-        return json.dumps(json_dict)
+        return json.dumps(json_dict, default=Bundle._json_default)
 
     @staticmethod
-    def construct_from_json(bundle_json_string):
+    def _json_default(value):
         """
-        Take a string JSON representation of a Bundle instance and construct a
-        new Bundle
-        :param bundle_json_string: string JSON representation
-        :return: instance of Bundle()
+        Serializes the values json cannot: SharedRaws as their handle
+        :raises TypeError: for any other value
         """
-        bundle = Bundle()
-        logger.debug(
-            Bundle.__name__,
-            func_name='construct_from_json',
-            msg='Constructing bundle from json: \r\n{}\r\n'.format(bundle_json_string),
-            id=None)
-        loaded = json.loads(bundle_json_string)
+        if isinstance(value, SharedRaw):
+            return value.handle
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
 
-        new_strings = loaded['strings']
-        for key in new_strings.keys():
-            bundle.insert_string(key, new_strings[key])
+    def to_binary(self):
+        """
+        Compact binary representation of this Bundle, which unlike JSON carries NumPy arrays (e.g., marker
+        corners) as their dtype, shape and buffer, and bytes as is. See jobs.binaryCodec for the value encoding.
+        :return: bytes starting with BINARY_MAGIC
+        """
+        parts = [self.BINARY_MAGIC]
+        self.write_binary(parts)
+        return b''.join(parts)
 
-        new_numbers = loaded['numbers']
-        for key in new_numbers.keys():
-            bundle.insert_number(key, new_numbers[key])
+    def write_binary(self, parts):
+        """
+        Appends the typed sections of this Bundle to parts, in the order strings, numbers, raws, iterables.
+        Each section is its number of entries followed by each key and value; string values are untagged.
+        :param parts: list of bytes-like objects, joined once the whole message is encoded
+        """
+        encode_length(len(self._strings), parts)
+        for key, value in self._strings.items():
+            encode_string(key, parts)
+            encode_string(value, parts)
+        for section in (self._numbers, self._raws, self._iterables):
+            encode_length(len(section), parts)
+            for key, value in section.items():
+                encode_string(key, parts)
+                encode_value(value, parts)
 
-        new_raws = loaded['raws']
-        for key in new_raws.keys():
-            bundle.insert_raw(key, new_raws[key])
+    @staticmethod
+    def construct_from_binary(bundle_bytes):
+        """
+        Take the binary representation of a Bundle instance (see to_binary) and construct a new Bundle
+        :raises BinaryCodecError: if bundle_bytes is not the binary representation of a Bundle
+        :param bundle_bytes: bytes-like binary representation
+        :return: instance of Bundle()
+        """
+        view = memoryview(bundle_bytes)
+        if bytes(view[:len(Bundle.BINARY_MAGIC)]) != Bundle.BINARY_MAGIC:
+            raise BinaryCodecError('Not a binary Bundle')
+        bundle, _ = Bundle.read_binary(view, len(Bundle.BINARY_MAGIC))
+        return bundle
 
-        new_iterables = loaded['iterables']
-        for key in new_iterables.keys():
-            bundle.insert_iterable(key, new_iterables[key])
+    @staticmethod
+    def read_binary(view, offset):
+        """
+        Reads the typed sections written by write_binary, inserting each entry as construct_from_json does
+        :param view: memoryview of the message
+        :param offset: position of the sections in view
+        :return: (instance of Bundle(), offset past the sections)
+        """
+        bundle = Bundle()
+        length, offset = decode_length(view, offset)
+        for _ in range(length):
+            key, offset = decode_string(view, offset)
+            value, offset = decode_string(view, offset)
+            bundle.insert_string(key, value)
+        for insert in (bundle.insert_number, bundle.insert_raw, bundle.insert_iterable):
+            length, offset = decode_length(view, offset)
+            for _ in range(length):
+                key, offset = decode_string(view, offset)
+                value, offset = decode_value(view, offset)
+                insert(key, value)
+        return bundle, offset
 
+    @staticmethod
+    def construct_from_json(bundle_json_string):
+        """
+        Take a string JSON representation of a Bundle instance and construct a
+        new Bundle. Parsing and validation are deferred until a section is first
+        accessed, so a payload that is only routed or forwarded is never decoded.
+        :param bundle_json_string: string JSON representation
+        :return: instance of Bundle()
+        """
+        if logger.is_enabled:
+            logger.debug(
+                Bundle.__name__,
+                func_name='construct_from_json',
+                msg='Constructing bundle from json: \r\n{}\r\n'.format(bundle_json_string),
+                id=None)
+        bundle = Bundle.__new__(Bundle)
+        bundle._pending_json = bundle_json_string
+        bundle._pending_offset = 0
+        bundle._pending_sections = {}
         return bundle
 
     @staticmethod
     def is_valid_key(key):
         """
-        is_valid_key defines valid keys to be uppercase characters and underscores only
+        is_valid_key defines valid keys to be strings of uppercase characters and underscores only.
         :param key: a potential key
         :return: validity of the key
         """
+        # Checked before the cache, which cannot hash e.g. lists
+        return isinstance(key, str) and Bundle._is_valid_str_key(key)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _is_valid_str_key(key):
+        """
+        Results are cached, as the same few keys are checked on every access.
+        :param key: a string
+        :return: validity of the key
+        """
         for c in key:
             if c != '_' and not c.isalpha():
                 return False
@@ -280,7 +437,7 @@ class Bundle(object):
         if not Bundle.is_valid_key(key):
             raise AttributeError(self._IMPROPER_KEY_FORMAT_STRING.format(key))
 
-        if isinstance(value, collections.Iterable):
+        if isinstance(value, collections.abc.Iterable):
             self._iterables[key] = value
         else:
             raise AttributeError(self._INCORRECT_TYPE_ITERABLE)
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from .aeroCubeEvent import ImageEvent, ResultEvent
+from .aeroCubeSignal import ResultEventSignal
+from .bundle import Bundle, BundleKeyError
+from .settings import job_id_bundle_key
+
+
+class JobCoalescer(object):
+    """
+    Coalesces jobs scanning the same image, so that retried uploads and repeated stream notifications are scanned
+    once. A job is fingerprinted by the content of the file at its root ImageEvent's FILE_PATH, the signal of that
+    event and the rest of its payload (detection parameters), plus the params given to the coalescer: these must
+    cover what the scan depends on outside the payload, e.g., the camera calibration in use. The first job with a
+    fingerprint is scanned as usual; later ones are attached to it until its root event is resolved, and then given
+    a copy of its result, addressed to their own root event and with their own SCAN_ID. OK results are kept for
+    window seconds (at most max_entries of them) for jobs enqueued after the scan finished. Only the root event is
+    shared: the rest of each job (e.g., storage) runs on its own.
+    :ivar _window: seconds an OK result is reused after it is received
+    :ivar _max_entries: maximum number of results kept
+    :ivar _params: dict of parameters included in every fingerprint
+    :ivar _recent: fingerprint -> (time received, ResultEvent), oldest first
+    :ivar _primaries: fingerprint -> the job being scanned for it
+    :ivar _followers: id of each primary job -> jobs attached to it, in the order attached
+    :ivar _fingerprints: id of each primary job -> its fingerprint
+    """
+
+    DEFAULT_WINDOW = 300.
+    DEFAULT_MAX_ENTRIES = 64
+    # Read files in chunks, so that large images are not held in memory twice
+    _CHUNK_SIZE = 1 << 20
+    # Payload keys that identify a job rather than what is scanned
+    _IGNORED_KEYS = (ImageEvent.FILE_PATH, job_id_bundle_key)
+
+    def __init__(self, window=None, max_entries=None, params=None):
+        """
+        :param window: seconds an OK result is reused, defaults to DEFAULT_WINDOW
+        :param max_entries: maximum number of results kept, defaults to DEFAULT_MAX_ENTRIES
+        :param params: JSON-serializable dict of parameters included in every fingerprint
+        """
+        self._window = JobCoalescer.DEFAULT_WINDOW if window is None else window
+        self._max_entries = JobCoalescer.DEFAULT_MAX_ENTRIES if max_entries is None else max_entries
+        self._params = params if params is not None else {}
+        self._recent = OrderedDict()
+        self._primaries = {}
+        self._followers = {}
+        self._fingerprints = {}
+
+    def __len__(self):
+        """
+        :return: number of jobs attached to a job being scanned
+        """
+        return sum(len(followers) for followers in self._followers.values())
+
+    def __contains__(self, job):
+        """
+        :return: True if job is attached to a job being scanned
+        """
+        return any(job is follower for followers in self._followers.values() for follower in followers)
+
+    def __iter__(self):
+        """
+        Iterates over the jobs attached to a job being scanned
+        """
+        return iter([follower for followers in self._followers.values() for follower in followers])
+
+    def fingerprint(self, job):
+        """
+        :param job: an AeroCubeJob
+        :return: hex digest identifying the scan of job's root event, or None if it cannot be coalesced (its root
+            event is not an ImageEvent, or has no readable file)
+        """
+        event = job.root_event
+        if not isinstance(event, ImageEvent):
+            return None
+        try:
+            file_path = event.payload.strings(ImageEvent.FILE_PATH)
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(JobCoalescer._CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        except (BundleKeyError, OSError, TypeError):
+            return None
+        params = {
+            'signal': str(event.signal),
+            'params': self._params,
+            'payload': [{k: v for k, v in section.items() if k not in JobCoalescer._IGNORED_KEYS}
+                        for section in (event.payload.strings(), event.payload.numbers(),
+                                        event.payload.iterables())]
+        }
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def coalesce(self, job, now=None):
+        """
+        Checks a new job against the jobs being scanned and the results kept
+        :param job: an AeroCubeJob not yet queued
+        :param now: time in seconds since the Epoch; defaults to time.time()
+        :return: (ResultEvent for job's root event or None, True if job was attached to a job being scanned). If
+            neither, job is to be scanned as usual.
+        """
+        fingerprint = self.fingerprint(job)
+        if fingerprint is None:
+            return None, False
+        self._drop_expired(time.time() if now is None else now)
+        recent = self._recent.get(fingerprint)
+        if recent is not None:
+            return JobCoalescer._copy_result(recent[1], job), False
+        primary = self._primaries.get(fingerprint)
+        if primary is not None:
+            self._followers[id(primary)].append(job)
+            return None, True
+        self._primaries[fingerprint] = job
+        self._followers[id(job)] = []
+        self._fingerprints[id(job)] = fingerprint
+        return None, False
+
+    def resolve(self, job, result_event, now=None):
+        """
+        Records the result of a job's root event, keeping it if OK, and detaches the jobs attached to it
+        :param job: an AeroCubeJob
+        :param result_event: ResultEvent of job's root event
+        :param now: time in seconds since the Epoch; defaults to time.time()
+        :return: the jobs that were attached to job, to be coalesced again (and so given the result, if kept)
+        """
+        fingerprint = self._fingerprints.get(id(job))
+        if fingerprint is None:
+            return []
+        if result_event.signal == ResultEventSignal.OK and self._max_entries > 0 and self._window > 0:
+            self._recent.pop(fingerprint, None)
+            self._recent[fingerprint] = (time.time() if now is None else now, result_event)
+            while len(self._recent) > self._max_entries:
+                self._recent.popitem(last=False)
+        return self.discard(job)
+
+    def discard(self, job):
+        """
+        Forgets a job, e.g., when it is dequeued
+        :param job: an AeroCubeJob
+        :return: the jobs that were attached to job, to be coalesced again
+        """
+        for followers in self._followers.values():
+            for i, follower in enumerate(followers):
+                if follower is job:
+                    del followers[i]
+                    return []
+        fingerprint = self._fingerprints.pop(id(job), None)
+        if fingerprint is None:
+            return []
+        del self._primaries[fingerprint]
+        return self._followers.pop(id(job))
+
+    def clear(self):
+        self._recent.clear()
+        self._primaries.clear()
+        self._followers.clear()
+        self._fingerprints.clear()
+
+    def _drop_expired(self, now):
+        while self._recent:
+            received_at, _ = next(iter(self._recent.values()))
+            if now - received_at < self._window:
+                break
+            self._recent.popitem(last=False)
+
+    @staticmethod
+    def _copy_result(result_event, job):
+        """
+        :return: a copy of result_event answering job's root event, with job's own id, file path and scan id; raws
+            are shared, not copied
+        """
+        bundle = Bundle()
+        bundle.merge_from_bundle(result_event.payload)
+        bundle.insert_string(job_id_bundle_key, job.uuid)
+        root_payload = job.root_event.payload
+        bundle.insert_string(ImageEvent.FILE_PATH, root_payload.strings(ImageEvent.FILE_PATH))
+        # As the controller names a scan, so that each job stores its result under its own scan
+        bundle.insert_string(ImageEvent.SCAN_ID, str(job.root_event.created_at).split('.')[0])
+        return ResultEvent(result_event.signal, job.root_event.uuid, bundle=bundle)
@@ -1,9 +1,13 @@
-from collections import deque
+from collections import OrderedDict
 
 from logger import Logger
+from .aeroCubeEvent import ResultEvent
 from .aeroCubeJob import AeroCubeJob
 from .aeroCubeSignal import *
+from .jobJournal import JobJournalError
+from .jobQueue import JobQueue
 from .settings import job_id_bundle_key
+from .sharedRaw import SharedRaw
 
 logger = Logger('jobHandler.py', active=True, external=True)
 
@@ -17,15 +21,30 @@ class JobHandler(object):
     For all other operations, JobHandler will return None if an operation is
     improperly used (e.g., if dequeue_event is called on an JobHandler with
     no events).
-    :ivar _job_deque: queue-style structure that stores incoming events
+    Up to max_in_flight events are started before any result is received, so that a slow event (e.g., an external
+    upload) does not hold back other jobs; the events of one job are started in order, except that the branches of
+    a fan-out (see AeroCubeJob) may be in flight together. Results are matched to their event by
+    ResultEvent.CALLING_EVENT_UUID.
+    Jobs are scheduled by priority and deadline (see JobQueue), so that e.g. interactive scans do not wait behind
+    reprocessing of archived images.
+    With a JobCoalescer, jobs scanning the same image (e.g., retried uploads) are coalesced, so that the image is
+    scanned once and each job is given its own copy of the result (see JobCoalescer).
+    With a JobJournal, every job enqueued, result resolved and job dequeued is recorded, so that the jobs not finished
+    can be restored after a restart (see restore_jobs). A job's enqueue is durable before any of its events is
+    started; results are recorded once applied without waiting, an event whose result was lost being started again.
+    :ivar _job_queue: JobQueue of the jobs with a current event not yet started
+    :ivar _in_flight: uuid of each started, unresolved event -> (its job, the event), in the order started
+    :ivar _last_added_job: the most recently enqueued job
+    :ivar _coalescer: JobCoalescer holding the jobs waiting on the scan of another job, or None
+    :ivar _journal: JobJournal recording the jobs, or None
+    :ivar _max_in_flight: maximum number of started, unresolved events
     :ivar _on_start_event: function handler for "on_start_event"
     :ivar _on_job_enqueue: function handler for "on_enqueue"
     :ivar _on_job_dequeue: function handler for "on_dequeue"
     :ivar _state: state chosen from inner class State that controls how incoming events are dealt with
+    :ivar _sending: True while _start_sending_events is starting events
     """
 
-    # TODO: Structure for Event Priorities
-
     class NotAllowedInStateException(Exception):
         """
         NotAllowedInStateException is thrown when a function is called that is not permitted in the current JobHandler
@@ -35,21 +54,39 @@ class JobHandler(object):
             super(JobHandler.NotAllowedInStateException, self).__init__(message)
 
     class State(Enum):
-        # Ready to receive & start events
+        # Ready to receive & start events; events may be in flight, but fewer than max_in_flight
         STARTED                     = 0x0000aaaa
-        # Waiting for results
+        # max_in_flight events in flight, waiting for a result before starting another
         PENDING                     = 0x0000bbbb
         # Paused
         STOPPED                     = 0x0000cccc
-        # Will Stop After Current Event Resolved
+        # Will Stop After Events In Flight Resolved
         PENDING_STOP_ON_RESOLVE     = 0x0000dddd
 
-    def __init__(self, start_event_observer=None, job_enqueue_observer=None, job_dequeue_observer=None):
-        self._job_deque = deque()
+    def __init__(self, start_event_observer=None, job_enqueue_observer=None, job_dequeue_observer=None,
+                 max_in_flight=1, aging=None, coalescer=None, journal=None):
+        """
+        :param max_in_flight: maximum number of events started but not resolved, across different jobs
+        :param aging: JobPriority -> aging delay in seconds, overriding JobQueue.DEFAULT_AGING
+        :param coalescer: JobCoalescer for jobs scanning the same image, or None to scan every job. Its params must
+            cover whatever else the scan depends on (e.g., the camera calibration in use).
+        :param journal: JobJournal to record the jobs in, or None
+        """
+        if max_in_flight < 1:
+            raise AttributeError('max_in_flight must be at least 1')
+        self._job_queue = JobQueue(aging)
+        self._in_flight = OrderedDict()
+        self._last_added_job = None
+        self._coalescer = coalescer
+        self._journal = journal
+        self._max_in_flight = max_in_flight
         self._on_start_event = start_event_observer
         self._on_job_enqueue = job_enqueue_observer
         self._on_job_dequeue = job_dequeue_observer
         self._state = JobHandler.State.STARTED
+        self._sending = False
+        # Jobs are dequeued, and so their shared memory raws released, in this process
+        SharedRaw.register_owner_process()
 
     # setters for function handlers
 
@@ -93,7 +130,7 @@ class JobHandler(object):
 
     def enqueue_job(self, job):
         """
-        Adds a new job
+        Adds a new job, recording it in the journal (if any) before starting its first event
         :param job: the new job to be added
         :return:
         """
@@ -102,14 +139,26 @@ class JobHandler(object):
             func_name='enqueue_job',
             msg='Enqueued job: \r\n{}\r\n'.format(job),
             id=job.uuid)
-        if JobHandler.is_valid_element(job):
-            self._job_deque.append(job)
-        else:
+        if not JobHandler.is_valid_element(job):
             raise TypeError("Attempted to queue invalid object to JobHandler")
+        self._last_added_job = job
+        if self._journal is not None:
+            self._journal.record_enqueue(job)
+            # Write-ahead: concurrent enqueues share the fsync (see JobJournal)
+            try:
+                self._journal.sync()
+            except JobJournalError as e:
+                # The record is still retried, so the job is accepted
+                logger.err(
+                    self.__class__.__name__,
+                    func_name='enqueue_job',
+                    msg=e,
+                    id=job.uuid)
         # Try to restart the sending process on enqueue
         try:
             if self._on_job_enqueue is not None:
                 self._on_job_enqueue(job)
+            self._admit_job(job)
             if self._state == JobHandler.State.STARTED or self._state == JobHandler.State.STOPPED:
                 self._state = JobHandler.State.STARTED
                 self._start_sending_events()
@@ -122,6 +171,35 @@ class JobHandler(object):
                 msg=e,
                 id=job.uuid)
 
+    def restore_jobs(self):
+        """
+        Schedules the jobs recovered by the journal, at the node(s) they had reached. Events in flight when the
+        process stopped are started again, as their results were not recorded.
+        Precondition: observers are set, and no job has been enqueued since the journal was opened
+        :return: the restored jobs
+        """
+        if self._journal is None:
+            return []
+        jobs = self._journal.recovered_jobs
+        for job in jobs:
+            self._last_added_job = job
+            self._admit_job(job)
+        if len(jobs) > 0 and self._state == JobHandler.State.STARTED:
+            try:
+                self._start_sending_events()
+            except JobHandler.NotAllowedInStateException as e:
+                logger.err(
+                    self.__class__.__name__,
+                    func_name='restore_jobs',
+                    msg=e,
+                    id=None)
+        logger.debug(
+            self.__class__.__name__,
+            func_name='restore_jobs',
+            msg='Restored {} jobs'.format(len(jobs)),
+            id=None)
+        return jobs
+
     @property
     def state(self):
         """
@@ -130,50 +208,112 @@ class JobHandler(object):
         """
         return self._state
 
+    @property
+    def max_in_flight(self):
+        """
+        Get the maximum number of events started but not resolved
+        """
+        return self._max_in_flight
+
+    @property
+    def in_flight_events(self):
+        """
+        Get the events started but not resolved, in the order they were started
+        :return: list of events
+        """
+        return [event for _, event in self._in_flight.values()]
+
+    @property
+    def jobs(self):
+        """
+        Get the jobs not finished yet: those with an event in flight, in the order started, then the others, in the
+        order they are scheduled, then those waiting on the scan of another job
+        :return: list of jobs
+        """
+        jobs = list(OrderedDict((id(job), job) for job, _ in self._in_flight.values()).values())
+        jobs += [job for job in self._job_queue if job not in jobs]
+        return jobs + list(self._coalescer) if self._coalescer is not None else jobs
+
     @property
     def has_jobs(self):
         """
         Check if there are any events
         :return: true if there are events
         """
-        return len(self._job_deque) > 0
+        return len(self._in_flight) > 0 or len(self._job_queue) > 0 or \
+            (self._coalescer is not None and len(self._coalescer) > 0)
 
-    def _dequeue_job(self):
+    def _dequeue_job(self, job=None):
         """
-        Dequeues the current job, attempts to call on_dequeue
+        Dequeues a job, releasing the shared memory raws created on its behalf, attempts to call on_dequeue
+        :raises IndexError: if there are no jobs
+        :param job: the job to dequeue; defaults to the current job (see _peek_current_job)
         :return:
         """
-        dequeued_job = self._job_deque.popleft()
+        dequeued_job = job if job is not None else self._peek_current_job()
+        if dequeued_job is None:
+            raise IndexError('dequeue from a JobHandler without jobs')
+        for event_uuid, (in_flight_job, _) in list(self._in_flight.items()):
+            if in_flight_job is dequeued_job:
+                del self._in_flight[event_uuid]
+        self._job_queue.discard(dequeued_job)
+        if self._journal is not None:
+            self._journal.record_dequeue(dequeued_job)
+        SharedRaw.release_owner(dequeued_job.uuid)
         if self._on_job_dequeue is not None:
             self._on_job_dequeue(dequeued_job)
+        # Jobs waiting on its scan are scanned themselves
+        if self._coalescer is not None:
+            for follower in self._coalescer.discard(dequeued_job):
+                self._admit_job(follower)
         return dequeued_job
 
+    def _admit_job(self, job):
+        """
+        Schedules a new job, unless it is coalesced with a job scanning the same image: it then waits for that
+        scan, or is given the kept result of a past one and scheduled from its next event
+        :param job: an AeroCubeJob not yet scheduled
+        """
+        result_event, attached = self._coalescer.coalesce(job) if self._coalescer is not None else (None, False)
+        if attached:
+            return
+        if result_event is not None:
+            job.update_current_node(result_event, merge_payload=True)
+            if self._journal is not None:
+                self._journal.record_resolve(job, result_event)
+            if job.is_finished:
+                self._dequeue_job(job)
+                return
+        if len(self._get_ready_events(job)) > 0:
+            self._job_queue.push(job)
+
     def _peek_current_event(self):
         """
         Peeks at the current event of the current job
         :return: the current event
         """
-        if self.has_jobs:
-            return self._job_deque[0].current_event
-        else:
-            return None
+        job = self._peek_current_job()
+        return job.current_event if job is not None else None
 
     def _peek_current_job(self):
         """
-        Peeks at the current job
-        :return: the current job
+        Peeks at the current job: the first started job with an event in flight, else the next job scheduled
+        :return: the current job, or None
         """
-        return self._job_deque[0]
+        for job, _ in self._in_flight.values():
+            return job
+        return self._job_queue.peek()
 
     def _peek_last_added_job(self):
         """
         Peeks at the most recently added job
         :return: the most recently added job
         """
-        if self.has_jobs:
-            return self._job_deque[-1]
-        else:
-            return None
+        job = self._last_added_job
+        if job is not None and (job in self._job_queue or (self._coalescer is not None and job in self._coalescer) or
+                                any(job is j for j, _ in self._in_flight.values())):
+            return job
+        return None
 
     # state-change functions
 
@@ -184,6 +324,12 @@ class JobHandler(object):
         :return: True if successful, False if not
         """
         if self._state == JobHandler.State.STOPPED:
+            # Results of events in flight when stopped are dropped, so their events are started again
+            jobs = [job for job, _ in self._in_flight.values()]
+            self._in_flight.clear()
+            for job in jobs:
+                if job not in self._job_queue:
+                    self._job_queue.push(job)
             self._state = JobHandler.State.STARTED
             self._start_sending_events()
             return True
@@ -191,21 +337,36 @@ class JobHandler(object):
 
     def _start_sending_events(self):
         """
-        Attempts to send the first event in the queue
+        Attempts to send the current events of the jobs scheduled first, until max_in_flight are in flight
         Precondition: State is STARTED
+        :raises NotImplementedError if on_start_event is not defined; jobs are then left scheduled
         """
         if self._state != JobHandler.State.STARTED:
             raise JobHandler.NotAllowedInStateException('ERROR: JobHandler must be in STARTED state to send events')
-        if self.has_jobs:
-            self._start_event()
+        # Checked before a job is popped, so that it is not lost
+        if self._on_start_event is None:
+            raise NotImplementedError('ERROR: Must call set_start_event_observer before an event can be sent')
+        # Observers may resolve events before returning, which would start the next ones from within this loop; the
+        # outermost call starts them instead, so that the stack does not grow with the number of events
+        if self._sending:
+            return
+        self._sending = True
+        try:
+            # Hence the state is checked each time
+            while self._state == JobHandler.State.STARTED:
+                if len(self._job_queue) == 0:
+                    break
+                self._start_event(self._job_queue.pop())
+        finally:
+            self._sending = False
 
     def _continue_sending_events(self):
         """
-        Attempts
-        Precondition: State is PENDING
+        Attempts to send more events once an event in flight is resolved
+        Precondition: State is PENDING or STARTED
         """
-        if self._state != JobHandler.State.PENDING:
-            raise JobHandler.NotAllowedInStateException('ERROR: JobHandler must be in PENDING state to continue sending events')
+        if self._state != JobHandler.State.PENDING and self._state != JobHandler.State.STARTED:
+            raise JobHandler.NotAllowedInStateException('ERROR: JobHandler must be in PENDING or STARTED state to continue sending events')
         self._state = JobHandler.State.STARTED
         logger.debug(
             self.__class__.__name__,
@@ -216,11 +377,13 @@ class JobHandler(object):
 
     def _resolve_state(self):
         """
-        Precondition: State is PENDING or PENDING_STOP_ON_RESOLVE
+        Precondition: State is PENDING, STARTED or PENDING_STOP_ON_RESOLVE
         """
-        if self._state == JobHandler.State.PENDING:
+        if self._state == JobHandler.State.PENDING or self._state == JobHandler.State.STARTED:
             self._continue_sending_events()
         elif self._state == JobHandler.State.PENDING_STOP_ON_RESOLVE:
+            if len(self._in_flight) > 0:
+                return
             self._state = JobHandler.State.STOPPED
             logger.debug(
                 self.__class__.__name__,
@@ -228,15 +391,16 @@ class JobHandler(object):
                 msg='State changed to {}'.format(self._state),
                 id=None)
         else:
-            raise JobHandler.NotAllowedInStateException('ERROR: JobHandler must be in PENDING or PENDING_STOP_ON_RESOLVE to resolve current event')
+            raise JobHandler.NotAllowedInStateException('ERROR: JobHandler must be in PENDING, STARTED or PENDING_STOP_ON_RESOLVE to resolve an event')
 
     def stop(self):
         """
-        Attempts to put the JobHandler in a STOPPED state, waiting until the currently pending event is resolved
+        Attempts to put the JobHandler in a STOPPED state, waiting until the events in flight are resolved
         :return: True if successfully directs the JobHandler to switch to a STOPPED state, either then or
-        after the current event is resolved. False otherwise.
+        after the events in flight are resolved. False otherwise.
         """
-        if self._state == JobHandler.State.PENDING:
+        if self._state == JobHandler.State.PENDING or \
+                (self._state == JobHandler.State.STARTED and len(self._in_flight) > 0):
             self._state = JobHandler.State.PENDING_STOP_ON_RESOLVE
             logger.debug(
                 self.__class__.__name__,
@@ -274,22 +438,47 @@ class JobHandler(object):
 
     def resolve_event(self, event):
         """
-        Logic to resolve "finished" events/jobs in the JobHandler deque could
-        either be handled within this class, or lie in the calling class.
-        Needs to be determined.
-        :return: if event is resolved/finished, return true; else, return false
+        Resolves the event in flight that a ResultEvent answers (matched by its CALLING_EVENT_UUID), moving its
+        job to the next event, dequeuing the job if it is finished, and starting further events if allowed.
+        :return: if event is resolved/finished, return true; else (no such event in flight, or the event's payload is
+            invalid), return false
         """
+        job = None
         if self._can_state_resolve():
+            try:
+                # Before the event leaves _in_flight and its job is updated, so that neither is left half done
+                event.payload.validate()
+            except AttributeError as e:
+                logger.err(
+                    self.__class__.__name__,
+                    'resolve_event',
+                    msg='ResultEvent with invalid payload (not resolved): {}'.format(e),
+                    id=None)
+                return False
+            job, _ = self._in_flight.pop(event.payload.strings(ResultEvent.CALLING_EVENT_UUID), (None, None))
+        if job is not None:
             # Modify JobHandler queue (assuming state is valid)
-            self._peek_current_job().update_current_node(event, merge_payload=True)
+            followers = []
+            if self._coalescer is not None and \
+                    job.root_event.uuid == event.payload.strings(ResultEvent.CALLING_EVENT_UUID):
+                followers = self._coalescer.resolve(job, event)
+            job.update_current_node(event, merge_payload=True)
+            # Recorded once applied, so that replaying it cannot fail
+            if self._journal is not None:
+                self._journal.record_resolve(job, event)
             logger.success(
                 self.__class__.__name__,
                 'resolve_event',
                 msg='Resolved Event: \r\n{}\r\n'.format(event),
                 id=event.payload.strings(job_id_bundle_key))
-            # Check if the job is finished
-            if self._peek_current_job().is_finished:
-                self._dequeue_job()
+            # Check if the job is finished, else schedule its next events (in the job's original place)
+            if job.is_finished:
+                self._dequeue_job(job)
+            elif self._get_ready_events(job) and job not in self._job_queue:
+                self._job_queue.push(job)
+            # Jobs waiting on this scan are given its result if kept, else scanned themselves
+            for follower in followers:
+                self._admit_job(follower)
 
             # Update state
             self._resolve_state()
@@ -311,7 +500,7 @@ class JobHandler(object):
 
     def _can_state_resolve(self):
         # Check if state is valid
-        if self._state == JobHandler.State.STARTED:
+        if self._state == JobHandler.State.STARTED and len(self._in_flight) == 0:
             # Raise Error
             raise JobHandler.NotAllowedInStateException('ERROR: Attempted to resolve event while not pending for a result')
         elif self._state == JobHandler.State.STOPPED:
@@ -319,23 +508,31 @@ class JobHandler(object):
             raise JobHandler.NotAllowedInStateException('ERROR: Attempted to resolve event while stopped')
         return True
 
-    def _start_event(self):
+    def _start_event(self, job=None):
         """
-        Start an event of the current job by calling the on_start_event function and passing it the first event in the queue.
-        This action puts the JobHandler in a PENDING state.
+        Start the first current event of a job not yet in flight by calling the on_start_event function and passing it the event.
+        This action puts the JobHandler in a PENDING state if max_in_flight events are then in flight.
         Preconditions: state must be STARTED; on_start_event must be not None
         :raises NotImplementedError if on_start_event is not defined
+        :param job: a job popped from the queue; defaults to the job scheduled first
         """
         if self._state != JobHandler.State.STARTED:
             raise JobHandler.NotAllowedInStateException('ERROR: Attempted to start event while not in STARTED state')
         if self._on_start_event is not None:
+            job = job if job is not None else self._job_queue.pop()
+            event = self._get_ready_events(job)[0]
             logger.debug(
                 self.__class__.__name__,
                 '_start_event',
-                msg='Starting event: \r\n{}\r\n'.format(self._peek_current_event()),
+                msg='Starting event: \r\n{}\r\n'.format(event),
                 id=None)
-            self._state = JobHandler.State.PENDING
-            self._on_start_event(self, self._peek_current_event())
+            self._in_flight[event.uuid] = (job, event)
+            # Other branches of the job may start as well
+            if len(self._get_ready_events(job)) > 0 and job not in self._job_queue:
+                self._job_queue.push(job)
+            if len(self._in_flight) >= self._max_in_flight:
+                self._state = JobHandler.State.PENDING
+            self._on_start_event(self, event)
             logger.debug(
                 self.__class__.__name__,
                 '_start_event',
@@ -344,6 +541,13 @@ class JobHandler(object):
         else:
             raise NotImplementedError('ERROR: Must call set_start_event_observer before an event can be sent')
 
+    def _get_ready_events(self, job):
+        """
+        :param job: an AeroCubeJob
+        :return: the current events of job not yet in flight
+        """
+        return [event for event in job.current_events if event.uuid not in self._in_flight]
+
     # static helper function(s)
 
     @staticmethod
@@ -0,0 +1,462 @@
+"""
+Write-ahead journal of the jobs held by a JobHandler, so that its backlog survives a restart of the process.
+The journal is an append-only file of records, one per transition:
+* enqueue: the job's graph of events (see AeroCubeJob.to_binary)
+* resolve: a ResultEvent the job was updated with (see AeroCubeEvent.to_binary)
+* dequeue: the job is finished or dropped
+Replaying the results of each job on its decoded graph brings it back to the exact node(s) it was at, payloads
+merged included. Each record is framed by its length and CRC-32, so a record torn by a crash is detected and cut off.
+Records are appended to a buffer and written by a background thread, which fsyncs every batch at once (group
+commit): recording costs the encoding of the record, and a record is durable within about commit_interval
+(or once sync returns). Records of dequeued jobs are dropped by compacting the file once they outweigh the rest.
+A batch that fails to be written is cut off the file and retried; the error is kept until sync reports it.
+A journal corrupt before its last record is moved aside when opened, and a job that cannot be replayed (e.g., its
+shared memory raws did not survive the restart) is dropped, so that neither keeps the server from starting.
+"""
+
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from logger import Logger
+from .aeroCubeEvent import AeroCubeEvent
+from .aeroCubeJob import AeroCubeJob
+from .binaryCodec import BinaryCodecError, decode_string, encode_string
+from .sharedRaw import SharedRawError
+
+logger = Logger('jobJournal.py', active=True, external=True)
+
+
+class JobJournalError(Exception):
+    def __init__(self, message):
+        super(JobJournalError, self).__init__(message)
+
+
+class JobJournal(object):
+    """
+    :ivar _path: path of the journal file
+    :ivar _commit_interval: seconds the writer waits for more records before writing a batch
+    :ivar _max_batch: number of records written without waiting for more
+    :ivar _compact_min_bytes: size of dead records below which the file is not compacted
+    :ivar _retry_interval: seconds the writer waits before retrying a batch that failed
+    :ivar _file: the journal file, opened for appending
+    :ivar _buffer: records appended and not yet written
+    :ivar _size: size of the journal file once the buffer is written
+    :ivar _written: size of the journal file up to the last record written and fsynced
+    :ivar _live: uuid of each job not dequeued -> [(offset, length)] of its records, in order
+    :ivar _dead_bytes: size of the records of dequeued jobs
+    :ivar _appended: number of records appended
+    :ivar _durable: number of records written and fsynced
+    :ivar _recovered_jobs: jobs replayed when the journal was opened
+    :ivar _error: OSError raised writing a batch, until sync reports it, or None
+    :ivar _failed: True while the last batch failed, until it is written
+    :ivar _closed: True once close is called
+    :ivar _condition: guards the above, and wakes the writer and threads waiting in sync
+    :ivar _io_lock: held while writing the file, taken before _condition
+    :ivar _writer: thread writing batches
+    """
+
+    ENQUEUE = b'E'
+    RESOLVE = b'R'
+    DEQUEUE = b'D'
+
+    DEFAULT_COMMIT_INTERVAL = 0.002
+    DEFAULT_MAX_BATCH = 256
+    DEFAULT_COMPACT_MIN_BYTES = 1 << 20
+    DEFAULT_RETRY_INTERVAL = 1.
+
+    # Length and CRC-32 of the body of a record
+    _HEADER = struct.Struct('<II')
+
+    def __init__(self, path, commit_interval=None, max_batch=None, compact_min_bytes=None, retry_interval=None):
+        """
+        Opens (or creates) a journal, replaying the jobs it holds (see recovered_jobs). If a record other than the
+        last is corrupt, the file is moved aside (suffixed with .corrupt- and the time) and the journal starts empty.
+        :param path: path of the journal file; its directory is created if needed
+        :param commit_interval: seconds to wait for more records before writing a batch, defaults to
+            DEFAULT_COMMIT_INTERVAL
+        :param max_batch: number of records written without waiting for more, defaults to DEFAULT_MAX_BATCH
+        :param compact_min_bytes: size of dead records below which the file is not compacted, defaults to
+            DEFAULT_COMPACT_MIN_BYTES
+        :param retry_interval: seconds to wait before retrying a batch that failed, defaults to
+            DEFAULT_RETRY_INTERVAL
+        """
+        self._path = path
+        self._commit_interval = JobJournal.DEFAULT_COMMIT_INTERVAL if commit_interval is None else commit_interval
+        self._max_batch = JobJournal.DEFAULT_MAX_BATCH if max_batch is None else max_batch
+        self._compact_min_bytes = JobJournal.DEFAULT_COMPACT_MIN_BYTES if compact_min_bytes is None \
+            else compact_min_bytes
+        self._retry_interval = JobJournal.DEFAULT_RETRY_INTERVAL if retry_interval is None else retry_interval
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._buffer = []
+        self._live = OrderedDict()
+        self._dead_bytes = 0
+        self._appended = 0
+        self._durable = 0
+        self._error = None
+        self._failed = False
+        self._closed = False
+        try:
+            self._recovered_jobs, dropped = self._replay()
+        except JobJournalError as e:
+            corrupt_path = '{}.corrupt-{}'.format(path, time.strftime('%Y%m%d-%H%M%S'))
+            os.replace(path, corrupt_path)
+            logger.err(
+                self.__class__.__name__,
+                func_name='__init__',
+                msg='{}; moved it to {}, starting without its jobs'.format(e, corrupt_path),
+                id=None)
+            self._live = OrderedDict()
+            self._dead_bytes = 0
+            self._recovered_jobs, dropped = [], []
+        self._file = open(path, 'ab')
+        self._size = self._file.tell()
+        self._written = self._size
+        self._condition = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_batches, name='JobJournal', daemon=True)
+        self._writer.start()
+        # So that they are not replayed again, and are compacted away
+        for job_uuid in dropped:
+            self._append(JobJournal.DEQUEUE, job_uuid, b'')
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def recovered_jobs(self):
+        """
+        Get the jobs not dequeued when the journal was last closed (or its process stopped), in the order they
+        were enqueued, each at the node(s) it had reached
+        :return: list of AeroCubeJobs
+        """
+        return list(self._recovered_jobs)
+
+    @property
+    def size(self):
+        """
+        Get the size of the journal file, including records not yet written
+        """
+        with self._condition:
+            return self._size
+
+    def record_enqueue(self, job):
+        """
+        :param job: an AeroCubeJob, at its root event
+        """
+        self._append(JobJournal.ENQUEUE, job.uuid, job.to_binary())
+
+    def record_resolve(self, job, result_event):
+        """
+        :param job: an AeroCubeJob recorded by record_enqueue
+        :param result_event: the ResultEvent the job is updated with
+        """
+        self._append(JobJournal.RESOLVE, job.uuid, result_event.to_binary())
+
+    def record_dequeue(self, job):
+        """
+        :param job: an AeroCubeJob
+        """
+        self._append(JobJournal.DEQUEUE, job.uuid, b'')
+
+    def sync(self):
+        """
+        Waits until every record appended so far is written and fsynced
+        :raises JobJournalError: if writing the journal failed since the last call (records are still retried), or
+            it was closed before the records could be written
+        """
+        with self._condition:
+            target = self._appended
+            self._condition.notify_all()
+            while self._durable < target and self._error is None and not (self._failed and self._closed):
+                self._condition.wait()
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise JobJournalError('Failed to write journal {}: {}'.format(self._path, error))
+            if self._durable < target:
+                raise JobJournalError('Journal {} closed before its records were written'.format(self._path))
+
+    def close(self):
+        """
+        Writes the records appended so far and closes the journal; further records raise JobJournalError
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+        self._file.close()
+
+    def compact(self):
+        """
+        Rewrites the journal with the records of the jobs not dequeued only, in the order they were appended
+        :raises JobJournalError: if the journal is closed, or cannot be written
+        """
+        with self._io_lock:
+            with self._condition:
+                if self._closed:
+                    raise JobJournalError('Journal {} is closed'.format(self._path))
+                if self._failed:
+                    raise JobJournalError('Journal {} failed to be written, not compacting'.format(self._path))
+                try:
+                    self._compact()
+                except OSError as e:
+                    self._failed = True
+                    raise JobJournalError('Failed to compact journal {}: {}'.format(self._path, e))
+
+    def _append(self, op, job_uuid, payload):
+        parts = [op]
+        encode_string(job_uuid, parts)
+        parts.append(payload)
+        body = b''.join(parts)
+        record = JobJournal._HEADER.pack(len(body), zlib.crc32(body)) + body
+        with self._condition:
+            if self._closed:
+                raise JobJournalError('Journal {} is closed'.format(self._path))
+            offset = self._size
+            self._size += len(record)
+            self._buffer.append(record)
+            self._appended += 1
+            self._index(op, job_uuid, offset, len(record))
+            if len(self._buffer) == 1 or len(self._buffer) >= self._max_batch:
+                self._condition.notify_all()
+
+    def _index(self, op, job_uuid, offset, length):
+        """
+        Tracks the records of the jobs not dequeued, and the size of the others
+        """
+        if op == JobJournal.ENQUEUE:
+            # A job enqueued again (e.g., after a restart) starts over
+            self._dead_bytes += sum(length for _, length in self._live.pop(job_uuid, []))
+            self._live[job_uuid] = [(offset, length)]
+        elif op == JobJournal.RESOLVE and job_uuid in self._live:
+            self._live[job_uuid].append((offset, length))
+        elif op == JobJournal.DEQUEUE and job_uuid in self._live:
+            self._dead_bytes += sum(length for _, length in self._live.pop(job_uuid)) + length
+        else:
+            self._dead_bytes += length
+
+    def _write_batches(self):
+        """
+        Writes and fsyncs the records appended, a batch at a time, until closed. A batch that fails is retried every
+        retry_interval, after cutting off what it left in the file; when closing, it is given up on.
+        """
+        while True:
+            with self._condition:
+                while not self._buffer and not self._closed:
+                    self._condition.wait()
+                if not self._buffer and self._closed:
+                    return
+                if self._failed:
+                    if self._closed:
+                        logger.err(
+                            self.__class__.__name__,
+                            func_name='_write_batches',
+                            msg='Closing journal {} with {} records not written'.format(self._path, len(self._buffer)),
+                            id=None)
+                        self._condition.notify_all()
+                        return
+                    self._condition.wait(self._retry_interval)
+                # Give concurrent callers a chance to join the batch
+                elif len(self._buffer) < self._max_batch and self._commit_interval > 0 and not self._closed:
+                    self._condition.wait(self._commit_interval)
+            with self._io_lock:
+                with self._condition:
+                    batch, self._buffer = self._buffer, []
+                    target = self._appended
+                    failed = self._failed
+                data = b''.join(batch)
+                try:
+                    if failed:
+                        self._reset_file()
+                    self._file.write(data)
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    error = None
+                except OSError as e:
+                    error = e
+                    logger.err(
+                        self.__class__.__name__,
+                        func_name='_write_batches',
+                        msg='Failed to write journal {}: {}'.format(self._path, e),
+                        id=None)
+                with self._condition:
+                    if error is not None:
+                        # Written again at the same offsets, so that the index stays valid
+                        self._buffer = batch + self._buffer
+                        self._failed = True
+                        self._error = error
+                    else:
+                        self._written += len(data)
+                        self._durable = max(self._durable, target)
+                        self._failed = False
+                        if self._dead_bytes >= max(self._compact_min_bytes, self._size - self._dead_bytes):
+                            try:
+                                self._compact()
+                            except OSError as e:
+                                self._failed = True
+                                self._error = e
+                                logger.err(
+                                    self.__class__.__name__,
+                                    func_name='_write_batches',
+                                    msg='Failed to compact journal {}: {}'.format(self._path, e),
+                                    id=None)
+                    self._condition.notify_all()
+
+    def _reset_file(self):
+        """
+        Cuts off whatever a failed write left after the records written, and opens the file again
+        Precondition: self._io_lock is held
+        """
+        try:
+            self._file.close()
+        except OSError:
+            # Closed regardless, dropping the data left in its buffer
+            pass
+        with open(self._path, 'r+b') as f:
+            f.truncate(self._written)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file = open(self._path, 'ab')
+
+    def _compact(self):
+        """
+        Precondition: self._io_lock and self._condition are held, and the last batch did not fail
+        :raises OSError: if the journal cannot be written; it is then left as it was, the records not yet written
+            included
+        """
+        pending = b''.join(self._buffer)
+        self._file.write(pending)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._buffer = []
+        self._written += len(pending)
+        self._durable = self._appended
+        compact_path = self._path + '.compact'
+        live = OrderedDict()
+        offset = 0
+        with open(self._path, 'rb') as source, open(compact_path, 'wb') as target:
+            for job_uuid, records in self._live.items():
+                live[job_uuid] = []
+                for record_offset, length in records:
+                    source.seek(record_offset)
+                    target.write(source.read(length))
+                    live[job_uuid].append((offset, length))
+                    offset += length
+            target.flush()
+            os.fsync(target.fileno())
+        self._file.close()
+        os.replace(compact_path, self._path)
+        self._live = live
+        self._size = offset
+        self._written = offset
+        self._dead_bytes = 0
+        JobJournal._fsync_directory(self._path)
+        self._file = open(self._path, 'ab')
+        logger.debug(
+            self.__class__.__name__,
+            func_name='_compact',
+            msg='Compacted journal {} to {} bytes'.format(self._path, offset),
+            id=None)
+
+    def _replay(self):
+        """
+        Indexes the records of the journal file, cutting off a torn last record, and decodes the jobs not
+        dequeued. Records of dequeued jobs are skipped without being decoded; jobs that cannot be decoded, or are
+        finished (the process stopped before dequeuing them), are dropped, their records counted as dead.
+        :raises JobJournalError: if a record other than the last is corrupt
+        :return: (the recovered jobs, in the order they were enqueued, uuids of the jobs dropped)
+        """
+        if not os.path.exists(self._path):
+            return [], []
+        with open(self._path, 'rb') as f:
+            data = f.read()
+        view = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            if offset + JobJournal._HEADER.size > len(data):
+                break
+            length, crc = JobJournal._HEADER.unpack_from(view, offset)
+            body_offset = offset + JobJournal._HEADER.size
+            body = view[body_offset:body_offset + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                break
+            job_uuid, _ = decode_string(body, 1)
+            self._index(bytes(body[:1]), job_uuid, offset, JobJournal._HEADER.size + length)
+            offset = body_offset + length
+        if offset < len(data):
+            # Only the last record may be torn by a crash; anything else is corruption
+            if self._has_record_after(view, offset):
+                raise JobJournalError('Journal {} is corrupt at offset {}'.format(self._path, offset))
+            logger.warn(
+                self.__class__.__name__,
+                func_name='_replay',
+                msg='Cutting off torn record at offset {} of journal {}'.format(offset, self._path),
+                id=None)
+            with open(self._path, 'r+b') as f:
+                f.truncate(offset)
+                f.flush()
+                os.fsync(f.fileno())
+        jobs = []
+        dropped = []
+        for job_uuid, records in self._live.items():
+            try:
+                job = None
+                for record_offset, length in records:
+                    body = view[record_offset + JobJournal._HEADER.size:record_offset + length]
+                    _, payload_offset = decode_string(body, 1)
+                    if job is None:
+                        job = AeroCubeJob.construct_from_binary(body[payload_offset:])
+                    else:
+                        job.update_current_node(AeroCubeEvent.construct_from_binary(body[payload_offset:]),
+                                                merge_payload=True)
+            except (AttributeError, LookupError, BinaryCodecError, SharedRawError, OSError) as e:
+                # E.g., FileNotFoundError for the segment of a SharedRaw, unlinked when its process stopped
+                logger.err(
+                    self.__class__.__name__,
+                    func_name='_replay',
+                    msg='Dropping job {} that cannot be replayed from journal {}: {}'.format(job_uuid, self._path, e),
+                    id=job_uuid)
+                dropped.append(job_uuid)
+                continue
+            if job.is_finished:
+                dropped.append(job_uuid)
+            else:
+                jobs.append(job)
+        for job_uuid in dropped:
+            self._dead_bytes += sum(length for _, length in self._live.pop(job_uuid))
+        return jobs, dropped
+
+    @staticmethod
+    def _has_record_after(view, offset):
+        """
+        :return: True if a complete, valid record starts anywhere after offset
+        """
+        for start in range(offset + 1, len(view) - JobJournal._HEADER.size + 1):
+            length, crc = JobJournal._HEADER.unpack_from(view, start)
+            end = start + JobJournal._HEADER.size + length
+            if 0 < length and end <= len(view) and zlib.crc32(view[start + JobJournal._HEADER.size:end]) == crc:
+                return True
+        return False
+
+    @staticmethod
+    def _fsync_directory(path):
+        """
+        Makes a rename durable; not supported on all platforms
+        """
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
@@ -0,0 +1,127 @@
+import heapq
+import itertools
+import time
+from enum import Enum
+
+
+class JobPriority(Enum):
+    # Jobs a user waits for, e.g., scans of uploaded images
+    INTERACTIVE     = 0
+    # Bulk work, e.g., reprocessing archived scans
+    REPROCESSING    = 1
+    # Work nobody waits for, e.g., shipping logs
+    LOG_SHIPPING    = 2
+
+
+class JobQueue(object):
+    """
+    Heap of jobs ordered by due time, earliest first, with O(log n) push, pop and discard.
+    A job's due time is fixed when it is first pushed: the time it was pushed plus the aging delay of its priority,
+    or its deadline if earlier. A job of lower priority therefore waits at most its delay behind jobs pushed after
+    it, which keeps it from starving, while deadlines are met in order (earliest deadline first). A job popped and
+    pushed again (e.g., between the events of a job) keeps its place until it is discarded.
+    :ivar _heap: entries [due, sequence, job], where job is None once the entry is discarded
+    :ivar _entries: id of each queued job -> its entry in _heap
+    :ivar _places: id of each job pushed and not discarded -> (due, sequence)
+    :ivar _aging: JobPriority -> aging delay in seconds
+    :ivar _counter: sequence numbers, keeping jobs due at the same time in the order they were pushed
+    """
+
+    # Aging delay of each priority, in seconds
+    DEFAULT_AGING = {
+        JobPriority.INTERACTIVE: 0.,
+        JobPriority.REPROCESSING: 60.,
+        JobPriority.LOG_SHIPPING: 600.
+    }
+
+    def __init__(self, aging=None):
+        """
+        :param aging: JobPriority -> aging delay in seconds, overriding DEFAULT_AGING
+        """
+        self._heap = []
+        self._entries = {}
+        self._places = {}
+        self._aging = dict(JobQueue.DEFAULT_AGING)
+        if aging is not None:
+            self._aging.update(aging)
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, job):
+        return id(job) in self._entries
+
+    def __iter__(self):
+        """
+        Iterates over the queued jobs in the order they would be popped, in O(n log n)
+        """
+        return iter([entry[2] for entry in sorted(self._entries.values())])
+
+    def get_due(self, job):
+        """
+        :param job: a job pushed and not discarded
+        :return: the time at which the job is due, in seconds since the Epoch
+        """
+        return self._places[id(job)][0]
+
+    def push(self, job, now=None):
+        """
+        Queues a job, keeping its place if it was pushed before and not discarded
+        :raises AttributeError: if the job is already queued
+        :param job: an AeroCubeJob
+        :param now: time of the push in seconds since the Epoch; defaults to time.time()
+        """
+        if job in self:
+            raise AttributeError('Job {} is already queued'.format(job.uuid))
+        place = self._places.get(id(job))
+        if place is None:
+            now = time.time() if now is None else now
+            due = now + self._aging[job.priority]
+            if job.deadline is not None:
+                due = min(due, job.deadline)
+            place = (due, next(self._counter))
+            self._places[id(job)] = place
+        entry = [place[0], place[1], job]
+        self._entries[id(job)] = entry
+        heapq.heappush(self._heap, entry)
+
+    def peek(self):
+        """
+        :return: the job due first, or None if empty
+        """
+        self._drop_discarded()
+        return self._heap[0][2] if self._heap else None
+
+    def pop(self):
+        """
+        Removes the job due first, keeping its place for a later push
+        :raises IndexError: if empty
+        :return: the job due first
+        """
+        self._drop_discarded()
+        if not self._heap:
+            raise IndexError('pop from an empty JobQueue')
+        job = heapq.heappop(self._heap)[2]
+        del self._entries[id(job)]
+        return job
+
+    def discard(self, job):
+        """
+        Removes a job if queued, and forgets its place
+        :param job: an AeroCubeJob
+        """
+        self._places.pop(id(job), None)
+        entry = self._entries.pop(id(job), None)
+        if entry is not None:
+            # Dropped from the heap once it reaches the top
+            entry[2] = None
+
+    def clear(self):
+        self._heap = []
+        self._entries = {}
+        self._places = {}
+
+    def _drop_discarded(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
@@ -1,2 +1,4 @@
 
-job_id_bundle_key = 'JOB_ID'
\ No newline at end of file
+job_id_bundle_key = 'JOB_ID'
+# Codec of AeroCubeEvent.encode: 'json' (for compatibility) or 'binary'
+event_codec = 'json'
@@ -0,0 +1,246 @@
+"""
+Raw payloads (NumPy arrays) held in multiprocessing.shared_memory segments, for processes on the same host
+(e.g., the Flask server and the Controller). A SharedRaw is inserted into a Bundle like any other raw, but is
+serialized as a handle (segment name, dtype and shape) rather than as its data; receivers map the segment and
+read the array in place.
+Segments are reference counted in each process: the creating process holds a reference on behalf of the owner
+(the uuid of the job the payload belongs to) until release_owner is called, which JobHandler does when the job is
+dequeued; every SharedRaw instance holds one more until it is released or garbage collected. The creating process
+unlinks the segment once its count drops to zero, while mappings already open elsewhere stay valid.
+Since only the creating process can release an owner, segments are created only in the process of the JobHandler
+(see register_owner_process); other processes (e.g., the Controller) map them but do not create any.
+"""
+
+import os
+import threading
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+class SharedRawError(Exception):
+    def __init__(self, message):
+        super(SharedRawError, self).__init__(message)
+
+
+class _Segment(object):
+    """
+    :ivar shm: the mapped SharedMemory
+    :ivar references: number of references to the segment held in this process
+    :ivar created: True if this process created (and so must unlink) the segment
+    """
+    __slots__ = ('shm', 'references', 'created')
+
+    def __init__(self, shm, created):
+        self.shm = shm
+        self.references = 0
+        self.created = created
+
+
+class SharedRaw(object):
+    """
+    Use create to move an array into shared memory, and from_handle to map one received from another process.
+    :cvar HANDLE_KEY: key of the JSON object standing in for a SharedRaw (see handle)
+    :ivar _name: name of the shared memory segment
+    :ivar _dtype: dtype of the array
+    :ivar _shape: shape of the array
+    :ivar _release: finalizer dropping this instance's reference to the segment
+    """
+
+    HANDLE_KEY = '__shared_raw__'
+
+    _ERROR_INVALID_HANDLE = 'Invalid SharedRaw handle: {}'
+    _ERROR_RELEASED = 'SharedRaw {} has been released'
+    _ERROR_NOT_ARRAY = 'SharedRaw requires a NumPy array without Python objects'
+    _ERROR_NOT_OWNER_PROCESS = 'SharedRaw.create must be called in the process releasing its owners ' \
+                               '(that of the JobHandler), not in process {}'
+
+    # Segment name -> _Segment, for segments mapped in this process
+    _segments = {}
+    # Owner -> names of the segments created on its behalf, released by release_owner
+    _owned = {}
+    # Id of the process allowed to create segments, see register_owner_process
+    _owner_process = None
+    _lock = threading.Lock()
+
+    def __init__(self, name, dtype, shape):
+        """
+        Maps (or re-uses the mapping of) an existing segment; prefer create or from_handle
+        :raises FileNotFoundError: if no segment has the given name (e.g., its owner has released it)
+        """
+        self._name = name
+        self._dtype = np.dtype(dtype)
+        self._shape = tuple(int(d) for d in shape)
+        SharedRaw._acquire(name)
+        self._release = weakref.finalize(self, SharedRaw._release_segment, name)
+
+    def __eq__(self, other):
+        return isinstance(other, SharedRaw) and \
+               self._name == other.name and \
+               self._dtype == other.dtype and \
+               self._shape == other.shape
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._name)
+
+    def __repr__(self):
+        return 'SharedRaw({!r}, {}, {})'.format(self._name, self._dtype.str, self._shape)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self._shape, dtype=np.int64)) * self._dtype.itemsize
+
+    @property
+    def array(self):
+        """
+        Array reading and writing the shared segment in place (no copy)
+        :raises SharedRawError: if this instance has been released
+        """
+        if not self._release.alive:
+            raise SharedRawError(self._ERROR_RELEASED.format(self._name))
+        buf = SharedRaw._segments[self._name].shm.buf
+        return np.ndarray(self._shape, dtype=self._dtype, buffer=buf[:self.nbytes])
+
+    @property
+    def handle(self):
+        """
+        JSON-serializable stand-in for this SharedRaw, as written by Bundle.to_json; see from_handle
+        """
+        return {SharedRaw.HANDLE_KEY: {'name': self._name, 'dtype': self._dtype.str, 'shape': list(self._shape)}}
+
+    def release(self):
+        """
+        Drops this instance's reference to the segment (also done when it is garbage collected). Arrays
+        returned by array must not be used afterwards.
+        """
+        self._release()
+
+    @staticmethod
+    def create(array, owner):
+        """
+        Copies an array into a new shared memory segment, kept alive until release_owner(owner)
+        :raises SharedRawError: if array is not a NumPy array, or holds Python objects, or if this is not the process
+            registered with register_owner_process
+        :param array: NumPy array
+        :param owner: identifier of what the payload belongs to, usually the uuid of its AeroCubeJob
+        :return: instance of SharedRaw
+        """
+        if not isinstance(array, np.ndarray) or array.dtype.hasobject:
+            raise SharedRawError(SharedRaw._ERROR_NOT_ARRAY)
+        # Segments created elsewhere would never be released, as release_owner only reaches this process
+        if SharedRaw._owner_process != os.getpid():
+            raise SharedRawError(SharedRaw._ERROR_NOT_OWNER_PROCESS.format(os.getpid()))
+        # Segments cannot be empty
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        with SharedRaw._lock:
+            segment = _Segment(shm, created=True)
+            # Reference held on behalf of the owner
+            segment.references = 1
+            SharedRaw._segments[shm.name] = segment
+            SharedRaw._owned.setdefault(owner, []).append(shm.name)
+        shared_raw = SharedRaw(shm.name, array.dtype, array.shape)
+        shared_raw.array[...] = array
+        return shared_raw
+
+    @staticmethod
+    def is_handle(value):
+        """
+        :param value: any decoded JSON value
+        :return: True if value is the handle of a SharedRaw
+        """
+        return isinstance(value, dict) and len(value) == 1 and SharedRaw.HANDLE_KEY in value
+
+    @staticmethod
+    def from_handle(handle):
+        """
+        Maps the segment described by a handle, re-using the mapping if this process already has one
+        :raises SharedRawError: if handle is not the handle of a SharedRaw
+        :raises FileNotFoundError: if the segment no longer exists
+        :param handle: as returned by SharedRaw.handle
+        :return: instance of SharedRaw
+        """
+        if not SharedRaw.is_handle(handle):
+            raise SharedRawError(SharedRaw._ERROR_INVALID_HANDLE.format(handle))
+        fields = handle[SharedRaw.HANDLE_KEY]
+        try:
+            return SharedRaw(fields['name'], fields['dtype'], fields['shape'])
+        except (KeyError, TypeError) as err:
+            raise SharedRawError(SharedRaw._ERROR_INVALID_HANDLE.format(err))
+
+    @staticmethod
+    def register_owner_process():
+        """
+        Makes this process the one creating segments and releasing their owners, as JobHandler does when it is
+        constructed. Forked children are not registered along with their parent.
+        """
+        SharedRaw._owner_process = os.getpid()
+
+    @staticmethod
+    def release_owner(owner):
+        """
+        Drops the references held on behalf of owner, so that its segments are unlinked once no SharedRaw in
+        this process uses them. Does nothing if owner has no segments.
+        :param owner: identifier passed to create
+        """
+        with SharedRaw._lock:
+            names = SharedRaw._owned.pop(owner, [])
+        for name in names:
+            SharedRaw._release_segment(name)
+
+    @staticmethod
+    def _acquire(name):
+        with SharedRaw._lock:
+            segment = SharedRaw._segments.get(name)
+            if segment is None:
+                segment = _Segment(SharedRaw._open_segment(name), created=False)
+                SharedRaw._segments[name] = segment
+            segment.references += 1
+
+    @staticmethod
+    def _release_segment(name):
+        with SharedRaw._lock:
+            segment = SharedRaw._segments.get(name)
+            if segment is None:
+                return
+            segment.references -= 1
+            if segment.references > 0:
+                return
+            del SharedRaw._segments[name]
+        try:
+            segment.shm.close()
+        except BufferError:
+            # Arrays still view the mapping, which is then closed when they are garbage collected
+            pass
+        if segment.created:
+            segment.shm.unlink()
+
+    @staticmethod
+    def _open_segment(name):
+        """
+        Opens a segment created by another process, which remains responsible for unlinking it. Before Python 3.13
+        this assumes the two processes were started independently (as the Flask server and Controller are), since
+        multiprocessing children share the resource tracker of their parent.
+        """
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13, opening a segment registers it for unlinking when this process exits
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            return shm
@@ -0,0 +1,53 @@
+"""
+Jobs and results shared by the tests of JobHandler, JobJournal, JobCoalescer and AeroCubeJob
+"""
+
+from jobs.aeroCubeEvent import ImageEvent, ResultEvent
+from jobs.aeroCubeJob import AeroCubeJob, AeroCubeJobEventNode
+from jobs.aeroCubeSignal import ImageEventSignal, ResultEventSignal
+from jobs.bundle import Bundle
+from jobs.jobQueue import JobPriority
+from jobs.settings import job_id_bundle_key
+
+
+def create_job(job_id, num_events=1, priority=JobPriority.INTERACTIVE):
+    """
+    :param job_id: id of the job, also given to its events' payloads
+    :param num_events: number of events, run one after the other
+    :param priority: JobPriority of the job
+    :return: AeroCubeJob of IDENTIFY_AEROCUBES ImageEvents with ids '<job_id>-<i>', the last one run being
+        '<job_id>-0'
+    """
+    node = None
+    for i in range(num_events):
+        bundle = Bundle()
+        bundle.insert_string(job_id_bundle_key, job_id)
+        event = ImageEvent(ImageEventSignal.IDENTIFY_AEROCUBES, bundle=bundle, id='{}-{}'.format(job_id, i))
+        node = AeroCubeJobEventNode(event, ok_event_node=node)
+    return AeroCubeJob(node, id=job_id, priority=priority)
+
+
+def create_image_upload_job(path, **kwargs):
+    """
+    :param path: FILE_PATH of the job's root event
+    :param kwargs: as taken by AeroCubeJob.create_image_upload_job; int_storage defaults to True
+    :return: AeroCubeJob scanning the image at path
+    """
+    kwargs.setdefault('int_storage', True)
+    return AeroCubeJob.create_image_upload_job(path, **kwargs)
+
+
+def create_result(event, signal=ResultEventSignal.OK, scan_id=None):
+    """
+    :param event: the event answered
+    :param signal: ResultEventSignal of the result
+    :param scan_id: SCAN_ID of the result, or None
+    :return: ResultEvent for event, carrying the job id of its payload, if any
+    """
+    bundle = Bundle()
+    job_id = event.payload.strings().get(job_id_bundle_key)
+    if job_id is not None:
+        bundle.insert_string(job_id_bundle_key, job_id)
+    if scan_id is not None:
+        bundle.insert_string(ImageEvent.SCAN_ID, scan_id)
+    return ResultEvent(signal, event.uuid, bundle=bundle)
@@ -1,8 +1,9 @@
 import unittest
 
-from jobs.aeroCubeEvent import ImageEvent, StorageEvent, ResultEvent, SystemEvent
+from jobs.aeroCubeEvent import AeroCubeEvent, ImageEvent, StorageEvent, ResultEvent, SystemEvent
 from jobs.aeroCubeSignal import *
 from jobs.bundle import Bundle, BundleKeyError
+from jobs.settings import job_id_bundle_key
 
 
 class TestAeroCubeEventInit(unittest.TestCase):
@@ -134,6 +135,25 @@ class TestAeroCubeEvent(unittest.TestCase):
         event = StorageEvent(StorageEventSignal.STORE_INTERNALLY, payload)
         self.assertEqual(event.parse_storage_keys(), [scan_id, scan_corners, scan_marker_ids])
 
+    def test_encode_decode(self):
+        calling_event = ImageEvent(ImageEventSignal.IDENTIFY_AEROCUBES)
+        payload = Bundle()
+        payload.insert_string(job_id_bundle_key, 'JOB')
+        payload.insert_string(ImageEvent.SCAN_ID, '123456789')
+        payload.insert_iterable(ImageEvent.SCAN_MARKER_IDS, [[0], [7]])
+        event = ResultEvent(ResultEventSignal.IDENT_AEROCUBES_FIN, calling_event.uuid, bundle=payload)
+        for codec in (ResultEvent.CODEC_JSON, ResultEvent.CODEC_BINARY):
+            encoded = event.encode(codec)
+            for decoded in (AeroCubeEvent.decode(encoded),
+                            AeroCubeEvent.decode(encoded.encode() if isinstance(encoded, str) else encoded)):
+                self.assertIsInstance(decoded, ResultEvent)
+                self.assertEqual(decoded, event)
+                self.assertEqual(decoded.signal, event.signal)
+                self.assertEqual(decoded.created_at, event.created_at)
+                self.assertEqual(decoded.payload, event.payload)
+        self.assertIsInstance(event.encode(), str)
+        self.assertRaises(AttributeError, event.encode, 'xml')
+
 
 class TestAeroCubeSignal(unittest.TestCase):
     @classmethod
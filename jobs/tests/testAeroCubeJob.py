@@ -2,6 +2,7 @@ import unittest
 import numpy as np
 
 from jobs.aeroCubeJob import *
+from jobs.tests.jobFixtures import create_result
 
 
 class TestAeroCubeJobEventNode(unittest.TestCase):
@@ -151,6 +152,58 @@ class TestAeroCubeJob(unittest.TestCase):
         self._JOB.update_current_node(result_event)
         self.assertRaises(Exception, self._JOB.current_event.payload.strings, ImageEvent.FILE_PATH)
 
+    def _create_fan_out_job(self, **kwargs):
+        """
+        :param kwargs: passed to AeroCubeJobEventNode for the root node
+        :return: (job fanning out from _IMAGE_EVENT_1 to two branches joined by a barrier, the branch nodes, the
+            join node)
+        """
+        join_node = AeroCubeJobJoinNode(ImageEvent(ImageEventSignal.GET_AEROCUBE_POSE))
+        branches = [AeroCubeJobEventNode(ImageEvent(ImageEventSignal.IDENTIFY_AEROCUBES), ok_event_node=join_node)
+                    for _ in range(2)]
+        return AeroCubeJob(AeroCubeJobEventNode(self._IMAGE_EVENT_1, ok_event_node=branches, **kwargs)), \
+            branches, join_node
+
+    def test_fan_out_joins_at_barrier(self):
+        job, branches, join_node = self._create_fan_out_job()
+        job.update_current_node(create_result(self._IMAGE_EVENT_1))
+        self.assertEqual(job.current_events, [node.event for node in branches])
+        # Branches finish in any order, and payloads are merged in the order of the branches
+        job.update_current_node(create_result(branches[1].event, scan_id='second'), merge_payload=True)
+        self.assertEqual(job.current_events, [branches[0].event])
+        job.update_current_node(create_result(branches[0].event, scan_id='first'), merge_payload=True)
+        self.assertEqual(job.current_events, [join_node.event])
+        self.assertEqual(join_node.event.payload.strings(ImageEvent.SCAN_ID), 'second')
+        job.update_current_node(create_result(join_node.event))
+        self.assertTrue(job.is_finished)
+        self.assertEqual(job.current_events, [])
+
+    def test_fan_out_branch_ending_early(self):
+        job, branches, join_node = self._create_fan_out_job()
+        job.update_current_node(create_result(self._IMAGE_EVENT_1))
+        # No node for errors, so the branch ends without reaching the barrier
+        job.update_current_node(create_result(branches[0].event, ResultEventSignal.ERROR))
+        job.update_current_node(create_result(branches[1].event))
+        self.assertEqual(job.current_event, join_node.event)
+        # Without a barrier, the job finishes with its last branch
+        job = AeroCubeJob(AeroCubeJobEventNode(self._IMAGE_EVENT_1, ok_event_node=[self._IMAGE_EVENT_LEAF_NODE]))
+        job.update_current_node(create_result(self._IMAGE_EVENT_1))
+        job.update_current_node(create_result(self._IMAGE_EVENT))
+        self.assertTrue(job.is_finished)
+
+    def test_binary_round_trip(self):
+        job, _, _ = self._create_fan_out_job(err_event_node=self._IMAGE_EVENT_LEAF_NODE)
+        job = AeroCubeJob(job._root_event_node, deadline=5.)
+        decoded = AeroCubeJob.construct_from_binary(job.to_binary())
+        self.assertEqual(decoded.uuid, job.uuid)
+        self.assertEqual(decoded.deadline, 5.)
+        self.assertEqual(decoded._root_event_node, job._root_event_node)
+        # The join node is shared by both branches
+        decoded_branches = decoded._root_event_node.event_signal_map[ResultEventSignal.OK]
+        self.assertIsInstance(decoded_branches[0].event_signal_map[ResultEventSignal.OK], AeroCubeJobJoinNode)
+        self.assertIs(decoded_branches[0].event_signal_map[ResultEventSignal.OK],
+                      decoded_branches[1].event_signal_map[ResultEventSignal.OK])
+
 
 class TestAeroCubeJobConstructors(unittest.TestCase):
     @classmethod
@@ -167,13 +220,12 @@ class TestAeroCubeJobConstructors(unittest.TestCase):
         self.assertIsInstance(job.root_event, ImageEvent)
         self.assertEqual(job.root_event.payload.strings(ImageEvent.FILE_PATH), img_path)
 
-        int_store_node = job._current_node.event_signal_map[ResultEventSignal.OK]
+        int_store_node, ext_store_node = job._current_node.event_signal_map[ResultEventSignal.OK]
         self.assertIsInstance(int_store_node.event, StorageEvent)
         self.assertEqual(int_store_node.event.signal, StorageEventSignal.STORE_INTERNALLY)
         np.testing.assert_equal(int_store_node.event.payload.raws(StorageEvent.INT_STORE_PAYLOAD_KEYS),
                                 [ImageEvent.SCAN_ID, ImageEvent.SCAN_CORNERS, ImageEvent.SCAN_MARKER_IDS])
 
-        ext_store_node = int_store_node.event_signal_map[ResultEventSignal.OK]
         self.assertIsInstance(ext_store_node.event, StorageEvent)
         self.assertEqual(ext_store_node.event.signal, StorageEventSignal.STORE_EXTERNALLY)
         self.assertEqual(ext_store_node.event.payload.strings(StorageEvent.EXT_STORAGE_TARGET), 'FIREBASE')
\ No newline at end of file
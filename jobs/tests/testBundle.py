@@ -1,6 +1,9 @@
 import pickle
 import unittest
 
+import numpy as np
+
+from jobs.binaryCodec import BinaryCodecError
 from jobs.bundle import Bundle, BundleKeyError
 
 
@@ -58,6 +61,11 @@ class TestBundle(unittest.TestCase):
     def test_invalid_key_has_symbol(self):
         self.assertEqual(self._bundle.is_valid_key(self._invalid_key_has_symbol), False)
 
+    def test_invalid_key_not_string(self):
+        self.assertEqual(self._bundle.is_valid_key(['KEY']), False)
+        self.assertRaises(AttributeError, self._bundle.insert_string, ['KEY'], 'value')
+        self.assertRaises(AttributeError, self._bundle.strings, {'KEY': 1})
+
     def test_bundle_access_valid_key_not_found(self):
         self.assertRaises(BundleKeyError, self._bundle.strings, self._valid_key)
 
@@ -119,6 +127,79 @@ class TestBundle(unittest.TestCase):
         self._bundle.insert_iterable(self._valid_key, updated_iterable)
         self.assertEqual(self._bundle.iterables(self._valid_key), self._valid_iterable)
 
+    # Binary
+
+    def test_binary_round_trip(self):
+        self._bundle.insert_string('SCAN_ID', 'scan \u00e9')
+        self._bundle.insert_number('COUNT', 3)
+        self._bundle.insert_number('BIG', 2 ** 70)
+        self._bundle.insert_number('RATE', 0.25)
+        self._bundle.insert_raw('PICKLED', self._valid_raw)
+        self._bundle.insert_raw('CUBES', {'CUBE_IDS': [0, 2], 'DISTANCES': {'0': 0.5, '2': None}})
+        self._bundle.insert_iterable('KEYS', ['strings:SCAN_ID', ['raws', True]])
+        self._bundle.insert_iterable('NAME', 'iterable string')
+        decoded = Bundle.construct_from_binary(self._bundle.to_binary())
+        self.assertEqual(decoded, self._bundle)
+        self.assertEqual(Bundle.construct_from_binary(Bundle().to_binary()), Bundle())
+        # plain containers come back as they would from JSON, while those holding arrays or bytes are walked
+        self._bundle.insert_iterable('PLAIN', ({1: 'a'}, 2.5))
+        self._bundle.insert_iterable('WALKED', ({1: b'a'}, np.zeros(2)))
+        decoded = Bundle.construct_from_binary(self._bundle.to_binary())
+        self.assertEqual(decoded.iterables('PLAIN'), [{'1': 'a'}, 2.5])
+        self.assertIsInstance(decoded.iterables('WALKED'), tuple)
+        self.assertEqual(decoded.iterables('WALKED')[0], {1: b'a'})
+
+    def test_binary_carries_numpy_arrays(self):
+        corners = np.arange(16, dtype=np.float32).reshape(2, 1, 4, 2)
+        self._bundle.insert_raw('SCAN_CORNERS', corners)
+        self._bundle.insert_raw('SCAN_MARKER_IDS', np.array([[3], [7]])[::-1])
+        self._bundle.insert_raw('EMPTY', np.zeros((0, 4, 2)))
+        decoded = Bundle.construct_from_binary(self._bundle.to_binary())
+        for key in ('SCAN_CORNERS', 'SCAN_MARKER_IDS', 'EMPTY'):
+            expected = self._bundle.raws(key)
+            self.assertEqual(decoded.raws(key).dtype, expected.dtype)
+            np.testing.assert_array_equal(decoded.raws(key), expected)
+        # arrays are copied out of the message
+        decoded.raws('SCAN_CORNERS')[0] = -1
+        np.testing.assert_array_equal(self._bundle.raws('SCAN_CORNERS'), corners)
+
+    def test_construct_from_binary_invalid(self):
+        self.assertRaises(BinaryCodecError, Bundle.construct_from_binary, Bundle().to_json().encode())
+        bundle_bytes = bytearray(Bundle().to_binary())
+        bundle_bytes[len(Bundle.BINARY_MAGIC) + 4:len(Bundle.BINARY_MAGIC) + 8] = b'\x01\x00\x00\x00'
+        self.assertRaises(Exception, Bundle.construct_from_binary, bytes(bundle_bytes))
+
+    def test_construct_from_json_is_lazy(self):
+        self._bundle.insert_string('JOB_ID', 'JOB')
+        self._bundle.insert_number('COUNT', 2)
+        self._bundle.insert_raw('SCAN_MARKERS', [{'aerocubeID': 1}])
+        bundle_json = self._bundle.to_json()
+        decoded = Bundle.construct_from_json(bundle_json)
+        # Forwarded without decoding
+        self.assertIs(decoded.to_json(), bundle_json)
+        self.assertEqual(decoded.strings('JOB_ID'), 'JOB')
+        self.assertNotIn('_raws', decoded.__dict__)
+        self.assertEqual(decoded, self._bundle)
+        self.assertEqual(Bundle.construct_from_json(bundle_json).to_json(), bundle_json)
+
+    def test_construct_from_json_invalid_on_access(self):
+        for bundle_json in ('{"strings": {}, "numbers": {"COUNT": "two"}, "raws": {}, "iterables": {}}',
+                            '{"iterables": {}, "numbers": {"COUNT": "two"}, "raws": {}, "strings": {}}'):
+            decoded = Bundle.construct_from_json(bundle_json)
+            self.assertEqual(decoded.strings(), {})
+            self.assertEqual(decoded.iterables(), {})
+            self.assertRaises(AttributeError, decoded.numbers)
+            # Still invalid on later accesses, rather than half filled
+            self.assertRaises(AttributeError, decoded.numbers)
+            self.assertRaises(AttributeError, decoded.validate)
+
+    def test_construct_from_json_invalid_entries_kept_pending(self):
+        decoded = Bundle.construct_from_json('{"strings": {}, "numbers": {"A": 1, "B": "two"}, "raws": {}, '
+                                             '"iterables": {}}')
+        self.assertRaises(AttributeError, decoded.numbers)
+        self.assertRaises(AttributeError, decoded.numbers)
+        self.assertNotIn('_numbers', decoded.__dict__)
+        self.assertIn('"B": "two"', decoded.to_json())
 
 
 if __name__ == '__main__':
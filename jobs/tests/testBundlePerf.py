@@ -0,0 +1,80 @@
+import timeit
+import unittest
+
+import numpy as np
+
+from jobs import aeroCubeEvent, bundle
+from jobs.aeroCubeEvent import AeroCubeEvent, ImageEvent
+from jobs.aeroCubeSignal import ImageEventSignal
+from jobs.bundle import Bundle
+from jobs.settings import job_id_bundle_key
+
+
+class TestBundlePerf(unittest.TestCase):
+    """
+    Concerned with measuring the encode/decode throughput of the JSON and binary codecs rather than correctness.
+    """
+    _NUM_MARKERS = 200
+    _REPEAT = 50
+
+    @classmethod
+    def setUpClass(cls):
+        from logger import Logger
+        Logger.prevent_external()
+        # Debug logs print whole encoded events, which would dwarf the time spent in the codecs
+        aeroCubeEvent.logger.disable()
+        bundle.logger.disable()
+        rng = np.random.RandomState(0)
+        cls._corners = rng.uniform(0, 4000, size=(cls._NUM_MARKERS, 1, 4, 2)).astype(np.float32)
+        cls._ids = np.arange(cls._NUM_MARKERS).reshape(-1, 1)
+        cls._markers = [{
+            "aerocubeID": int(i) // 6,
+            "aerocubeFace": int(i) % 6,
+            "corners": c[0].tolist(),
+            "quaternion": dict(zip(['w', 'x', 'y', 'z'], rng.normal(size=4).tolist())),
+            "distance": float(rng.uniform())
+        } for i, c in zip(cls._ids.ravel(), cls._corners)]
+
+    @classmethod
+    def tearDownClass(cls):
+        aeroCubeEvent.logger.enable()
+        bundle.logger.enable()
+
+    def _get_event(self, corners, ids):
+        payload = Bundle()
+        payload.insert_string(job_id_bundle_key, 'JOB')
+        payload.insert_string(ImageEvent.SCAN_ID, '123456789')
+        payload.insert_raw(ImageEvent.SCAN_CORNERS, corners)
+        payload.insert_raw(ImageEvent.SCAN_MARKER_IDS, ids)
+        payload.insert_raw(ImageEvent.SCAN_MARKERS, self._markers)
+        return ImageEvent(ImageEventSignal.IDENTIFY_AEROCUBES, bundle=payload)
+
+    def _time(self, func):
+        return min(timeit.repeat(func, number=self._REPEAT, repeat=3)) / self._REPEAT
+
+    def test_time_json_vs_binary(self):
+        # JSON needs arrays converted to nested lists first
+        json_event = self._get_event(self._corners.tolist(), self._ids.tolist())
+        binary_event = self._get_event(self._corners, self._ids)
+        json_str = json_event.encode(AeroCubeEvent.CODEC_JSON)
+        binary_bytes = binary_event.encode(AeroCubeEvent.CODEC_BINARY)
+        # JSON payloads are decoded lazily, so decoding includes reading the raws
+        results = {
+            'json': (self._time(lambda: self._get_event(self._corners.tolist(), self._ids.tolist()).to_json()),
+                     self._time(lambda: AeroCubeEvent.decode(json_str).payload.raws()),
+                     len(json_str.encode())),
+            'binary': (self._time(lambda: self._get_event(self._corners, self._ids).to_binary()),
+                       self._time(lambda: AeroCubeEvent.decode(binary_bytes).payload.raws()),
+                       len(binary_bytes))
+        }
+        for codec, (encode_time, decode_time, size) in results.items():
+            print('{}: encode {:.3f} ms ({:.1f} MB/s), decode {:.3f} ms ({:.1f} MB/s), {} bytes'.format(
+                codec, encode_time * 1e3, size / encode_time / 1e6, decode_time * 1e3, size / decode_time / 1e6, size))
+        decoded = AeroCubeEvent.decode(binary_bytes)
+        np.testing.assert_array_equal(decoded.payload.raws(ImageEvent.SCAN_CORNERS), self._corners)
+        self.assertEqual(decoded.payload.raws(ImageEvent.SCAN_MARKERS), self._markers)
+        self.assertEqual(AeroCubeEvent.decode(json_str).payload.raws(ImageEvent.SCAN_CORNERS), self._corners.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from jobs.aeroCubeEvent import ImageEvent, ResultEvent
+from jobs.aeroCubeSignal import ResultEventSignal
+from jobs.jobCoalescer import JobCoalescer
+from jobs.settings import job_id_bundle_key
+from jobs.tests.jobFixtures import create_image_upload_job, create_result
+
+
+class TestJobCoalescer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from logger import Logger
+        Logger.prevent_external()
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._coalescer = JobCoalescer(window=10, max_entries=2)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self._dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_fingerprint(self):
+        first = create_image_upload_job(self._write('a.jpg', b'image'))
+        copy = create_image_upload_job(self._write('b.jpg', b'image'))
+        other = create_image_upload_job(self._write('c.jpg', b'other image'))
+        self.assertEqual(self._coalescer.fingerprint(first), self._coalescer.fingerprint(copy))
+        self.assertNotEqual(self._coalescer.fingerprint(first), self._coalescer.fingerprint(other))
+        # Detection parameters are part of the fingerprint
+        copy.root_event.payload.insert_number('MARKER_SIZE', 2)
+        self.assertNotEqual(self._coalescer.fingerprint(first), self._coalescer.fingerprint(copy))
+        self.assertNotEqual(self._coalescer.fingerprint(first),
+                            JobCoalescer(params={'calibration': 'other'}).fingerprint(first))
+        self.assertIsNone(self._coalescer.fingerprint(create_image_upload_job(os.path.join(self._dir, 'missing.jpg'))))
+
+    def test_attach_to_job_being_scanned(self):
+        path = self._write('a.jpg', b'image')
+        primary, duplicate = create_image_upload_job(path), create_image_upload_job(path)
+        self.assertEqual(self._coalescer.coalesce(primary, now=0), (None, False))
+        self.assertEqual(self._coalescer.coalesce(duplicate, now=1), (None, True))
+        self.assertIn(duplicate, self._coalescer)
+        result_event = create_result(primary.root_event, scan_id='123')
+        self.assertEqual(self._coalescer.resolve(primary, result_event, now=2), [duplicate])
+        self.assertEqual(len(self._coalescer), 0)
+        # Given its own copy of the result
+        result_event, attached = self._coalescer.coalesce(duplicate, now=3)
+        self.assertFalse(attached)
+        self.assertEqual(result_event.payload.strings(ResultEvent.CALLING_EVENT_UUID), duplicate.root_event.uuid)
+        self.assertEqual(result_event.payload.strings(job_id_bundle_key), duplicate.uuid)
+        self.assertEqual(result_event.payload.strings(ImageEvent.SCAN_ID),
+                         str(duplicate.root_event.created_at).split('.')[0])
+
+    def test_errors_not_kept(self):
+        path = self._write('a.jpg', b'image')
+        primary, duplicate = create_image_upload_job(path), create_image_upload_job(path)
+        self._coalescer.coalesce(primary, now=0)
+        self._coalescer.coalesce(duplicate, now=0)
+        self._coalescer.resolve(primary, create_result(primary.root_event, ResultEventSignal.ERROR), now=1)
+        # Scanned itself
+        self.assertEqual(self._coalescer.coalesce(duplicate, now=1), (None, False))
+
+    def test_results_bounded(self):
+        jobs = [create_image_upload_job(self._write('{}.jpg'.format(i), str(i).encode())) for i in range(3)]
+        for now, job in enumerate(jobs):
+            self._coalescer.coalesce(job, now=now)
+            self._coalescer.resolve(job, create_result(job.root_event, scan_id='123'), now=now)
+        # Only the most recent max_entries results are kept, for window seconds
+        self.assertIsNone(self._coalescer.coalesce(create_image_upload_job(jobs[0].root_event.payload.strings(
+            ImageEvent.FILE_PATH)), now=3)[0])
+        self.assertIsNotNone(self._coalescer.coalesce(create_image_upload_job(jobs[2].root_event.payload.strings(
+            ImageEvent.FILE_PATH)), now=3)[0])
+        self.assertIsNone(self._coalescer.coalesce(create_image_upload_job(jobs[2].root_event.payload.strings(
+            ImageEvent.FILE_PATH)), now=20)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,17 @@
+import json
+import os
+import tempfile
 import unittest
-from collections import deque
 from unittest.mock import Mock
 
+import numpy as np
+
 from ..aeroCubeJob import *
+from ..jobCoalescer import JobCoalescer
 from ..jobHandler import JobHandler
+from ..jobQueue import JobPriority
+from ..sharedRaw import SharedRaw
+from .jobFixtures import create_image_upload_job, create_job, create_result
 
 
 class TestJobHandler(unittest.TestCase):
@@ -34,8 +42,8 @@ class TestJobHandler(unittest.TestCase):
         self._handler = JobHandler(self._on_event_mock, self._on_enqueue_mock, self._on_dequeue_mock)
 
     def tearDown(self):
-        self._handler._job_deque.clear()
-        self._handler._job_deque = None
+        self._handler._job_queue.clear()
+        self._handler._job_queue = None
         self._handler = None
 
     # Init
@@ -47,8 +55,8 @@ class TestJobHandler(unittest.TestCase):
 
         job_handler = JobHandler(on_event_mock, on_enqueue_mock, on_dequeue_mock)
         # Deque is set and empty
-        self.assertIsNotNone(self._handler._job_deque)
-        self.assertEqual(0, len(self._handler._job_deque))
+        self.assertIsNotNone(self._handler._job_queue)
+        self.assertEqual(0, len(self._handler._job_queue))
         job_handler._on_start_event(self.image_event)
         job_handler._on_job_enqueue(self.valid_job)
         job_handler._on_job_dequeue(self.other_valid_job)
@@ -59,6 +67,16 @@ class TestJobHandler(unittest.TestCase):
         # State is STARTED
         self.assertEqual(JobHandler.State.STARTED, job_handler._state)
 
+    def test_enqueue_without_start_event_observer(self):
+        handler = JobHandler()
+        self.assertRaises(NotImplementedError, handler.enqueue_job, self.valid_job)
+        # Still scheduled, and started once there is an observer
+        self.assertTrue(handler.has_jobs)
+        self.assertEqual(handler.jobs, [self.valid_job])
+        handler.set_start_event_observer(self._on_event_mock)
+        handler.enqueue_job(self.other_valid_job)
+        self._on_event_mock.assert_called_once_with(handler, self.valid_job.current_event)
+
     # set_observers
 
     def test_set_start_event_observer(self):
@@ -83,13 +101,13 @@ class TestJobHandler(unittest.TestCase):
 
     def test_enqueue_job(self):
         self._handler.enqueue_job(self.valid_job)
-        self.assertEqual(self._handler._job_deque, deque([self.valid_job]))
+        self.assertEqual(self._handler.jobs, [self.valid_job])
 
     def test_enqueue_multiple_jobs(self):
         self._handler.enqueue_job(self.valid_job)
         self._handler.enqueue_job(self.other_valid_job)
-        self.assertEqual(self._handler._job_deque,
-                         deque([self.valid_job, self.other_valid_job]))
+        self.assertEqual(self._handler.jobs,
+                         [self.valid_job, self.other_valid_job])
 
     def test_enqueue_job_runs_start_sending_events(self):
         self._handler._start_sending_events = Mock()
@@ -107,10 +125,19 @@ class TestJobHandler(unittest.TestCase):
 
     def test_dequeue_job(self):
         self._handler.enqueue_job(self.valid_job)
-        self.assertEqual(self._handler._job_deque,
-                         deque([self.valid_job]))
+        self.assertEqual(self._handler.jobs,
+                         [self.valid_job])
+        self._handler._dequeue_job()
+        self.assertEqual(self._handler.jobs, [])
+
+    def test_dequeue_job_releases_shared_raws(self):
+        shared_raw = SharedRaw.create(np.zeros(16), owner=self.valid_job.uuid)
+        handle = shared_raw.handle
+        shared_raw.release()
+        self._handler.enqueue_job(self.valid_job)
+        SharedRaw.from_handle(handle).release()
         self._handler._dequeue_job()
-        self.assertEqual(self._handler._job_deque, deque())
+        self.assertRaises(FileNotFoundError, SharedRaw.from_handle, handle)
 
     def test_dequeue_event_exception(self):
         self.assertRaises(IndexError, self._handler._dequeue_job)
@@ -152,9 +179,9 @@ class TestJobHandler(unittest.TestCase):
     # any_jobs
 
     def test_any_jobs_not_empty(self):
-        self._handler._job_deque.append(self.valid_job)
+        self._handler._job_queue.push(self.valid_job)
         self.assertTrue(self._handler.has_jobs)
-        self._handler._job_deque.append(self.other_valid_job)
+        self._handler._job_queue.push(self.other_valid_job)
         self.assertTrue(self._handler.has_jobs)
 
     def test_any_events_empty(self):
@@ -178,7 +205,7 @@ class TestJobHandler(unittest.TestCase):
 
     def test_has_jobs(self):
         self.assertFalse(self._handler.has_jobs)
-        self._handler._job_deque.append(self.valid_job)
+        self._handler._job_queue.push(self.valid_job)
         self.assertTrue(self._handler.has_jobs)
 
     # state changes
@@ -202,7 +229,7 @@ class TestJobHandler(unittest.TestCase):
     def test_state_restart_empty(self):
         self._handler.enqueue_job(self.valid_job)
         self._handler.force_stop()
-        self._handler._job_deque.popleft()
+        self._handler._dequeue_job()
         self._handler.restart()
         self.assertEqual(self._handler._state, JobHandler.State.STARTED)
 
@@ -224,5 +251,128 @@ class TestJobHandler(unittest.TestCase):
         self._handler._state = JobHandler.State.STOPPED
         self.assertRaises(JobHandler.NotAllowedInStateException, self._handler._can_state_resolve)
 
+    # concurrent events
+
+    def _started_events(self):
+        return [args[0][1] for args in self._on_event_mock.call_args_list]
+
+    def test_max_in_flight_events(self):
+        handler = JobHandler(self._on_event_mock, max_in_flight=2)
+        jobs = [create_job(id) for id in ('A', 'B', 'C')]
+        for job in jobs:
+            handler.enqueue_job(job)
+        self.assertEqual(self._started_events(), [jobs[0].current_event, jobs[1].current_event])
+        self.assertEqual(handler.state, JobHandler.State.PENDING)
+        # Results may come back in any order
+        self.assertTrue(handler.resolve_event(create_result(jobs[1].current_event)))
+        self.assertEqual(self._started_events()[-1], jobs[2].current_event)
+        self.assertEqual(handler.in_flight_events, [jobs[0].current_event, jobs[2].current_event])
+        self.assertEqual(handler.jobs, [jobs[0], jobs[2]])
+        self.assertFalse(handler.resolve_event(create_result(jobs[1].root_event)))
+        self.assertTrue(handler.resolve_event(create_result(jobs[0].current_event)))
+        self.assertEqual(handler.state, JobHandler.State.STARTED)
+        self.assertTrue(handler.resolve_event(create_result(jobs[2].current_event)))
+        self.assertFalse(handler.has_jobs)
+        self.assertRaises(JobHandler.NotAllowedInStateException, handler._can_state_resolve)
+
+    def test_in_flight_events_keep_job_order(self):
+        handler = JobHandler(self._on_event_mock, max_in_flight=3)
+        job = create_job('A', num_events=2)
+        other_job = create_job('B')
+        handler.enqueue_job(job)
+        handler.enqueue_job(other_job)
+        first_event = job.current_event
+        # One event per job in flight, even with room for more
+        self.assertEqual(self._started_events(), [first_event, other_job.current_event])
+        self.assertEqual(handler.state, JobHandler.State.STARTED)
+        handler.resolve_event(create_result(first_event))
+        self.assertNotEqual(job.current_event, first_event)
+        self.assertEqual(self._started_events()[-1], job.current_event)
+
+    def test_interactive_jobs_scheduled_first(self):
+        handler = JobHandler(self._on_event_mock)
+        running = create_job('A')
+        handler.enqueue_job(running)
+        backfills = [create_job(id, priority=JobPriority.REPROCESSING) for id in ('B', 'C')]
+        for job in backfills:
+            handler.enqueue_job(job)
+        interactive = create_job('D')
+        handler.enqueue_job(interactive)
+        self.assertEqual(handler.jobs, [running, interactive] + backfills)
+        handler.resolve_event(create_result(running.current_event))
+        self.assertEqual(self._started_events(), [running.root_event, interactive.current_event])
+
+    def test_stop_waits_for_events_in_flight(self):
+        handler = JobHandler(self._on_event_mock, max_in_flight=2)
+        jobs = [create_job(id) for id in ('A', 'B')]
+        for job in jobs:
+            handler.enqueue_job(job)
+        handler.stop()
+        handler.resolve_event(create_result(jobs[0].current_event))
+        self.assertEqual(handler.state, JobHandler.State.PENDING_STOP_ON_RESOLVE)
+        handler.resolve_event(create_result(jobs[1].current_event))
+        self.assertEqual(handler.state, JobHandler.State.STOPPED)
+        self.assertEqual(len(self._started_events()), 2)
+
+    def test_fan_out_branches_in_flight_together(self):
+        handler = JobHandler(self._on_event_mock, max_in_flight=3)
+        job = create_image_upload_job('path', ext_store_target='FIREBASE')
+        other_job = create_job('B')
+        handler.enqueue_job(job)
+        handler.enqueue_job(other_job)
+        handler.resolve_event(create_result(job.root_event))
+        int_store_event, ext_store_event = job.current_events
+        self.assertEqual(handler.in_flight_events, [other_job.current_event, int_store_event, ext_store_event])
+        self.assertEqual(handler.jobs, [other_job, job])
+        handler.resolve_event(create_result(ext_store_event))
+        self.assertEqual(handler.in_flight_events, [other_job.current_event, int_store_event])
+        self.assertEqual(len(self._started_events()), 4)
+        handler.resolve_event(create_result(int_store_event))
+        self.assertEqual(handler.jobs, [other_job])
+
+    def test_invalid_result_payload_not_resolved(self):
+        handler = JobHandler(self._on_event_mock)
+        job = create_job('A', num_events=2)
+        handler.enqueue_job(job)
+        event = job.current_event
+        result_json = json.loads(create_result(event).to_json())
+        result_json['payload'] = json.dumps({'strings': {ResultEvent.CALLING_EVENT_UUID: event.uuid,
+                                                         job_id_bundle_key: 'A'},
+                                             'numbers': {'COUNT': 'two'}, 'raws': {}, 'iterables': {}})
+        self.assertFalse(handler.resolve_event(AeroCubeEvent.construct_from_json(json.dumps(result_json))))
+        # Neither the handler nor the job moved on
+        self.assertEqual(handler.in_flight_events, [event])
+        self.assertEqual(job.current_event, event)
+        self.assertTrue(handler.resolve_event(create_result(event)))
+
+    def test_duplicate_images_scanned_once(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'image.jpg')
+            with open(path, 'wb') as f:
+                f.write(b'image')
+            # Not coalesced unless asked to
+            handler = JobHandler(self._on_event_mock, max_in_flight=2)
+            jobs = [create_image_upload_job(path) for _ in range(2)]
+            for job in jobs:
+                handler.enqueue_job(job)
+            self.assertEqual(self._started_events(), [job.root_event for job in jobs])
+            self._on_event_mock.reset_mock()
+            handler = JobHandler(self._on_event_mock, job_dequeue_observer=self._on_dequeue_mock, max_in_flight=2,
+                                 coalescer=JobCoalescer())
+            jobs = [create_image_upload_job(path) for _ in range(2)]
+            for job in jobs:
+                handler.enqueue_job(job)
+            self.assertEqual(self._started_events(), [jobs[0].root_event])
+            self.assertEqual(handler.jobs, jobs)
+            handler.resolve_event(create_result(jobs[0].root_event))
+            # Each job stores its own copy of the result
+            self.assertEqual(self._started_events()[1:], [job.current_event for job in jobs])
+            # Scanned recently, so a retry skips straight to storage
+            retry = create_image_upload_job(path, int_storage=False)
+            handler.enqueue_job(retry)
+            self.assertTrue(retry.is_finished)
+            self._on_dequeue_mock.assert_called_once_with(retry)
+
+
 if __name__ == '__main__':
     unittest.main()
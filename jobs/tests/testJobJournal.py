@@ -0,0 +1,207 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from unittest.mock import Mock
+
+import numpy as np
+
+from jobs.aeroCubeEvent import ImageEvent
+from jobs.jobHandler import JobHandler
+from jobs.jobJournal import JobJournal, JobJournalError
+from jobs.jobQueue import JobPriority
+from jobs.sharedRaw import SharedRaw
+from jobs.tests.jobFixtures import create_image_upload_job, create_result
+
+
+class TestJobJournal(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from logger import Logger
+        Logger.prevent_external()
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'jobs.journal')
+        self._journal = JobJournal(self._path)
+
+    def tearDown(self):
+        self._journal.close()
+        shutil.rmtree(self._dir)
+
+    def _reopen(self):
+        self._journal.close()
+        self._journal = JobJournal(self._path)
+        return self._journal.recovered_jobs
+
+    def _create_job(self, path='path'):
+        # Recorded with all of its attributes
+        return create_image_upload_job(path, ext_store_target='FIREBASE', priority=JobPriority.REPROCESSING,
+                                       deadline=10.)
+
+    def test_replay_to_current_nodes(self):
+        job = self._create_job()
+        self._journal.record_enqueue(job)
+        result_event = create_result(job.root_event, scan_id='123')
+        job.update_current_node(result_event, merge_payload=True)
+        self._journal.record_resolve(job, result_event)
+        # One branch of the fan-out done, the other still in flight
+        result_event = create_result(job.current_events[1])
+        job.update_current_node(result_event, merge_payload=True)
+        self._journal.record_resolve(job, result_event)
+        finished_job = self._create_job('other_path')
+        self._journal.record_enqueue(finished_job)
+        self._journal.record_dequeue(finished_job)
+        recovered_job, = self._reopen()
+        self.assertEqual(recovered_job.uuid, job.uuid)
+        self.assertEqual(recovered_job.created_at, job.created_at)
+        self.assertEqual(recovered_job.priority, JobPriority.REPROCESSING)
+        self.assertEqual(recovered_job.deadline, 10.)
+        self.assertEqual(recovered_job.current_events, job.current_events)
+        self.assertEqual(recovered_job.current_event.payload.strings(ImageEvent.SCAN_ID), '123')
+
+    def test_torn_record_cut_off(self):
+        jobs = [self._create_job(str(i)) for i in range(2)]
+        for job in jobs:
+            self._journal.record_enqueue(job)
+        self._journal.sync()
+        size = self._journal.size
+        self._journal.close()
+        with open(self._path, 'r+b') as f:
+            f.truncate(size - 10)
+        self.assertEqual(self._reopen(), jobs[:1])
+        self.assertLess(self._journal.size, size - 10)
+        # Corruption before the last record cannot come from a crash, so the file is kept aside
+        self._journal.record_enqueue(jobs[1])
+        self._journal.close()
+        with open(self._path, 'r+b') as f:
+            f.seek(20)
+            f.write(b'\xff\xff')
+        size = os.path.getsize(self._path)
+        self.assertEqual(self._reopen(), [])
+        self.assertEqual(self._journal.size, 0)
+        corrupt_path, = glob.glob(self._path + '.corrupt-*')
+        self.assertEqual(os.path.getsize(corrupt_path), size)
+
+    def test_failed_write_retried(self):
+        journal = JobJournal(os.path.join(self._dir, 'failing.journal'), retry_interval=0)
+        jobs = [self._create_job(str(i)) for i in range(2)]
+        fsync = os.fsync
+        calls = []
+
+        def fail_once(fd):
+            calls.append(fd)
+            if len(calls) == 1:
+                raise OSError('No space left on device')
+            fsync(fd)
+
+        with mock.patch('jobs.jobJournal.os.fsync', fail_once):
+            journal.record_enqueue(jobs[0])
+            self.assertRaises(JobJournalError, journal.sync)
+            # Reported once, while the batch is written again
+            journal.record_enqueue(jobs[1])
+            journal.sync()
+        # Without the copy left by the failed write
+        self.assertEqual(os.path.getsize(journal.path), journal.size)
+        journal.close()
+        reopened = JobJournal(journal.path)
+        self.assertEqual(reopened.recovered_jobs, jobs)
+        reopened.close()
+
+    def test_job_with_released_shared_raw_dropped(self):
+        SharedRaw.register_owner_process()
+        jobs = [self._create_job(str(i)) for i in range(2)]
+        for job in jobs:
+            self._journal.record_enqueue(job)
+        shared_raw = SharedRaw.create(np.zeros(4), owner=jobs[0].uuid)
+        result_event = create_result(jobs[0].root_event, scan_id='123')
+        result_event.payload.insert_raw(ImageEvent.SCAN_CORNERS, shared_raw)
+        jobs[0].update_current_node(result_event, merge_payload=True)
+        self._journal.record_resolve(jobs[0], result_event)
+        # Unlinked, as when the process stops
+        shared_raw.release()
+        SharedRaw.release_owner(jobs[0].uuid)
+        self.assertEqual(self._reopen(), jobs[1:])
+        # And dequeued, so not replayed again
+        self.assertEqual(self._reopen(), jobs[1:])
+
+    def test_finished_job_not_dequeued_dropped(self):
+        jobs = [self._create_job(str(i)) for i in range(2)]
+        for job in jobs:
+            self._journal.record_enqueue(job)
+        # The process stopped after the last result was recorded, before the job was dequeued
+        while not jobs[0].is_finished:
+            result_event = create_result(jobs[0].current_event, scan_id='123')
+            jobs[0].update_current_node(result_event, merge_payload=True)
+            self._journal.record_resolve(jobs[0], result_event)
+        self.assertEqual(self._reopen(), jobs[1:])
+        self.assertEqual(self._reopen(), jobs[1:])
+        # Its records are dead, dequeue included
+        self.assertEqual(list(self._journal._live), [jobs[1].uuid])
+        self.assertEqual(self._journal._dead_bytes,
+                         self._journal.size - sum(length for _, length in self._journal._live[jobs[1].uuid]))
+
+    def test_compaction(self):
+        journal = JobJournal(os.path.join(self._dir, 'compacted.journal'), compact_min_bytes=0)
+        jobs = [self._create_job(str(i)) for i in range(10)]
+        for job in jobs:
+            journal.record_enqueue(job)
+        for job in jobs[:-1]:
+            journal.record_dequeue(job)
+        journal.sync()
+        # Compacted once dead records outweighed the rest
+        self.assertEqual(journal.size, os.path.getsize(journal.path))
+        self.assertLess(journal.size, 2 * len(jobs[-1].to_binary()))
+        journal.close()
+        reopened = JobJournal(journal.path)
+        self.assertEqual(reopened.recovered_jobs, jobs[-1:])
+        reopened.close()
+        self.assertRaises(JobJournalError, journal.record_dequeue, jobs[-1])
+
+    def test_job_handler_restores_jobs(self):
+        handler = JobHandler(Mock(), journal=self._journal)
+        jobs = [self._create_job(str(i)) for i in range(2)]
+        for job in jobs:
+            handler.enqueue_job(job)
+        handler.resolve_event(create_result(jobs[0].root_event))
+        self._reopen()
+        on_event_mock = Mock()
+        restored_handler = JobHandler(on_event_mock, journal=self._journal)
+        self.assertEqual(restored_handler.restore_jobs(), jobs)
+        # The event in flight is started again
+        self.assertEqual([args[0][1] for args in on_event_mock.call_args_list], [jobs[0].current_event])
+        self.assertEqual(restored_handler.jobs, jobs)
+
+    def test_enqueue_durable_before_event_started(self):
+        sizes = []
+
+        def on_start_event(handler, event):
+            sizes.append(os.path.getsize(self._path))
+
+        handler = JobHandler(on_start_event, journal=self._journal, max_in_flight=2)
+        for job in [self._create_job(str(i)) for i in range(2)]:
+            handler.enqueue_job(job)
+            self.assertEqual(sizes[-1], self._journal.size)
+
+    def test_restore_with_synchronous_observer(self):
+        jobs = [self._create_job(str(i)) for i in range(300)]
+        for job in jobs:
+            self._journal.record_enqueue(job)
+        self._reopen()
+        dequeued = []
+
+        def on_start_event(handler, event):
+            # Resolved before returning, as a handler in the same thread may
+            handler.resolve_event(create_result(event, scan_id='123'))
+
+        handler = JobHandler(on_start_event, job_dequeue_observer=dequeued.append, journal=self._journal)
+        self.assertEqual(handler.restore_jobs(), jobs)
+        self.assertEqual(dequeued, jobs)
+        self.assertFalse(handler.has_jobs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+from jobs.aeroCubeEvent import ImageEvent
+from jobs.aeroCubeJob import AeroCubeJob, AeroCubeJobEventNode
+from jobs.aeroCubeSignal import ImageEventSignal
+from jobs.jobQueue import JobPriority, JobQueue
+
+
+class TestJobQueue(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from logger import Logger
+        Logger.prevent_external()
+
+    def setUp(self):
+        self._queue = JobQueue()
+
+    def _create_job(self, id, priority=JobPriority.INTERACTIVE, deadline=None):
+        node = AeroCubeJobEventNode(ImageEvent(ImageEventSignal.IDENTIFY_AEROCUBES, id=id))
+        return AeroCubeJob(node, id=id, priority=priority, deadline=deadline)
+
+    def test_pop_empty(self):
+        self.assertIsNone(self._queue.peek())
+        self.assertRaises(IndexError, self._queue.pop)
+
+    def test_same_priority_is_fifo(self):
+        jobs = [self._create_job(id) for id in 'ABC']
+        for job in jobs:
+            self._queue.push(job, now=0)
+        self.assertEqual(list(self._queue), jobs)
+        self.assertEqual([self._queue.pop() for _ in jobs], jobs)
+
+    def test_priority_with_aging(self):
+        backfill = self._create_job('BACKFILL', JobPriority.REPROCESSING)
+        self._queue.push(backfill, now=0)
+        interactive = self._create_job('INTERACTIVE')
+        self._queue.push(interactive, now=1)
+        self.assertIs(self._queue.peek(), interactive)
+        # Pushed after the backfill's aging delay, so it no longer jumps ahead
+        late = self._create_job('LATE')
+        self._queue.push(late, now=JobQueue.DEFAULT_AGING[JobPriority.REPROCESSING] + 1)
+        self.assertEqual(list(self._queue), [interactive, backfill, late])
+
+    def test_deadline(self):
+        interactive = self._create_job('INTERACTIVE')
+        self._queue.push(interactive, now=10)
+        log_job = self._create_job('LOGS', JobPriority.LOG_SHIPPING, deadline=5)
+        self._queue.push(log_job, now=10)
+        self.assertEqual(self._queue.get_due(log_job), 5)
+        self.assertIs(self._queue.pop(), log_job)
+
+    def test_push_again_keeps_place(self):
+        first, second = self._create_job('A'), self._create_job('B')
+        self._queue.push(first, now=0)
+        self._queue.push(second, now=1)
+        self.assertIs(self._queue.pop(), first)
+        self._queue.push(first, now=2)
+        self.assertIs(self._queue.peek(), first)
+        self.assertRaises(AttributeError, self._queue.push, first)
+
+    def test_discard(self):
+        first, second = self._create_job('A'), self._create_job('B')
+        self._queue.push(first, now=0)
+        self._queue.push(second, now=1)
+        self._queue.discard(first)
+        self.assertEqual(len(self._queue), 1)
+        self.assertNotIn(first, self._queue)
+        self.assertIs(self._queue.pop(), second)
+        # Its place is forgotten
+        self._queue.push(first, now=2)
+        self._queue.push(second, now=3)
+        self.assertEqual(self._queue.get_due(first), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
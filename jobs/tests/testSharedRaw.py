@@ -0,0 +1,97 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from jobs.aeroCubeEvent import AeroCubeEvent, ImageEvent
+from jobs.aeroCubeSignal import ImageEventSignal
+from jobs.bundle import Bundle
+from jobs.settings import job_id_bundle_key
+from jobs.sharedRaw import SharedRaw, SharedRawError
+
+# Run in a separately started interpreter, as the Controller is
+_SUM_SHARED_RAW = """
+import json, sys
+from jobs.sharedRaw import SharedRaw
+shared_raw = SharedRaw.from_handle(json.loads(sys.argv[1]))
+print(float(shared_raw.array.sum()))
+# Written in place, visible to the creating process
+shared_raw.array[0] = -1
+shared_raw.release()
+"""
+
+
+class TestSharedRaw(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from logger import Logger
+        Logger.prevent_external()
+
+    def setUp(self):
+        self._owner = 'JOB'
+        self._array = np.arange(4000, dtype=np.float32).reshape(1000, 4)
+        SharedRaw.register_owner_process()
+        self._shared_raw = SharedRaw.create(self._array, owner=self._owner)
+
+    def tearDown(self):
+        self._shared_raw.release()
+        SharedRaw.release_owner(self._owner)
+
+    def _get_event(self):
+        bundle = Bundle()
+        bundle.insert_string(job_id_bundle_key, self._owner)
+        bundle.insert_raw(ImageEvent.SCAN_CORNERS, self._shared_raw)
+        return ImageEvent(ImageEventSignal.IDENTIFY_AEROCUBES, bundle=bundle)
+
+    def test_create(self):
+        np.testing.assert_array_equal(self._shared_raw.array, self._array)
+        self.assertEqual(self._shared_raw.shape, (1000, 4))
+        self.assertEqual(self._shared_raw.dtype, np.float32)
+        self.assertRaises(SharedRawError, SharedRaw.create, self._array.tolist(), self._owner)
+
+    def test_create_only_in_owner_process(self):
+        # E.g., the Controller, which cannot release what it would create
+        with mock.patch('jobs.sharedRaw.os.getpid', return_value=-1):
+            self.assertRaises(SharedRawError, SharedRaw.create, self._array, self._owner)
+
+    def test_handle_round_trip_with_both_codecs(self):
+        event = self._get_event()
+        # Only the handle is serialized
+        self.assertLess(len(event.to_json()), 1000)
+        for encoded in (event.encode(AeroCubeEvent.CODEC_JSON), event.encode(AeroCubeEvent.CODEC_BINARY)):
+            decoded = AeroCubeEvent.decode(encoded)
+            shared_raw = decoded.payload.raws(ImageEvent.SCAN_CORNERS)
+            self.assertEqual(shared_raw, self._shared_raw)
+            self.assertEqual(decoded.payload, event.payload)
+            # Maps the same memory rather than holding a copy
+            shared_raw.array[0, 0] = 42
+            self.assertEqual(self._shared_raw.array[0, 0], 42)
+            shared_raw.release()
+
+    def test_other_process_maps_without_copy(self):
+        root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        output = subprocess.run([sys.executable, '-c', _SUM_SHARED_RAW, json.dumps(self._shared_raw.handle)],
+                                cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60, check=True)
+        self.assertEqual(float(output.stdout), self._array.sum())
+        self.assertEqual(output.stderr, b'')
+        self.assertEqual(self._shared_raw.array[0, 0], -1)
+        self.assertEqual(self._shared_raw.array[0, 1], -1)
+
+    def test_release_owner_unlinks(self):
+        handle = self._shared_raw.handle
+        SharedRaw.release_owner(self._owner)
+        # Still referenced by self._shared_raw
+        SharedRaw.from_handle(handle).release()
+        self._shared_raw.release()
+        self.assertRaises(SharedRawError, getattr, self._shared_raw, 'array')
+        self.assertRaises(FileNotFoundError, SharedRaw.from_handle, handle)
+        self.assertRaises(SharedRawError, SharedRaw.from_handle, {'name': handle[SharedRaw.HANDLE_KEY]['name']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -40,7 +40,7 @@ class Logger:
         self._external = external
 
     def _log(self, log_type, class_name=None, func_name='', msg='', id=None):
-        if self._active and not global_log_disable:
+        if self.is_enabled:
             log_statement = '{}: {}'.format(log_type, self._filename)
             if class_name is not None:
                 log_statement += '.{}'.format(class_name)
@@ -53,6 +53,13 @@ class Logger:
                 from externalComm.commClass import FirebaseComm
                 external_write(FirebaseComm.NAME, scanID=str(time.time()).split('.')[0], location='logs/{}'.format(id), data=log_statement, testing=True)
 
+    @property
+    def is_enabled(self):
+        """
+        Whether logs are printed; check it before formatting expensive messages (e.g., whole events)
+        """
+        return self._active and not global_log_disable
+
     @classmethod
     def prevent_external(cls):
         cls._prevent_external = True